@@ -14,7 +14,7 @@ class CelestialFactory(factory.django.DjangoModelFactory):
     class Meta:
         model = models.Celestial
 
-class PersonFactory(factory.DjangoModelFactory):
+class PersonFactory(factory.django.DjangoModelFactory):
     origin = factory.SubFactory(CelestialFactory)
     first_name = factory.Faker('first_name')
     last_name = factory.Faker('last_name')
@@ -23,14 +23,14 @@ class PersonFactory(factory.DjangoModelFactory):
     class Meta:
         model = models.Person
 
-class SpaceportFactory(factory.DjangoModelFactory):
+class SpaceportFactory(factory.django.DjangoModelFactory):
     name = factory.LazyAttribute(lambda sp: f'Port {sp.celestial.name}')
     celestial = factory.SubFactory(CelestialFactory, celestial_type=factory.Iterator([2,2,3,4,5]))
     
     class Meta:
         model = models.Spaceport
 
-class VisitorFactory(factory.DjangoModelFactory):
+class VisitorFactory(factory.django.DjangoModelFactory):
     person = factory.SubFactory(PersonFactory)
     spaceport = factory.SubFactory(SpaceportFactory)
     luggage_weight = factory.fuzzy.FuzzyFloat(1.0, 100.0)
@@ -38,7 +38,7 @@ class VisitorFactory(factory.DjangoModelFactory):
     class Meta:
         model = models.Visitor
 
-class CitizenFactory(factory.DjangoModelFactory):
+class CitizenFactory(factory.django.DjangoModelFactory):
     planet = factory.SubFactory(CelestialFactory, celestial_type=2)
     person = factory.SubFactory(PersonFactory, origin=factory.SelfAttribute('planet'))
     clearance_level = factory.fuzzy.FuzzyInteger(0, 4)
@@ -1,17 +1,30 @@
-from dataclasses import dataclass
+import csv
+import io
+import json
+from dataclasses import dataclass, replace
 from unittest.case import skipIf
 from unittest import mock
 
-from django.db.models import F
-from django.test.testcases import TestCase
+from asgiref.sync import async_to_sync
+from django.db.models import Count, F
+from django.test.testcases import TestCase, TransactionTestCase
 from django.test.utils import tag
 
-from django_records.adjuncts import MappedValue, FixedValue, PostProcess
-from django_records.handlers import RecordDictHandler
+from django_records.adjuncts import MappedValue, FixedValue, PostProcess, Ref, Skip
+from django_records.cache import RecordCache
+from django_records.gather import agather_records, gather_records, merge_records
+from django_records.errors import RecordClassDefinitionError, RecordInstanceError, RecordTreeLimitError
+from django_records.handlers import RecordDict
+from django_records.instrumentation import records_evaluated
+from django_records.nested import Nested
+from django_records.records import RecordIterable
+from django_records.related import RelatedRecords
+from django_records.specs import RecordSpec
+from django_records.writers import streaming_response, write_csv, write_json, write_ndjson
 
 
 try:
-    from .models import Celestial
+    from .models import Celestial, Spaceport
     from .galaxy import Stars
     celestials_installed = True
 except RuntimeError:
@@ -31,6 +44,49 @@ class SpaceRock:
     is_moon: bool
 
 
+@dataclass
+class SizedRock:
+    id: int
+    name: str
+    size: float
+
+
+@dataclass
+class Shouting:
+    id: int
+    name: str
+
+    def __post_init__(self):
+        self.name = self.name.upper()
+
+
+@dataclass(frozen=True)
+class Port:
+    id: int
+    name: str
+
+
+@dataclass(frozen=True)
+class Body:
+    id: int
+    name: str
+    orbitals: tuple = ()
+    spaceports: tuple = ()
+
+
+@dataclass(frozen=True)
+class Orbiter:
+    id: int
+    name: str
+    orbits: 'Orbiter | None' = None
+
+
+@dataclass(frozen=True)
+class Dock:
+    name: str
+    celestial: Orbiter
+
+
 @tag('library')
 @skipIf(not celestials_installed, "Celestials Testpackage not installed into INSTALLED_APPS.")
 class TestQueryBuilder(TestCase):
@@ -54,7 +110,7 @@ class TestQueryBuilder(TestCase):
             orbits__in=Celestial.objects.filter(orbits__name='Sol', celestial_type__lte=4)).values_list('id', flat=True)))
 
     def test_handler_dict(self):
-        entities = Celestial.objects.filter(orbits__name='Sol', celestial_type__lte=4).records(RecordDictHandler())
+        entities = Celestial.objects.filter(orbits__name='Sol', celestial_type__lte=4).records(RecordDict())
         self.assertEqual(len(entities), len(self.planets))
         self.assertIsInstance(entities.first(), dict)
 
@@ -91,3 +147,321 @@ class TestQueryBuilder(TestCase):
         self.assertEqual(len(entities), len(self.celestials))
         self.assertEqual(post_process_one.call_count, len(self.celestials))
         self.assertEqual(post_process_two.call_count, len(self.celestials))
+
+    def test_related_records(self):
+        with self.assertNumQueries(4):
+            suns = list(Celestial.objects.filter(celestial_type=1).record_into(Body).records(
+                orbitals=RelatedRecords('orbitals', into=Body, container=tuple,
+                                        orbitals=RelatedRecords('orbitals', into=Body, container=tuple,
+                                                                orbitals=Skip(), spaceports=Skip()),
+                                        spaceports=RelatedRecords('spaceports', into=Port, container=tuple)),
+                spaceports=Skip()))
+
+        self.assertEqual(len(suns), 1)
+        planets = {planet.name: planet for planet in suns[0].orbitals}
+        self.assertEqual(len(planets), len(self.planets))
+        self.assertEqual([moon.name for moon in planets['Terra'].orbitals], ['Luna'])
+        self.assertEqual([port.name for port in planets['Terra'].spaceports], ['Houston IPS'])
+        self.assertEqual(planets['Venus'].orbitals, ())
+        self.assertEqual(len(planets['Jupiter'].orbitals), 4)
+
+        # the key column of the relation is not part of dictionary records.
+        sun = Celestial.objects.filter(celestial_type=1).record_into(RecordDict()).records(
+            'name', spaceports=RelatedRecords('spaceports', into=Port)).get()
+        self.assertEqual(sun, {'name': 'Sol', 'spaceports': []})
+
+    def test_nested_records(self):
+        with self.assertNumQueries(1):
+            moons = {moon.name: moon for moon in Celestial.objects.filter(pk__in=[m.pk for m in self.moons])
+                     .nested(2).record_into(Orbiter).records()}
+        self.assertEqual(moons['Luna'].orbits.name, 'Terra')
+        self.assertEqual(moons['Luna'].orbits.orbits, Orbiter(self.sun.pk, 'Sol'))
+
+        # NULL relations resolve to None, depth 1 leaves the relations of nested records out.
+        orbiters = {o.name: o for o in Celestial.objects.record_into(Orbiter).records()}
+        self.assertIsNone(orbiters['Sol'].orbits)
+        self.assertEqual(orbiters['Luna'].orbits, Orbiter(self.planets[2].pk, 'Terra'))
+
+        # nesting can be disabled, and given explicitly with a relation other than the key.
+        self.assertEqual(Celestial.objects.filter(name='Luna').nested(0).record_into(Orbiter).records().get().orbits,
+                         self.planets[2].pk)
+        with self.assertNumQueries(1):
+            docks = list(Spaceport.objects.order_by('name').record_into(Dock).records(celestial=Nested(relation='celestial')))
+        self.assertEqual(docks[0].celestial.name, Spaceport.objects.order_by('name').first().celestial.name)
+
+    def test_records_tree(self):
+        for recursive, queries in ((True, 1), (False, 4)):
+            with self.assertNumQueries(queries):
+                suns = Celestial.objects.order_by('name').record_into(Body).records_tree(
+                    'orbits', spaceports=Skip(), recursive=recursive)
+            self.assertEqual([sun.name for sun in suns], ['Sol'])
+            planets = {planet.name: planet for planet in suns[0].orbitals}
+            self.assertEqual(len(planets), len(self.planets))
+            self.assertEqual([moon.name for moon in planets['Jupiter'].orbitals], ['Callisto', 'Europa', 'Ganymede', 'Io'])
+            self.assertEqual(planets['Venus'].orbitals, ())
+
+            # subtrees of a root, limited in depth, and cut off below excluded nodes.
+            terra = Celestial.objects.record_into(Body).records_tree(
+                'orbits', root=self.planets[2], spaceports=Skip(), recursive=recursive)
+            self.assertEqual([moon.name for moon in terra[0].orbitals], ['Luna'])
+            sun = Celestial.objects.record_into(Body).records_tree(
+                'orbits', root=self.sun.pk, max_depth=1, spaceports=Skip(), recursive=recursive)[0]
+            self.assertTrue(all(planet.orbitals == () for planet in sun.orbitals))
+            sun = Celestial.objects.exclude(name='Jupiter').record_into(Body).records_tree(
+                'orbits', spaceports=Skip(), recursive=recursive)[0]
+            self.assertEqual(len(sun.orbitals), len(self.planets) - 1)
+
+            with self.assertRaises(RecordTreeLimitError):
+                Celestial.objects.record_into(Body).records_tree('orbits', max_rows=5, spaceports=Skip(), recursive=recursive)
+
+    def test_bulk_write(self):
+        rocks = list(Celestial.objects.filter(celestial_type=2).order_by('id').record_into(SizedRock).records())
+        changed = [replace(rock, name=rock.name.upper(), size=rock.size * 2) for rock in rocks]
+        result = Celestial.objects.bulk_write([*changed, SizedRock(None, 'Nibiru', 9.9)], fields=['size'], batch_size=5)
+        self.assertEqual((result.created, result.updated, result.batches), (1, len(rocks), 2))
+        stored = dict(Celestial.objects.filter(pk__in=[rock.id for rock in rocks]).values_list('name', 'size'))
+        self.assertEqual(stored, {rock.name: rock.size * 2 for rock in rocks})
+        self.assertEqual(Celestial.objects.get(name='Nibiru').size, 9.9)
+
+        # nested records are written as their key, and mapped fields to the fields they were read from.
+        luna = Celestial.objects.filter(name='Luna').record_into(Orbiter).records().get()
+        mars = Celestial.objects.filter(name='Mars').record_into(Orbiter).records().get()
+        Celestial.objects.bulk_write([replace(luna, orbits=mars)], fields=['orbits'])
+        Celestial.objects.bulk_write([{'id': luna.id, 'label': 'Selene'}], mapping={'label': Ref('name')})
+        self.assertEqual(Celestial.objects.filter(orbits__name='Mars', name='Selene').count(), 1)
+
+        result = Celestial.objects.bulk_write([replace(rocks[0], size=1.0)], fields=['size'], upsert=True)
+        self.assertEqual(result.upserted, 1)
+        self.assertEqual(Celestial.objects.get(pk=rocks[0].id).size, 1.0)
+
+    def test_records_in_batches(self):
+        total = Celestial.objects.count()
+        with self.assertNumQueries(total // 5 + 1):
+            batches = list(Celestial.objects.record_into(SizedRock).records_in_batches(batch_size=5))
+        self.assertEqual([len(batch) for batch in batches[:-1]], [5] * (len(batches) - 1))
+        ids = [rock.id for batch in batches for rock in batch]
+        self.assertEqual(ids, sorted(Celestial.objects.values_list('pk', flat=True)))
+        self.assertEqual(batches[0].checkpoint, (ids[4],))
+
+        # composite keys in mixed order, resumed from a checkpoint.
+        ordered = [rock.id for rock in Celestial.objects.order_by('celestial_type', '-size', 'pk').record_into(SizedRock).records()]
+        key = ('celestial_type', '-size')
+        first = next(Celestial.objects.record_into(SizedRock).records_in_batches(batch_size=7, key=key))
+        rest = Celestial.objects.record_into(SizedRock).records_in_batches(batch_size=7, key=key, after=first.checkpoint)
+        self.assertEqual([rock.id for rock in first] + [rock.id for batch in rest for rock in batch], ordered)
+
+        # arguments of records() are passed without batch_size and key.
+        batches = Celestial.objects.record_into(SizedRock).records_in_batches('name', size=Ref('size', round))
+        self.assertEqual({rock.size for batch in batches for rock in batch}, {round(c.size) for c in self.celestials})
+
+    def test_record_spec(self):
+        spec = RecordSpec(SpaceRock, model=Celestial, orbits_name=Ref('orbits__name'), is_moon=FixedValue(False))
+        rocks = list(Celestial.objects.filter(orbits__name='Sol').order_by('id').records(spec))
+        self.assertEqual([rock.name for rock in rocks], [planet.name for planet in self.planets])
+        self.assertEqual({rock.orbits_name for rock in rocks}, {'Sol'})
+        self.assertEqual(Celestial.objects.filter(orbits__name='Sol').order_by('id').record_into(spec).records()[0], rocks[0])
+
+        # the arguments of the spec apply to batches of spec querysets as well.
+        batches = list(Celestial.objects.filter(orbits__name='Sol').record_into(spec).records_in_batches(batch_size=5))
+        self.assertEqual([rock for batch in batches for rock in batch], rocks)
+
+        with self.assertRaises(RecordClassDefinitionError):
+            RecordSpec(SpaceRock, model=Celestial, orbits_name=Ref('orbits__unknown'), is_moon=FixedValue(False))
+
+    def test_column_pruning(self):
+        # weight is passed, but neither the record nor an adjunct reads it, celestial_type is read by is_moon.
+        is_moon = MappedValue(lambda entry: entry['celestial_type'] > 4, requires=['celestial_type'])
+        rocks = Celestial.objects.records(SpaceRock, 'celestial_type', 'weight',
+                                          orbits_name=Ref('orbits__name'), is_moon=is_moon)
+        self.assertEqual(set(rocks.query.values_select), {'id', 'name', 'celestial_type', 'orbits__name'})
+        self.assertEqual(sum(rock.is_moon for rock in rocks), Celestial.objects.filter(celestial_type__gt=4).count())
+        # the queryset can still filter and order on the columns it does not fetch.
+        heavy = Celestial.objects.filter(weight__gt=0).order_by('-weight', 'id')
+        self.assertTrue(heavy.exists())
+        self.assertEqual([rock.id for rock in rocks.filter(weight__gt=0).order_by('-weight', 'id')],
+                         list(heavy.values_list('id', flat=True)))
+
+        # annotations are always fetched, so the queryset can filter and order on the ones the record does not have.
+        rocks = Celestial.objects.records(SizedRock, ports=Count('spaceports'))
+        names = sorted(port.celestial.name for port in self.spaceports)
+        self.assertEqual(sorted(rock.name for rock in rocks.filter(ports__gt=0)), names)
+        self.assertEqual([rock.name for rock in rocks.order_by('-ports', 'name')[:len(names)]], names)
+        self.assertEqual(rocks.filter(ports__gt=0).order_by('name').distinct().count(), len(self.spaceports))
+
+        # without requires, the callback may read any column.
+        rocks = Celestial.objects.records(SpaceRock, 'weight', orbits_name=Ref('orbits__name'),
+                                          is_moon=MappedValue(lambda entry: False))
+        self.assertIn('weight', rocks.query.values_select)
+        # distinct rows depend on every column.
+        self.assertIn('weight', Celestial.objects.distinct().records(Entity, 'weight').query.values_select)
+
+    def test_parallel(self):
+        rocks = Celestial.objects.order_by('id').records(SizedRock, size=Ref('size', round))
+        self.assertEqual(list(rocks.parallel(workers=2, chunk_size=3)), list(rocks))
+
+        rocks = Celestial.objects.order_by('id').records(SizedRock, size=Ref('name', lambda name: 1 / 0))
+        with self.assertRaisesRegex(RecordInstanceError, 'row 0'):
+            list(rocks.parallel(workers=2, chunk_size=3))
+
+    def test_raw_records(self):
+        table = Celestial._meta.db_table
+        sql = (f"SELECT id, name, size, RANK() OVER (ORDER BY size DESC) AS position "
+               f"FROM {table} WHERE orbits_id = %s ORDER BY position")
+        rocks = list(Celestial.objects.raw_records(sql, [self.sun.pk], into=SizedRock, chunk_size=4,
+                                                   name=Ref('name', str.upper)))
+        self.assertEqual([rock.name for rock in rocks[:2]], ['JUPITER', 'SATURN'])
+        self.assertEqual(len(rocks), len(self.planets))
+
+        # columns of model fields are converted like in RawQuerySet, other columns are taken as they are.
+        size = Celestial._meta.get_field('size')
+        with mock.patch.object(size, 'from_db_value', create=True, new=lambda value, expression, connection: -value):
+            rocks = list(Celestial.objects.raw_records(f"SELECT id, name, size FROM {table} WHERE id = %s", [self.sun.pk],
+                                                       into=SizedRock))
+            self.assertEqual(rocks[0].size, -self.sun.size)
+            rocks = list(Celestial.objects.raw_records(f"SELECT id, name, size * 1 AS size_1 FROM {table} WHERE id = %s",
+                                                       [self.sun.pk], into=SizedRock, size=Ref('size_1')))
+            self.assertEqual(rocks[0].size, self.sun.size)
+
+        # the record class defaults to the one of records().
+        ports = Celestial.objects.record_into(Port).raw_records(f"SELECT id, name FROM {table} WHERE id = %s", [self.sun.pk])
+        self.assertEqual(list(ports), [Port(id=self.sun.pk, name='Sol')])
+
+    async def test_async_records(self):
+        names = [entity.name async for entity in Celestial.objects.filter(orbits__name='Sol').records(Port)]
+        self.assertEqual(len(names), len(self.planets))
+
+        entities = await Celestial.objects.filter(orbits__name='Sol').records(Port).alist()
+        self.assertEqual([entity.name for entity in entities], names)
+        self.assertEqual(len(await Celestial.objects.alist()), len(self.celestials))
+
+    def test_records_columns(self):
+        columns = Celestial.objects.filter(orbits__name='Sol').order_by('id').records(SizedRock).as_columns('array')
+        self.assertEqual(list(columns), ['id', 'name', 'size'])
+        self.assertEqual(columns['id'].typecode, 'q')
+        self.assertEqual(columns['size'].typecode, 'd')
+        self.assertEqual(columns['name'], [planet.name for planet in self.planets])
+
+        # without records(), the record class set on the queryset is used.
+        planets = Celestial.objects.filter(orbits__name='Sol').order_by('id').record_into(SizedRock)
+        self.assertEqual(planets.as_columns('array'), columns)
+        with self.assertRaises(RecordClassDefinitionError):
+            Celestial.objects.all().as_columns('array')
+
+    def test_writers(self):
+        queryset = Celestial.objects.filter(orbits__name='Sol').order_by('id').records(SizedRock)
+        expected = [{'id': p.id, 'name': p.name, 'size': p.size} for p in self.planets]
+
+        fp = io.StringIO()
+        write_ndjson(queryset, fp, chunk_size=4)
+        self.assertEqual([json.loads(line) for line in fp.getvalue().splitlines()], expected)
+
+        fp = io.BytesIO()
+        write_json(queryset, fp, chunk_size=4, shape_only=True)
+        self.assertEqual(json.loads(fp.getvalue()), expected)
+
+        fp = io.StringIO()
+        write_csv(queryset, fp)
+        rows = list(csv.DictReader(io.StringIO(fp.getvalue())))
+        self.assertEqual([row['name'] for row in rows], [p.name for p in self.planets])
+
+        response = streaming_response(queryset, 'json')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        self.assertEqual(json.loads(b''.join(response.streaming_content)), expected)
+
+    def test_cached_records(self):
+        cache = RecordCache()
+        queryset = Celestial.objects.filter(orbits__name='Sol').order_by('id')
+        with self.assertNumQueries(1):
+            first = list(queryset.records(SizedRock).cached(cache=cache))
+        with self.assertNumQueries(0):
+            second = list(queryset.records(SizedRock).cached(cache=cache))
+        self.assertEqual(first, second)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+        # mutable records are copies, changing them does not change what the next caller gets.
+        name = first[0].name
+        first[0].name = second[0].name = 'Changed'
+        self.assertEqual(list(queryset.records(SizedRock).cached(cache=cache))[0].name, name)
+        for _ in range(2):
+            dicts = list(queryset.records(RecordDict(), 'name').cached(cache=cache))
+            self.assertEqual(dicts[0]['name'], name)
+            dicts[0]['name'] = 'Changed'
+        # immutable ones are shared.
+        ports = list(queryset.records(Port).cached(cache=cache))
+        self.assertIs(list(queryset.records(Port).cached(cache=cache))[0], ports[0])
+        hits = cache.stats()['hits']
+
+        # related records with the same arguments are the same entry.
+        related = lambda: queryset.records(Body, orbitals=RelatedRecords('orbitals', into=Body, container=tuple,
+                                                                          orbitals=Skip(), spaceports=Skip()),
+                                           spaceports=RelatedRecords('spaceports', into=Port)).cached(cache=cache)
+        with self.assertNumQueries(3):
+            self.assertEqual(list(related()), list(related()))
+        self.assertEqual(cache.stats()['hits'], hits + 1)
+
+        # trusted records skip __post_init__, they are another entry.
+        shouting = lambda trusted: queryset.cached(cache=cache).record_into(Shouting, trusted=trusted).records()
+        self.assertEqual(list(shouting(True))[0].name, name)
+        self.assertEqual(list(shouting(False))[0].name, name.upper())
+
+        # another handler or adjunct is another entry.
+        with self.assertNumQueries(1):
+            list(queryset.records(SizedRock, size=FixedValue(0)).cached(cache=cache))
+
+        # saving a model of the query invalidates its entries.
+        planet = self.planets[0]
+        planet.name = 'Renamed'
+        planet.save()
+        self.assertEqual(len(cache), 0)
+        with self.assertNumQueries(1):
+            records = list(queryset.records(SizedRock).cached(cache=cache))
+        self.assertEqual(records[0].name, 'Renamed')
+
+        # rows fetched while the query is invalidated are not stored.
+        rows = RecordIterable.rows
+
+        def save_and_fetch(iterable):
+            planet.save()
+            return rows(iterable)
+        cache.clear()
+        with mock.patch.object(RecordIterable, 'rows', save_and_fetch):
+            list(queryset.records(SizedRock).cached(cache=cache))
+        self.assertEqual(len(cache), 0)
+
+    def test_instrumentation(self):
+        received = []
+        receiver = lambda sender, stats, **kwargs: received.append(stats)
+        records_evaluated.connect(receiver, sender=Celestial)
+        try:
+            queryset = Celestial.objects.filter(orbits__name='Sol').order_by('id')
+            records = list(queryset.records(SizedRock, name=Ref('name', str.upper)))
+            self.assertEqual(records[0].name, self.planets[0].name.upper())
+            async_to_sync(queryset.records(SizedRock).alist)()
+            # other models are not instrumented.
+            list(Spaceport.objects.records(Port))
+        finally:
+            records_evaluated.disconnect(receiver, sender=Celestial)
+        self.assertEqual([stats.rows for stats in received], [len(self.planets)] * 2)
+        self.assertEqual(list(received[0].resolve_times), ['name'])
+        self.assertEqual(received[0].model, Celestial)
+
+
+@tag('library')
+@skipIf(not celestials_installed, "Celestials Testpackage not installed into INSTALLED_APPS.")
+class TestGather(TransactionTestCase):
+    # the querysets run in threads with connections of their own, which only see committed rows.
+
+    def setUp(self):
+        super().setUp()
+        Stars.create_sol(context=self)
+
+    def test_gather_records(self):
+        planets = Celestial.objects.filter(orbits=self.sun).order_by('id').records(Port)
+        moons = Celestial.objects.filter(celestial_type=4).order_by('id').records(Entity)
+        self.assertEqual(gather_records(planets, moons), [list(planets), list(moons)])
+        self.assertEqual(async_to_sync(agather_records)(moons, planets), [list(moons), list(planets)])
+
+    def test_merge_records(self):
+        shards = [Celestial.objects.filter(celestial_type=kind).order_by('name').records(Port) for kind in (1, 2, 3, 4)]
+        names = [port.name for port in merge_records(*shards, key='name', chunk_size=3)]
+        self.assertEqual(names, sorted(celestial.name for celestial in self.celestials))
@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""
+Benchmarks records() against values(), values_list(), model instances and raw cursors.
+
+Runs against a local SQLite database filled with Celestial rows from the app factories, e.g.
+
+    python bench.py --rows 1000 100000 --output results.json
+    python bench.py --rows 100000 --compare results.json
+
+For every case and dataset size, the fastest of --repeat runs is reported as throughput and time per row,
+the overhead per row over a raw cursor.fetchall(), and the peak memory of one more run traced with tracemalloc.
+Results are written as JSON, so they can be compared across commits with --compare.
+"""
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+from dataclasses import dataclass
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BASE_DIR))
+sys.path.insert(0, str(BASE_DIR.parent.parent / 'src'))
+
+import django
+from django.conf import settings
+
+
+@dataclass
+class CelestialRecord:
+    id: int
+    name: str
+    celestial_type: int
+    weight: float
+    size: float
+
+
+@dataclass(frozen=True)
+class FrozenCelestial:
+    id: int
+    name: str
+    celestial_type: int
+    weight: float
+    size: float
+
+
+@dataclass
+class CelestialNote:
+    id: int
+    name: str
+    celestial_type: int
+    weight: float
+    size: float
+    note: str | None = None
+
+
+CelestialTuple = namedtuple('CelestialTuple', ['id', 'name', 'celestial_type', 'weight', 'size'])
+
+try:
+    from pydantic import BaseModel
+
+    class CelestialModel(BaseModel):
+        id: int
+        name: str
+        celestial_type: int
+        weight: float
+        size: float
+except ImportError:
+    CelestialModel = None
+
+
+def setup(database):
+    settings.configure(
+        INSTALLED_APPS=['app'],
+        DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': database}},
+        DEFAULT_AUTO_FIELD='django.db.models.BigAutoField',
+        USE_TZ=True,
+    )
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+
+def populate(rows, templates=1000):
+    """fills the Celestial table with rows rows, bulk inserting copies of factory built templates."""
+    from app.factories import CelestialFactory
+    from app.models import Celestial
+
+    Celestial.objects.all().delete()
+    sun = CelestialFactory(name='Sol', celestial_type=1)
+    built = CelestialFactory.build_batch(min(rows, templates), orbits=sun)
+    batch = []
+    for index in range(rows - 1):
+        template = built[index % len(built)]
+        batch.append(Celestial(orbits=sun, name=template.name, celestial_type=template.celestial_type,
+                               weight=template.weight, size=template.size))
+        if len(batch) == 10000:
+            Celestial.objects.bulk_create(batch)
+            batch = []
+    Celestial.objects.bulk_create(batch)
+
+
+def cases():
+    """name -> callable evaluating all rows. records() cases are named records:<target>[:<adjunct>]."""
+    from django.db import connection
+    from django_records.adjuncts import (BatchMappedValue, FixedValue, MappedOptionalValue, MappedValue,
+                                         PostProcess, Ref, Skip)
+    from django_records.handlers import RecordDict, RecordPydantic
+    from app.models import Celestial
+
+    fields = ['id', 'name', 'celestial_type', 'weight', 'size']
+    queryset = lambda: Celestial.objects.order_by('id')
+    sql = f"SELECT {', '.join(fields)} FROM {Celestial._meta.db_table} ORDER BY id"
+
+    def cursor():
+        with connection.cursor() as c:
+            c.execute(sql)
+            return c.fetchall()
+
+    def records(into, **adjuncts):
+        return list(queryset().record_into(into).records(**adjuncts))
+
+    def note(dbdata):
+        dbdata['note'] = dbdata['name'][:3]
+
+    result = {
+        'cursor.fetchall': cursor,
+        'values': lambda: list(queryset().values(*fields)),
+        'values_list': lambda: list(queryset().values_list(*fields)),
+        'values_list:named': lambda: list(queryset().values_list(*fields, named=True)),
+        'models': lambda: list(queryset()),
+        'models:only': lambda: list(queryset().only(*fields)),
+        'records:dataclass': lambda: records(CelestialRecord),
+        'records:dataclass:frozen': lambda: records(FrozenCelestial),
+        'records:dataclass:frozen:trusted': lambda: list(queryset().record_into(FrozenCelestial, trusted=True).records()),
+        'records:dict': lambda: list(queryset().record_into(RecordDict()).records(*fields)),
+        'records:namedtuple': lambda: records(CelestialTuple),
+        'records:dataclass:FixedValue': lambda: records(CelestialNote, note=FixedValue('x')),
+        'records:dataclass:MappedValue': lambda: records(CelestialNote, note=MappedValue(lambda dbdata: dbdata['name'][:3])),
+        'records:dataclass:Ref': lambda: records(CelestialNote, note=Ref('name')),
+        'records:dataclass:Ref+MappedOptionalValue': lambda: records(
+            CelestialNote, note=Ref('name', MappedOptionalValue(lambda name: name[:3]))),
+        'records:dataclass:Ref+cache': lambda: records(CelestialNote, note=Ref('celestial_type', str, cache=True)),
+        'records:dataclass:BatchMappedValue': lambda: records(
+            CelestialNote, note=BatchMappedValue(lambda rows: [dbdata['name'][:3] for dbdata in rows])),
+        'records:dataclass:Skip': lambda: records(CelestialNote, note=Skip()),
+        'records:dataclass:PostProcess': lambda: records(CelestialNote, note=Skip(), post=PostProcess(note)),
+    }
+    if CelestialModel is not None:
+        result['records:pydantic'] = lambda: records(CelestialModel)
+        result['records:pydantic:trusted'] = lambda: records(RecordPydantic(CelestialModel, trusted=True))
+    return result
+
+
+def measure(function, repeat):
+    """(fastest seconds of repeat runs, number of results, peak traced bytes)."""
+    timings = []
+    count = 0
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        count = len(function())
+        timings.append(time.perf_counter() - start)
+    gc.collect()
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(timings), count, peak
+
+
+def run(sizes, repeat, only=None):
+    results = []
+    for rows in sizes:
+        populate(rows)
+        measured = []
+        for name, case in cases().items():
+            if name == 'cursor.fetchall' or not only or any(o in name for o in only):
+                measured.append((name, *measure(case, repeat)))
+        # the raw cursor is always measured, as baseline for the overhead.
+        baseline = next(seconds for name, seconds, count, peak in measured if name == 'cursor.fetchall')
+        for name, seconds, count, peak in measured:
+            result = {
+                'name': name,
+                'rows': count,
+                'seconds': seconds,
+                'rows_per_second': count / seconds if seconds else None,
+                'us_per_row': seconds / count * 1e6 if count else None,
+                'overhead_us_per_row': (seconds - baseline) / count * 1e6 if count else None,
+                'peak_bytes': peak,
+            }
+            results.append(result)
+            print(f"{count:>9} {name:<45} {result['rows_per_second'] or 0:>14,.0f} rows/s "
+                  f"{result['us_per_row'] or 0:>8.2f} us/row {peak / 1024 / 1024:>9.1f} MiB", file=sys.stderr)
+    return results
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=BASE_DIR).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit or None,
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+    }
+
+
+def compare(results, previous):
+    """prints the change of time per row against a previous result file."""
+    before = {(r['name'], r['rows']): r for r in previous['results']}
+    print(f"compared to {previous['environment'].get('commit')}:", file=sys.stderr)
+    for result in results:
+        old = before.get((result['name'], result['rows']))
+        if old and old['us_per_row'] and result['us_per_row']:
+            change = (result['us_per_row'] / old['us_per_row'] - 1) * 100
+            print(f"{result['rows']:>9} {result['name']:<45} {change:>+8.1f}%", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, nargs='+', default=[1000, 10000], help="dataset sizes, 1000 to 1000000")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per case, the fastest is reported")
+    parser.add_argument('--only', nargs='*', help="only run cases containing one of these strings")
+    parser.add_argument('--database', default=':memory:', help="sqlite database file, in memory by default")
+    parser.add_argument('--output', help="write the JSON results to this file instead of stdout")
+    parser.add_argument('--compare', help="JSON results of a previous run to compare with")
+    args = parser.parse_args(argv)
+
+    setup(args.database)
+    report = {'environment': environment(), 'results': run(args.rows, args.repeat, args.only)}
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(report['results'], json.load(fp))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(report, fp, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    os.environ.pop('DJANGO_SETTINGS_MODULE', None)
+    main()
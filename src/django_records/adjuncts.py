@@ -1,5 +1,8 @@
 from abc import ABC
-from typing import Any, Callable
+from copy import copy
+from typing import Any, Callable, Iterable
+
+from asgiref.sync import async_to_sync
 
 class Adjunct(ABC):
     """
@@ -16,6 +19,9 @@ class Adjunct(ABC):
     skip = False  # if skip is true, this adjunct will not be actually processed.
     resolves_field = True  # if resolves_field is true, this adjunct will be called for a single field with resolve()
     post_processing = False  # if post_processing is true, this adjunct will in the end be called with dbdata, and be able to manipulate the whole dictionary.
+    batch = False  # if batch is true, this adjunct is resolved once per chunk of rows with resolve_batch()
+    asynchronous = False  # if asynchronous is true, this adjunct is awaited once per chunk of rows with resolve_async()
+    positional = False  # if positional is true, this adjunct never needs the dictionary of a row, and describes its value with row_source()
 
     def resolve(self, model, dbdata) -> Any | None:
         """
@@ -23,46 +29,165 @@ class Adjunct(ABC):
         """
         raise NotImplementedError
 
+    def resolve_batch(self, model, rows: list) -> list:
+        """
+        resolve_batch returns the field values for a chunk of entries, in the same order.
+        called instead of resolve() if batch is True.
+        """
+        return [self.resolve(model, dbdata) for dbdata in rows]
+
+    async def resolve_async(self, model, rows: list) -> list:
+        """
+        awaitable version of resolve_batch, called instead of it if asynchronous is True.
+        in synchronous iteration, it is run with async_to_sync.
+        """
+        return self.resolve_batch(model, rows)
+
     def post_process(self, model, dbdata) -> dict | None:
         """if you have post_processing on True, this needs to be implemented.
         has to return either a new dictionary to use in initialization of an object, or None.
         """
         raise NotImplementedError
 
-    def values_field(self) -> str | tuple[str, str] | None:
+    def row_source(self) -> tuple[str | None, Any]:
+        """
+        if you have positional on True, this needs to be implemented.
+        returns (key, None) if the value is the row value of key as-is, or (None, value) for a constant value.
+        """
+        raise NotImplementedError
+
+    def values_field(self) -> str | tuple[str, str] | list[str] | None:
         """
         return a field for the values operator.
 
         if you return None, it will not be added. (default)
         if you return a string, it will be added to values as args.
         if you return a tuple, it will be added to values as kwargs (key, value).
+        if you return a list of strings, each will be added to values as args.
         """
         return
 
+    def dependencies(self) -> set[str] | None:
+        """
+        the keys of the row dictionary this adjunct reads, which records() has to fetch for it.
+        None, the default, if it may read any key, which keeps records() from pruning unused columns.
+        """
+        return None
+
+    def attach(self, model, key, handler) -> 'Adjunct':
+        """
+        returns the adjunct records() uses for key, called once when records() is called on a queryset of model,
+        before values_field(). handler is the RecordHandler of the records. by default the adjunct itself is used.
+        """
+        return self
+
+    def bind(self, model) -> 'Adjunct':
+        """
+        returns the adjunct to use for one evaluation of a queryset of model, called when its row plan is compiled.
+        adjuncts with state per evaluation return a copy of themselves with fresh state, by default the adjunct itself is used.
+        """
+        return self
+
+    def cache_key(self):
+        """
+        identity of this adjunct in the key of cached records, see cache.RecordCache.
+        by default the adjunct object itself, which is only equal to itself.
+        """
+        return self
+
+    def cache_models(self, model) -> list:
+        """models, besides the ones of the query, whose changes invalidate cached records with this adjunct."""
+        return []
+
 
 class FixedValue(Adjunct):
     """always resolves to a fixed value."""
 
+    positional = True
+
     def __init__(self, value=None):
         self.value = value
 
     def resolve(self, model, dbdata):
         return self.value
 
+    def row_source(self):
+        return None, self.value
+
+    def dependencies(self):
+        return set()
+
+    def cache_key(self):
+        return FixedValue, self.value
+
 
 class MappedValue(Adjunct):
     """adjunct value that returns a field value with a callback.
         currently supports only 1 parameter (dbdata).
+
+        cache memoizes the callback per input in a bounded LRU of cache_size inputs, see identity.Identical:
+        True or 'evaluation' for one cache per evaluation of the queryset, 'process' for one cache of this adjunct
+        for all evaluations, or an identity.IdentityMap shared with other adjuncts.
+        cache_by is a callable returning the input to memoize on, e.g. itemgetter('celestial_type') for rows.
+        unhashable inputs are not cached, so records() refuses a cache without cache_by for the row.
+        cache_stats() reports the hits of the latest evaluation.
+
+        requires are the keys of dbdata the callback reads, which lets records() prune the columns nobody reads.
     """
+    CACHE_SCOPES = (True, 'evaluation', 'process')
 
-    def __init__(self, callback):
+    def __init__(self, callback, cache=None, cache_size: int | None = 10000, cache_by: Callable | None = None,
+                 requires: Iterable[str] | None = None):
         self.callback = callback if callable(callback) else None
+        self.requires = None if requires is None else set(requires)
+        if cache not in (None, False, *self.CACHE_SCOPES) and not hasattr(cache, 'lookup'):
+            raise ValueError(f"cache has to be one of {self.CACHE_SCOPES} or an IdentityMap, not {cache!r}.")
+        self.cache = cache
+        self.cache_size = cache_size
+        self.cache_by = cache_by
+        self.last_map = cache if hasattr(cache, 'lookup') else None
+        self.identity_map = self.last_map
+        if cache == 'process':
+            # created once here, as concurrent evaluations bind this adjunct at the same time.
+            from .identity import IdentityMap
+            self.identity_map = IdentityMap(cache_size)
 
     def resolve(self, model, dbdata):
         # at this point i could check if callback needs 0-2 arguments and decide the call.
         if self.callback:
             return self.callback(dbdata)
 
+    def bind(self, model):
+        # an empty IdentityMap is falsy, so the scope is compared explicitly.
+        if getattr(self, 'cache', None) in (None, False):
+            return self
+        from .identity import EvaluationMap, Identical
+        identity_map = self.identity_map if self.identity_map is not None else EvaluationMap(self.cache_size)
+        self.last_map = identity_map
+        uncached = copy(self)
+        uncached.cache = None
+        # a map given as cache may be shared with other adjuncts, whose callbacks return other values for the same input.
+        return Identical(uncached, key=self.cache_by, identity_map=identity_map, scoped=hasattr(self.cache, 'lookup'))
+
+    def attach(self, model, key, handler):
+        # attached adjuncts get the row, which is unhashable, unlike the values a Ref passes to its adjunct.
+        if getattr(self, 'cache', None) not in (None, False) and getattr(self, 'cache_by', None) is None:
+            raise ValueError(f"the cache of the MappedValue of {key} never hits, as rows are unhashable. "
+                             f"pass cache_by, e.g. cache_by=itemgetter('field'), or use Ref('field', callback, cache=...).")
+        return self
+
+    def dependencies(self):
+        requires = getattr(self, 'requires', None)
+        return None if requires is None else set(requires)
+
+    def cache_stats(self) -> dict | None:
+        """hits, misses and hit rate of the memoized callback in the latest evaluation, or None if there was none."""
+        last_map = getattr(self, 'last_map', None)
+        return last_map.stats() if last_map is not None else None
+
+    def cache_key(self):
+        return type(self), self.callback
+
 class MappedOptionalValue(MappedValue):
     """MappedValue that only calls the callback if the dbdata is not None
     (convenience function)
@@ -72,6 +197,63 @@ class MappedOptionalValue(MappedValue):
             return super().resolve(model, dbdata)
 
 
+class BatchMappedValue(Adjunct):
+    """adjunct value that returns the field values of a whole chunk with a vectorized callback.
+        the callback gets a list of dbdata, and has to return a list of values in the same order.
+        requires are the keys of dbdata the callback reads, see MappedValue.
+    """
+    __slots__ = ['callback', 'requires']
+
+    batch = True
+
+    def __init__(self, callback, requires: Iterable[str] | None = None):
+        self.callback = callback if callable(callback) else None
+        self.requires = None if requires is None else set(requires)
+
+    def dependencies(self):
+        return None if self.requires is None else set(self.requires)
+
+    def resolve(self, model, dbdata):
+        return self.resolve_batch(model, [dbdata])[0]
+
+    def resolve_batch(self, model, rows):
+        if self.callback:
+            return self.callback(rows)
+        return [None] * len(rows)
+
+    def cache_key(self):
+        return type(self), self.callback
+
+
+class BatchMappedOptionalValue(BatchMappedValue):
+    """BatchMappedValue that only passes the values which are not None to the callback
+    (convenience function)
+    """
+    def resolve_batch(self, model, rows):
+        present = [index for index, dbdata in enumerate(rows) if dbdata is not None]
+        values = [None] * len(rows)
+        if present and self.callback:
+            for index, value in zip(present, self.callback([rows[index] for index in present])):
+                values[index] = value
+        return values
+
+
+class AsyncMappedValue(BatchMappedValue):
+    """BatchMappedValue with an awaitable callback.
+        in async iteration, it runs in the event loop, while the next chunk is fetched from the database.
+    """
+    batch = False
+    asynchronous = True
+
+    def resolve_batch(self, model, rows):
+        return async_to_sync(self.resolve_async)(model, rows)
+
+    async def resolve_async(self, model, rows):
+        if self.callback:
+            return await self.callback(rows)
+        return [None] * len(rows)
+
+
 class Ref(Adjunct):
     """
     Adds this key to the .values() call, and processes it with an adjunct or callback.
@@ -82,10 +264,12 @@ class Ref(Adjunct):
     """
     __slots__ = ['adjunct', 'key']
 
-    def __init__(self, key, adjunct: Adjunct | Callable | None = None):
+    def __init__(self, key, adjunct: Adjunct | Callable | None = None, cache=None, cache_size: int | None = 10000):
         match adjunct:
-            case Adjunct(adj): self.adjunct = adjunct
-            case callback if callable(callback): self.adjunct = MappedOptionalValue(callback)
+            case Adjunct(): self.adjunct = adjunct
+            case callback if callable(callback):
+                # cache memoizes the callback per value of key, see MappedValue.
+                self.adjunct = MappedOptionalValue(callback, cache=cache, cache_size=cache_size)
             case _: self.adjunct = None
         self.key = key
 
@@ -96,6 +280,58 @@ class Ref(Adjunct):
         else:
             return value
 
+    def resolve_batch(self, model, rows):
+        values = [dbdata.get(self.key) for dbdata in rows]
+        if self.adjunct:
+            return self.adjunct.resolve_batch(model, values)
+        return values
+
+    async def resolve_async(self, model, rows):
+        values = [dbdata.get(self.key) for dbdata in rows]
+        if self.adjunct:
+            return await self.adjunct.resolve_async(model, values)
+        return values
+
+    @property
+    def batch(self):
+        return self.adjunct is not None and self.adjunct.batch
+
+    @property
+    def asynchronous(self):
+        return self.adjunct is not None and self.adjunct.asynchronous
+
+    @property
+    def positional(self):
+        # without an adjunct, we only redirect a value of the row.
+        return self.adjunct is None
+
+    def row_source(self):
+        return self.key, None
+
+    def bind(self, model):
+        if self.adjunct is None:
+            return self
+        adjunct = self.adjunct.bind(model)
+        if adjunct is self.adjunct:
+            return self
+        bound = copy(self)
+        bound.adjunct = adjunct
+        return bound
+
+    def dependencies(self):
+        # the adjunct of a Ref only gets the value of key.
+        return {self.key[0] if isinstance(self.key, tuple) else self.key}
+
+    def cache_stats(self) -> dict | None:
+        """the cache_stats() of a memoized callback, see MappedValue."""
+        return self.adjunct.cache_stats() if isinstance(self.adjunct, MappedValue) else None
+
+    def cache_key(self):
+        return Ref, self.key, self.adjunct and self.adjunct.cache_key()
+
+    def cache_models(self, model):
+        return self.adjunct.cache_models(model) if self.adjunct else []
+
     def values_field(self):
         return self.key
 
@@ -106,17 +342,29 @@ class Skip(Adjunct):
     skip = True
     resolves_field = False
 
+    def dependencies(self):
+        return set()
+
 
 class PostProcess(Adjunct):
-    """calls a callback which can modify the whole initialization dictionary."""
-    __slots__ = ['callback']
+    """calls a callback which can modify the whole initialization dictionary.
+        requires are the keys of the dictionary the callback reads, see MappedValue.
+    """
+    __slots__ = ['callback', 'requires']
 
     resolves_field = False
     post_processing = True
 
-    def __init__(self, callback):
+    def __init__(self, callback, requires: Iterable[str] | None = None):
         self.callback = callback
+        self.requires = None if requires is None else set(requires)
+
+    def dependencies(self):
+        return None if self.requires is None else set(self.requires)
 
     def post_process(self, model, dbdata):
         if self.callback:
             return self.callback(dbdata)
+
+    def cache_key(self):
+        return PostProcess, self.callback
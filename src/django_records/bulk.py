@@ -0,0 +1,169 @@
+"""
+Writing records back to the database.
+
+save_records() maps the fields of records back to model fields, splits them into inserts and updates,
+and runs them with bulk_create and bulk_update, one batch at a time. Model instances are only created as
+containers for the written fields, nothing is loaded from the database besides the existing keys of each batch.
+
+    result = Celestial.objects.bulk_write(rocks, fields=['size'], mapping={'orbits_name': Skip()})
+
+mapping takes the keyword arguments records() was called with, and inverts them: a field of a Ref without adjunct
+is written to the key of the Ref, a field of an F() expression to its field name, other adjuncts are not written.
+Record fields without a concrete model field of the same name are not written either.
+Nested records of foreign keys are written as the key of the related record.
+"""
+from functools import partial
+
+from django.db import connections, transaction
+from django.db.models import F
+from django.db.models.base import ModelState
+
+from .adjuncts import Adjunct, Ref
+from .errors import RecordClassDefinitionError
+from .plans import chunked
+from .registry import registry
+
+
+class WriteResult:
+    """counters of one save_records() call"""
+    __slots__ = ['created', 'updated', 'upserted', 'batches']
+
+    def __init__(self):
+        self.created = 0  # records inserted
+        self.updated = 0  # rows matched by updates
+        self.upserted = 0  # records written with a backend upsert, inserted or updated
+        self.batches = 0
+
+    def as_dict(self) -> dict:
+        return {'created': self.created, 'updated': self.updated, 'upserted': self.upserted, 'batches': self.batches}
+
+    def __repr__(self):
+        return f"<WriteResult created={self.created} updated={self.updated} upserted={self.upserted}>"
+
+
+def record_fields(record) -> tuple[str, ...]:
+    """the field names of a record, the keys of dictionaries."""
+    if isinstance(record, dict):
+        return tuple(record)
+    return registry.describe(type(record)).field_names
+
+
+def model_target(mapping: dict, name: str):
+    """the model field name a record field is written to, or None if it is not written."""
+    target = mapping.get(name, name)
+    if isinstance(target, Ref):
+        # a Ref with an adjunct transforms the value, which can not be inverted.
+        return target.key if target.adjunct is None and isinstance(target.key, str) else None
+    if isinstance(target, F):
+        return target.name
+    if isinstance(target, Adjunct) or not isinstance(target, str):
+        return None
+    return target
+
+
+def column_map(model, record, mapping: dict) -> list:
+    """(record field, model field) of the fields of record written to model."""
+    columns = []
+    for name in record_fields(record):
+        target = model_target(mapping, name)
+        if target is None:
+            continue
+        try:
+            field = model._meta.get_field(target)
+        except Exception:
+            continue
+        if field.concrete and not field.many_to_many:
+            columns.append((name, field))
+    return columns
+
+
+def value_getter(columns):
+    """returns a function returning the {attname: value} of a record for columns."""
+    getters = []
+    for name, field in columns:
+        target = field.target_field.attname if field.is_relation else None
+        getters.append((name, field.attname, target))
+
+    def values(record):
+        get = record.get if isinstance(record, dict) else partial(getattr, record)
+        result = {}
+        for name, attname, target in getters:
+            value = get(name)
+            if target is not None and value is not None:
+                # nested records of a foreign key are written as the key of the related record.
+                if isinstance(value, dict):
+                    value = value.get(target)
+                elif hasattr(value, target):
+                    value = getattr(value, target)
+            result[attname] = value
+        return result
+    return values
+
+
+def update_instance(model, db, values: dict):
+    """a model instance carrying only values, for bulk_update, without running __init__."""
+    instance = model.__new__(model)
+    instance._state = ModelState()
+    instance._state.adding = False
+    instance._state.db = db
+    instance.__dict__.update(values)
+    return instance
+
+
+def save_records(queryset, records, fields=None, key: str = 'id', mapping: dict | None = None, batch_size: int = 1000,
+                 upsert: bool = False) -> WriteResult:
+    """writes records to the model of queryset, see RecordQuerySetMixin.bulk_write."""
+    model = queryset.model
+    db = queryset.db
+    mapping = mapping or {}
+    result = WriteResult()
+    manager = model._base_manager.db_manager(db)
+
+    key_target = model_target(mapping, key)
+    try:
+        key_field = model._meta.get_field(key_target) if key_target else None
+    except Exception:
+        key_field = None
+    if key_field is None or not (key_field.primary_key or key_field.unique):
+        raise RecordClassDefinitionError(f"bulk_write needs a unique model field as key, {key} is none.")
+
+    upsert = upsert and connections[db].features.supports_update_conflicts_with_target
+    pk_attname = model._meta.pk.attname
+    attname = key_field.attname
+    plans = {}
+
+    with transaction.atomic(using=db, savepoint=False):
+        for batch in chunked(records, batch_size):
+            result.batches += 1
+            record_type = type(batch[0])
+            if record_type not in plans or record_type is dict:
+                columns = column_map(model, batch[0], mapping)
+                if not any(field is key_field for _, field in columns):
+                    raise RecordClassDefinitionError(f"bulk_write records have no field {key} for {key_field.name}.")
+                written = [field.name for name, field in columns
+                           if field is not key_field and (fields is None or name in fields)]
+                plans[record_type] = (value_getter(columns), written)
+            values, update_fields = plans[record_type]
+            rows = [values(record) for record in batch]
+
+            if upsert and update_fields:
+                manager.bulk_create([model(**row) for row in rows], batch_size=batch_size, update_conflicts=True,
+                                    unique_fields=[key_field.name], update_fields=update_fields)
+                result.upserted += len(rows)
+                continue
+
+            # the only query reading the table: the primary keys of the keys that exist already.
+            keys = [row[attname] for row in rows if row[attname] is not None]
+            existing = dict(manager.filter(**{f'{key_field.name}__in': keys}).values_list(key_field.name, 'pk')) if keys else {}
+            inserts = [model(**row) for row in rows if row[attname] not in existing]
+            updates = []
+            for row in rows:
+                if row[attname] in existing:
+                    row[pk_attname] = existing[row[attname]]
+                    updates.append(update_instance(model, db, row))
+            if inserts:
+                manager.bulk_create(inserts, batch_size=batch_size)
+                result.created += len(inserts)
+            if updates and update_fields:
+                result.updated += manager.bulk_update(updates, update_fields, batch_size=batch_size)
+    return result
@@ -0,0 +1,289 @@
+"""
+Result cache for records querysets.
+
+queryset.records(...).cached() keeps the evaluated records in a RecordCache, so the same records() query
+with the same handler and adjuncts only hits the database again once its entry expired or was invalidated.
+
+Entries are kept in an in-process LRU of limited size. If a Django cache backend is configured, the raw rows
+are stored there as well, so other processes can build their records from them without querying the database.
+
+The key of an entry is made of the compiled SQL and its params, the handler and the cache_key() of every adjunct.
+Adjuncts with inline lambdas produce a new key per queryset: pass an explicit key to cached() for those.
+
+Every evaluation gets a list of its own. Immutable records, e.g. frozen dataclasses or named tuples, are shared between
+the callers, mutable ones, e.g. dictionaries of RecordDict, are shallow copies of the cached ones. Records nested
+in them are shared, so they should be immutable, see nested and related.
+
+Entries are invalidated on post_save, post_delete and m2m_changed of the models involved in the query.
+Changes which send no signals, like QuerySet.update() or bulk_create(), are not noticed: use a ttl for those,
+or call invalidate() yourself.
+"""
+import hashlib
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from copy import copy
+
+from django.apps import apps
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.exceptions import EmptyResultSet
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+_instances = weakref.WeakSet()
+_connected = False
+
+
+class CacheEntry:
+    """records of one cached query"""
+    __slots__ = ['records', 'models', 'expires', 'version']
+
+    def __init__(self, records: list, models: frozenset, expires: float | None, version=None):
+        self.records = records
+        self.models = models  # labels of the models the records depend on
+        self.expires = expires  # time.monotonic() deadline, or None
+        self.version = version  # key of the rows in the cache backend, if there is one
+
+
+class RecordCache:
+    """
+    LRU cache of evaluated records querysets.
+
+    maxsize is the number of querysets kept in process, timeout the default ttl in seconds (None never expires).
+    backend is the alias of a Django cache, e.g. 'default', which additionally stores the raw rows.
+    """
+
+    def __init__(self, maxsize: int = 128, timeout: float | None = None, backend: str | None = None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.backend = backend
+        self.hits = 0
+        self.backend_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._generations = {}  # label -> count of invalidations, to notice the ones during an evaluation
+        self._cleared = 0
+        self._lock = threading.RLock()
+        _instances.add(self)
+
+    def evaluate(self, iterable, ttl=None, key=None) -> list:
+        """returns the records of a RecordIterable, from the cache if possible."""
+        plan = iterable.plan()
+        queryset = iterable.queryset
+        try:
+            query = query_key(queryset) if key is None else (key,)
+        except EmptyResultSet:
+            # django never runs this query, there is nothing to cache.
+            return list(iterable.build(plan, iterable.rows()))
+        entry_key = (*query, plan_key(plan)) if key is None else query
+        try:
+            hash(entry_key)
+        except TypeError:
+            # e.g. a FixedValue with a list. such querysets are not cached.
+            with self._lock:
+                self.misses += 1
+            return list(iterable.build(plan, iterable.rows()))
+
+        if ttl is None:
+            ttl = self.timeout
+        models = involved_models(queryset, plan)
+        version = self.version(query, models) if self.backend else None
+
+        entry = self.get(entry_key, version)
+        if entry is not None:
+            return handed_out(entry.records)
+
+        # rows fetched before an invalidation must not be stored after it.
+        generation = self.generation(models)
+        rows = None
+        if version is not None:
+            rows = caches[self.backend].get(version)
+            if rows is not None:
+                with self._lock:
+                    self.backend_hits += 1
+        if rows is None:
+            with self._lock:
+                self.misses += 1
+            rows = list(iterable.rows())
+            if version is not None:
+                caches[self.backend].set(version, rows, DEFAULT_TIMEOUT if ttl is None else ttl)
+
+        records = list(iterable.build(plan, rows))
+        with self._lock:
+            if self.generation(models) == generation:
+                self.set(entry_key, records, models, ttl, version)
+        return handed_out(records)
+
+    def get(self, key, version=None) -> CacheEntry | None:
+        """returns the live entry for key, counting a hit, or None. version has to match, if the entry has one."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if (entry.expires is not None and entry.expires < time.monotonic()) or entry.version != version:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def set(self, key, records: list, models=(), ttl=None, version=None):
+        """stores records under key, evicting the least recently used entries beyond maxsize."""
+        connect_signals()
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            self._entries[key] = CacheEntry(records, frozenset(models), expires, version)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def generation(self, models) -> tuple:
+        """changes with every invalidation of one of models in this process."""
+        with self._lock:
+            return self._cleared, tuple(self._generations.get(label, 0) for label in sorted(models))
+
+    def version(self, query, models) -> str:
+        """key of the rows of query in the cache backend, which changes with the generation of every involved model."""
+        backend = caches[self.backend]
+        generation_keys = [generation_key(label) for label in sorted(models)]
+        generations = backend.get_many(generation_keys)
+        identity = repr((query, [generations.get(k, 0) for k in generation_keys]))
+        return f"django_records:rows:{hashlib.sha256(identity.encode()).hexdigest()}"
+
+    def invalidate(self, model=None):
+        """drops the entries depending on model, or all entries if model is None."""
+        if model is None:
+            self.clear()
+            return
+        label = model_label(model)
+        with self._lock:
+            self._generations[label] = self._generations.get(label, 0) + 1
+            stale = [key for key, entry in self._entries.items() if label in entry.models]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+        if self.backend:
+            # rows in the backend are not deleted, they are not found anymore by the next version().
+            caches[self.backend].set(generation_key(label), time.time_ns(), None)
+
+    def clear(self):
+        """drops all entries of this process."""
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._cleared += 1
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'backend_hits': self.backend_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+            }
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+def query_key(queryset) -> tuple:
+    """(database alias, sql, params) of queryset. raises EmptyResultSet if the query can not match anything."""
+    sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    return queryset.db, sql, tuple(params)
+
+
+def handed_out(records: list) -> list:
+    """a list of records for a caller, with copies of mutable records, so callers do not change each other's records."""
+    if not records or is_immutable(type(records[0])):
+        return list(records)
+    return list(map(copy, records))
+
+
+def is_immutable(klass) -> bool:
+    """whether records of klass can not be changed: tuples, and frozen dataclasses, pydantic models or msgspec structs."""
+    if issubclass(klass, tuple):
+        return True
+    params = getattr(klass, '__dataclass_params__', None) or getattr(klass, '__struct_config__', None)
+    if params is not None:
+        return bool(params.frozen)
+    config = getattr(klass, 'model_config', None)
+    return isinstance(config, dict) and bool(config.get('frozen'))
+
+
+def plan_key(plan) -> tuple:
+    """identity of what a row plan builds from the rows: columns, handler and adjuncts."""
+    handler = plan.handler
+    return (
+        tuple(plan.names),
+        type(handler),
+        handler.record,
+        # trusted records skip the validation and __init__ logic of the record class, they are not the same records.
+        handler.trusted,
+        tuple((name, adjunct.cache_key()) for name, adjunct in plan.adjuncts.items()),
+    )
+
+
+def model_label(model) -> str:
+    return model._meta.concrete_model._meta.label
+
+
+def generation_key(label) -> str:
+    return f"django_records:generation:{label}"
+
+
+def involved_models(queryset, plan) -> set[str]:
+    """labels of the models whose tables are in the query, or whose records adjuncts fetch."""
+    labels = set()
+    query = queryset.query
+    if queryset.model is not None:
+        labels.add(model_label(queryset.model))
+    tables = {join.table_name for join in query.alias_map.values()}
+    if tables:
+        for model in apps.get_models(include_auto_created=True):
+            if model._meta.db_table in tables:
+                labels.add(model_label(model))
+    for adjunct in plan.adjuncts.values():
+        for model in adjunct.cache_models(queryset.model):
+            labels.add(model_label(model))
+    return labels
+
+
+def invalidate_all(model):
+    for cache in list(_instances):
+        cache.invalidate(model)
+
+
+def on_change(sender, **kwargs):
+    invalidate_all(sender)
+
+
+def on_m2m_change(sender, instance, action, model, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        # sender is the through model, both sides of the relation might be in cached queries.
+        invalidate_all(sender)
+        invalidate_all(type(instance))
+        invalidate_all(model)
+
+
+def connect_signals():
+    """connects the invalidation receivers, once the first entry is cached."""
+    global _connected
+    if _connected:
+        return
+    _connected = True
+    post_save.connect(on_change, dispatch_uid='django_records.cache.post_save')
+    post_delete.connect(on_change, dispatch_uid='django_records.cache.post_delete')
+    m2m_changed.connect(on_m2m_change, dispatch_uid='django_records.cache.m2m_changed')
+
+
+record_cache = RecordCache()
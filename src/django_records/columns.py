@@ -0,0 +1,198 @@
+"""
+Columnar records: the results of records() as typed columns instead of record instances.
+
+The rows go through the same adjunct pipeline as records(), but instead of creating a record per row,
+each chunk is appended to one typed buffer per field of the record class.
+Numeric columns are kept in array.array buffers, so they are not held as Python objects per row,
+and can be handed to NumPy or pyarrow without copying.
+
+Column types are taken from the annotations of the record class, or from the model field types.
+"""
+import math
+import typing
+from array import array
+from types import NoneType, UnionType
+
+from .errors import RecordInstanceError
+from .plans import chunked
+from .registry import registry
+
+INTEGER_FIELDS = {
+    'AutoField', 'BigAutoField', 'SmallAutoField',
+    'IntegerField', 'BigIntegerField', 'SmallIntegerField',
+    'PositiveIntegerField', 'PositiveBigIntegerField', 'PositiveSmallIntegerField',
+}
+FLOAT_FIELDS = {'FloatField'}
+BOOLEAN_FIELDS = {'BooleanField'}
+
+
+class ColumnBuffer:
+    """
+    typed buffer for the values of one column.
+
+    int64, float64 and bool columns are stored in an array.array. None in a float column becomes nan,
+    None or a non numeric value in an int64 or bool column turns the buffer into a list of objects.
+    """
+    __slots__ = ['name', 'dtype', 'values']
+
+    typecodes = {'int64': 'q', 'float64': 'd', 'bool': 'B'}
+
+    def __init__(self, name: str, dtype: str = 'object'):
+        self.name = name
+        self.dtype = dtype
+        typecode = self.typecodes.get(dtype)
+        self.values = array(typecode) if typecode else []
+
+    @property
+    def typed(self) -> bool:
+        """whether the values are still stored in a typed array."""
+        return isinstance(self.values, array)
+
+    def extend(self, values):
+        if not self.typed:
+            self.values.extend(values)
+            return
+        size = len(self.values)
+        try:
+            self.values.extend(values)
+            return
+        except (TypeError, OverflowError):
+            del self.values[size:]
+        if self.dtype == 'float64':
+            try:
+                self.values.extend([math.nan if value is None else value for value in values])
+                return
+            except (TypeError, OverflowError):
+                del self.values[size:]
+        self.values = self.values.tolist()
+        self.values.extend(values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def to_numpy(self):
+        import numpy
+        if self.typed:
+            return numpy.frombuffer(self.values, dtype=self.dtype)
+        return numpy.array(self.values, dtype=object)
+
+    def to_arrow(self):
+        import pyarrow
+        types = {'int64': pyarrow.int64(), 'float64': pyarrow.float64(), 'bool': pyarrow.bool_()}
+        if self.typed and self.dtype != 'bool':
+            return pyarrow.Array.from_buffers(types[self.dtype], len(self.values), [None, pyarrow.py_buffer(self.values)])
+        return pyarrow.array(list(self.values), type=types.get(self.dtype))
+
+
+def annotation_dtype(annotation) -> str:
+    """maps a type annotation to a column dtype."""
+    if typing.get_origin(annotation) in (typing.Union, UnionType):
+        arguments = [a for a in typing.get_args(annotation) if a is not NoneType]
+        if len(arguments) != 1:
+            return 'object'
+        annotation = arguments[0]
+    if annotation is bool:
+        return 'bool'
+    if annotation is int:
+        return 'int64'
+    if annotation is float:
+        return 'float64'
+    return 'object'
+
+
+def field_dtype(model, name) -> str:
+    """maps the model field called name to a column dtype."""
+    try:
+        field = model._meta.get_field(name)
+    except Exception:
+        return 'object'
+    if getattr(field, 'target_field', None) is not None and field.is_relation:
+        field = field.target_field
+    internal_type = field.get_internal_type()
+    if internal_type in INTEGER_FIELDS:
+        return 'int64'
+    if internal_type in FLOAT_FIELDS:
+        return 'float64'
+    if internal_type in BOOLEAN_FIELDS:
+        return 'bool'
+    return 'object'
+
+
+def column_dtypes(plan, names) -> dict[str, str]:
+    """dtypes of the columns: annotations of the record class first, model fields otherwise."""
+    try:
+        hints = typing.get_type_hints(plan.handler.record)
+    except Exception:
+        hints = {}
+    dtypes = {}
+    for name in names:
+        if name in hints:
+            dtypes[name] = annotation_dtype(hints[name])
+        elif plan.model is not None:
+            dtypes[name] = field_dtype(plan.model, name)
+        else:
+            dtypes[name] = 'object'
+    return dtypes
+
+
+def column_names(plan) -> list[str]:
+    """the columns records would have: the fields of the record class, or the row keys for dictionaries."""
+    names = list(plan.handler.get_field_names())
+    if names:
+        return names
+    return list(plan.keys() or plan.names)
+
+
+def collect_columns(iterable, format='numpy'):
+    """
+    evaluates a RecordIterable into columns.
+
+    format is 'numpy' for a dictionary of numpy arrays, 'arrow' for a pyarrow Table,
+    or 'array' for a dictionary of the array.array (or list) buffers, which needs no further dependencies.
+    """
+    if format not in ('numpy', 'arrow', 'array'):
+        raise ValueError(f"Unknown column format {format}.")
+    plan = iterable.plan()
+    names = column_names(plan)
+    dtypes = column_dtypes(plan, names)
+    buffers = [ColumnBuffer(name, dtypes[name]) for name in names]
+
+    try:
+        meta = registry.describe(plan.handler.record)
+    except Exception:
+        meta = None
+
+    def default(name, size):
+        if meta is not None and name in meta.defaults:
+            return [meta.defaults[name]] * size
+        if meta is not None and name in meta.factories:
+            return [meta.factories[name]() for _ in range(size)]
+        raise RecordInstanceError(f"Column {name} is neither fetched nor has a default.")
+
+    if not plan.adjuncts:
+        # without adjuncts, columns are sliced out of the rows directly.
+        indexes = {name: index for index, name in enumerate(plan.names)}
+        for rows in chunked(iterable.rows(), iterable.chunk_size):
+            columns = list(zip(*rows))
+            for buffer in buffers:
+                index = indexes.get(buffer.name)
+                buffer.extend(columns[index] if index is not None else default(buffer.name, len(rows)))
+    else:
+        prepare = plan.compile_prepare()
+        for rows in chunked(iterable.rows(), iterable.chunk_size):
+            chunk = prepare(rows)
+            for buffer in buffers:
+                name = buffer.name
+                if all(name in dbdata for dbdata in chunk):
+                    buffer.extend([dbdata[name] for dbdata in chunk])
+                else:
+                    defaults = default(name, len(chunk))
+                    buffer.extend([dbdata.get(name, defaults[i]) for i, dbdata in enumerate(chunk)])
+
+    if format == 'array':
+        return {buffer.name: buffer.values for buffer in buffers}
+    if format == 'numpy':
+        return {buffer.name: buffer.to_numpy() for buffer in buffers}
+    import pyarrow
+    return pyarrow.table({buffer.name: buffer.to_arrow() for buffer in buffers})
+
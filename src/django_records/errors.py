@@ -6,3 +6,6 @@ class RecordClassDefinitionError(DjangoRecordsException):
 
 class RecordInstanceError(DjangoRecordsException):
     ...
+
+class RecordTreeLimitError(DjangoRecordsException):
+    ...
@@ -0,0 +1,131 @@
+"""
+Running several records querysets at the same time.
+
+gather_records() evaluates independent querysets, e.g. the panels of a dashboard, or the same query on several
+using() aliases, each in a thread of its own, and returns their results in the order of the querysets,
+so the wall-clock time is the one of the slowest query instead of the sum of all of them:
+
+    planets, ports = gather_records(Celestial.objects.records(Body), Spaceport.objects.using('shard_2').records(Port))
+
+agather_records() does the same for async code. merge_records() streams the records of several querysets of the same
+record type, each ordered by the same key, e.g. shards of one table, as one ordered stream, with a heap over the
+current record of each queryset. Each queryset is fetched in chunks by a thread of its own, ahead of the merge.
+
+Django connections belong to a thread, so every queryset gets a connection of its own, which is closed
+when the thread is done. Rows written in an open transaction of the calling thread are not visible to them.
+"""
+import asyncio
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty, Queue
+
+from django.db import connections
+
+from .errors import RecordClassDefinitionError
+from .plans import chunked
+
+DONE = object()
+
+
+def evaluate(queryset, container=list):
+    """the records of queryset in container, evaluated in a thread, whose connections are closed afterwards."""
+    try:
+        return container(queryset)
+    finally:
+        connections.close_all()
+
+
+def gather_records(*querysets, container=list, workers: int | None = None) -> list:
+    """
+    evaluates querysets concurrently, each with its own connection, and returns their records in the order of querysets.
+    container builds the result of each queryset. workers limits the threads, by default one per queryset.
+    the first error of the querysets, in their order, is raised once all of them are done.
+    """
+    if not querysets:
+        return []
+    with ThreadPoolExecutor(workers or len(querysets), 'django_records_gather') as pool:
+        futures = [pool.submit(evaluate, queryset, container) for queryset in querysets]
+    return [future.result() for future in futures]
+
+
+async def agather_records(*querysets, container=list) -> list:
+    """gather_records() for async code, with one thread per queryset besides the sync thread of asgiref."""
+    loop = asyncio.get_running_loop()
+    return list(await asyncio.gather(*(loop.run_in_executor(None, evaluate, queryset, container) for queryset in querysets)))
+
+
+def record_key(key):
+    """a callable returning the sort key of a record, for a field name of dictionaries or record classes, or a callable."""
+    if callable(key):
+        return key
+    return lambda record: record[key] if isinstance(record, dict) else getattr(record, key)
+
+
+class RecordStream:
+    """
+    the records of a queryset, fetched in chunks by a thread of its own, at most prefetch chunks ahead.
+    the thread starts right away, so streams of several querysets wait for their first rows at the same time.
+    """
+
+    def __init__(self, queryset, chunk_size: int = 2000, prefetch: int = 2):
+        self.queryset = queryset
+        self.chunk_size = chunk_size
+        self.chunks = Queue(prefetch)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.produce, name='django_records_stream', daemon=True)
+        self.thread.start()
+
+    def produce(self):
+        try:
+            for chunk in chunked(self.queryset.iterator(self.chunk_size), self.chunk_size):
+                self.chunks.put(chunk)
+                if self.stopped.is_set():
+                    return
+            self.chunks.put(DONE)
+        except Exception as e:
+            self.chunks.put(e)
+        finally:
+            connections.close_all()
+
+    def __iter__(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is DONE:
+                return
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield from chunk
+
+    def close(self):
+        """stops fetching, the thread ends after the chunk it is fetching."""
+        self.stopped.set()
+        while self.thread.is_alive():
+            # a full queue blocks the thread, until a chunk is taken out.
+            try:
+                self.chunks.get_nowait()
+            except Empty:
+                pass
+            self.thread.join(0.01)
+
+
+def merge_records(*querysets, key, reverse: bool = False, chunk_size: int = 2000, prefetch: int = 2):
+    """
+    yields the records of querysets ordered by key, merging querysets that are each ordered by key already.
+    key is a record field name or a callable returning the sort key of a record. reverse merges descending orders.
+    every queryset is fetched in chunks of chunk_size records by a thread of its own, see RecordStream.
+    """
+    for queryset in querysets:
+        if not queryset.ordered:
+            raise RecordClassDefinitionError(f"merge_records needs querysets ordered by the key, {queryset.model} is not ordered.")
+    return merged(querysets, record_key(key), reverse, chunk_size, prefetch)
+
+
+def merged(querysets, key, reverse, chunk_size, prefetch):
+    # the streams start with the iteration, and are stopped when it ends, or the generator is closed.
+    streams = [RecordStream(queryset, chunk_size, prefetch) for queryset in querysets]
+    try:
+        yield from heapq.merge(*streams, key=key, reverse=reverse)
+    finally:
+        for stream in streams:
+            stream.close()
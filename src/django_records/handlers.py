@@ -6,7 +6,12 @@ Each Record Type should define one.
 Usually you just want to use one of the pre-built Handlers for dataclass, dict, or pydantic.
 
 """
+import dataclasses
+from operator import itemgetter
+from types import MemberDescriptorType
+
 from .errors import RecordClassDefinitionError
+from .registry import RecordMeta, registry
 
 class RecordHandler:
     """
@@ -14,24 +19,60 @@ class RecordHandler:
 
     defines how a record can be created, and how to retrieve all field names, and the required ones.
     """
-    __slots__ = ['klass']
+    __slots__ = ['klass', 'trusted']
+
+    batch = False  # if batch is true, plans create the records of a whole chunk of rows with chunk_factory()
 
     @classmethod
-    def wrap(cls, klass):
+    def wrap(cls, klass, trusted=False):
         """internal factory function used to wrap a non-record handler into a record handler"""
-        return cls(klass)
+        return cls(klass, trusted=trusted)
 
-    def __init__(self, klass):
+    def __init__(self, klass, trusted=False):
         self.klass = klass
+        # trusted handlers may skip validation and __init__ logic, as the data comes straight from the database.
+        self.trusted = trusted
 
     def create(self, **kwargs):
         """the actual creation of the underlying record type instance"""
         return self.klass(**kwargs)
 
+    def factory(self, keys=None):
+        """
+        returns a callable that creates a record from a dictionary.
+
+        keys are the keys every dictionary will have, or None if they are not known in advance.
+        row plans call this once per queryset, so handlers can specialize the creation here.
+        """
+        create = self.create
+        return lambda data: create(**data)
+
+    def chunk_factory(self, keys=None):
+        """
+        returns a callable that creates the records of a list of dictionaries, as factory() does for one.
+        handlers with batch support override this to create a chunk in one go.
+        """
+        create = self.factory(keys)
+        return lambda chunk: [create(data) for data in chunk]
+
+    def positional(self, keys):
+        """
+        returns (arguments, callable) if a record with the given keys can be created from positional arguments only.
+        the callable takes the values of arguments in that order. returns None if the handler needs keywords.
+        """
+        return None
+
     def get_field_names(self):
         """should return all field names of the wrapped record type."""
         return self.klass.__dict__.keys()
 
+    def consumed_keys(self) -> frozenset[str] | None:
+        """
+        the keys of the row data the records are created from, other keys are dropped.
+        None, the default, if any key may be used, which keeps records() from pruning unused columns.
+        """
+        return None
+
     @property
     def record(self):
         """property used to retrieve the wrapped class."""
@@ -46,9 +87,15 @@ class RecordHandler:
 class RecordDict(RecordHandler):
     """RecordHandler that outputs a dictionary"""
 
-    def __init__(self, klass=None):
+    def __init__(self, klass=None, trusted=False):
         # it is not required to define dict, but you could do OrderedDict e.g.
-        self.klass = klass or dict
+        super().__init__(klass or dict, trusted=trusted)
+
+    def factory(self, keys=None):
+        if type(self).create is not RecordHandler.create:
+            return super().factory(keys)
+        # dictionary types can be built from the row data directly.
+        return self.klass
 
     def get_field_names(self) -> list[str]:
         # dictionary has no required fields. any field is possible.
@@ -56,23 +103,365 @@ class RecordDict(RecordHandler):
 
 
 class RecordDataclass(RecordHandler):
-    """handles dataclasses.dataclass derivatives"""
+    """
+    handles dataclasses.dataclass derivatives.
+    wrap() picks a specialized handler for pydantic models, namedtuples, attrs classes and msgspec structs.
+    """
+
+    @property
+    def meta(self) -> RecordMeta:
+        """the introspected metadata of the wrapped class, shared through the registry."""
+        return registry.describe(self.klass)
 
     def create(self, **kwargs):
         # clean field names to be only valid if they are on the dataclass.
-        record_fields = self.get_field_names()
+        record_fields = self.meta.field_set
         kwargs = {k: v for k, v in kwargs.items() if k in record_fields}
         return self.klass(**kwargs)
 
+    def factory(self, keys=None):
+        if type(self).create is not RecordDataclass.create:
+            return super().factory(keys)
+        if self.trusted and self.meta.strategy == 'dataclass':
+            create = self.trusted_factory(keys)
+            if create is not None:
+                return create
+        klass = self.klass
+        record_fields = self.meta.field_set
+        if keys is None:
+            # keys are only known per row, so we filter per row.
+            return lambda data: klass(**{k: v for k, v in data.items() if k in record_fields})
+        drop = tuple(k for k in keys if k not in record_fields)
+        if not drop:
+            return lambda data: klass(**data)
+
+        def create(data):
+            for k in drop:
+                del data[k]
+            return klass(**data)
+        return create
+
+    def trusted_factory(self, keys=None):
+        """returns a factory creating records with a generated constructor, see trusted_constructor(), or None."""
+        klass = self.klass
+        record_fields = self.meta.field_set
+        if keys is None:
+            constructors = {}
+
+            def create(data):
+                arguments = tuple(k for k in data if k in record_fields)
+                try:
+                    constructor = constructors[arguments]
+                except KeyError:
+                    constructor = constructors[arguments] = (
+                        trusted_constructor(klass, arguments) or (lambda *values: klass(**dict(zip(arguments, values)))))
+                return constructor(*[data[k] for k in arguments])
+            return create
+
+        arguments = tuple(k for k in keys if k in record_fields)
+        constructor = trusted_constructor(klass, arguments)
+        if constructor is None:
+            return None
+        return positional_factory(arguments, constructor)
+
+    def positional(self, keys):
+        if type(self).create is not RecordDataclass.create:
+            return None
+        meta = self.meta
+        if self.trusted and meta.strategy == 'dataclass':
+            arguments = tuple(k for k in keys if k in meta.field_set)
+            constructor = trusted_constructor(self.klass, arguments)
+            if constructor is not None:
+                return list(arguments), constructor
+        arguments = list(meta.positional)
+        # every known field has to be passed positionally, other keys are dropped anyway.
+        if any(k in meta.field_set and k not in arguments for k in keys):
+            return None
+        used = [a for a in arguments if a in keys]
+        # only trailing arguments may be left to their defaults.
+        if used != arguments[:len(used)]:
+            return None
+        return used, self.klass
+
     def get_field_names(self) -> list[str]:
         # returns all field names, even those which are not required.
+        return list(self.meta.field_names)
+
+    def consumed_keys(self):
+        # a create() of a subclass may use any key.
+        if type(self).create not in (RecordDataclass.create, RecordPydantic.create):
+            return None
+        return self.meta.field_set
+
+    @classmethod
+    def wrap(cls, klass, trusted=False):
+        # the default handler picks the specialized handler for known record types.
+        if cls is RecordDataclass:
+            try:
+                cls = HANDLERS.get(registry.describe(klass).strategy, cls)
+            except RecordClassDefinitionError:
+                pass
+        return cls(klass, trusted=trusted)
+
+
+
+def queryset_handler(queryset, caller='records') -> RecordHandler:
+    """the RecordHandler records() uses for queryset, set with record_into() or the _default_record of queryset or model."""
+    handler = getattr(queryset, '_record', getattr(queryset, '_default_record', getattr(queryset.model, '_default_record', None)))
+    if not handler:
+        raise RecordClassDefinitionError(f"Trying {caller}() on a Queryset without destination class.")
+    if not isinstance(handler, RecordHandler):
+        handler = queryset._record_handler.wrap(handler)
+    return handler
+
+
+def handler_key(into):
+    """the part of a cache key for into, a record class or a RecordHandler, whose records differ with trusted."""
+    if isinstance(into, RecordHandler):
+        return type(into), into.record, into.trusted
+    return into
+
+
+class RecordNamedTuple(RecordDataclass):
+    """handles collections.namedtuple and typing.NamedTuple, which are built with tuple.__new__ from the values in field order."""
+
+    def factory(self, keys=None):
+        if type(self).create is not RecordDataclass.create or keys is None:
+            return super().factory(keys)
+        meta = self.meta
+        missing = [f for f in meta.field_names if f not in keys]
+        if any(f not in meta.defaults for f in missing):
+            return super().factory(keys)
+        make = self.klass._make
+        if not missing:
+            getter = itemgetter(*meta.field_names)
+            return lambda data: make(getter(data))
+        defaults = {f: meta.defaults[f] for f in missing}
+        fields = meta.field_names
+        return lambda data: make([data[f] if f in data else defaults[f] for f in fields])
+
+
+class RecordSlots(RecordDataclass):
+    """
+    handles classes with __slots__ instead of an instance dictionary, e.g. slots=True dataclasses.
+
+    RecordSlots.generate() creates a frozen slotted dataclass from a list of fields, for records without a class of their own.
+    """
+
+    def __init__(self, klass, trusted=False):
+        if '__slots__' not in vars(klass):
+            raise RecordClassDefinitionError(f"{klass} has no __slots__.")
+        super().__init__(klass, trusted=trusted)
+
+    @classmethod
+    def generate(cls, name: str, fields, frozen=True, **options):
+        """handler for a new slotted dataclass. fields are names, (name, type) or (name, type, dataclasses.field()) tuples."""
+        return cls(dataclasses.make_dataclass(name, fields, slots=True, frozen=frozen, **options))
+
+
+class RecordAttrs(RecordDataclass):
+    """handles attrs classes. private attributes are passed without their leading underscore, as attrs expects."""
+
+
+class RecordStruct(RecordDataclass):
+    """handles msgspec.Struct types, whose constructor is implemented in C and takes positional arguments."""
+
+
+class RecordPydantic(RecordDataclass):
+    """
+    handles pydantic models.
+
+    by default, the rows of a chunk are validated in one go by the validator of the model, which keeps pydantic-core busy.
+    with trusted=True, records are created like model_construct() does without validation, for data straight from the database.
+    fields with an alias are passed by their alias.
+    """
+
+    @property
+    def batch(self):
+        # pydantic v1 has no validator of its own, its models are validated one by one.
+        return not self.trusted and hasattr(self.klass, 'model_validate')
+
+    def create(self, **kwargs):
+        return self.factory()(kwargs)
+
+    def arguments(self, keys=None):
+        """returns a function turning row data into the keyword arguments of the model."""
+        meta = self.meta
+        fields = meta.field_set
+        aliases = meta.aliases
+        if keys is not None and all(k in fields and k not in aliases for k in keys):
+            return None
+        return lambda data: {aliases.get(k, k): v for k, v in data.items() if k in fields}
+
+    def factory(self, keys=None):
+        if type(self).create is not RecordPydantic.create:
+            return RecordHandler.factory(self, keys)
+        klass = self.klass
+        if self.trusted:
+            construct = self.construct(keys)
+            if construct is not None:
+                return positional_factory(*construct)
+            klass = getattr(klass, 'model_construct', None) or klass.construct
+        arguments = self.arguments(keys)
+        if arguments is None:
+            return lambda data: klass(**data)
+        return lambda data: klass(**arguments(data))
+
+    def construct(self, keys):
+        """
+        returns (arguments, constructor), the fields of keys in the order of the model, and a function creating an instance
+        from their values, which sets the fields directly like model_construct() does, without its checks per row.
+        None if model_construct() is needed, e.g. for private attributes or default factories.
+        """
+        klass = self.klass
+        if keys is None or not hasattr(klass, 'model_construct') or getattr(klass, '__pydantic_post_init__', None):
+            return None
+        if klass.model_config.get('extra') == 'allow':
+            return None
+        meta = self.meta
+        fields = meta.field_names
+        missing = [f for f in fields if f not in keys]
+        if any(f not in meta.defaults or not isinstance(meta.defaults[f], IMMUTABLE) for f in missing):
+            return None
+        arguments = tuple(f for f in fields if f in keys)
+        return arguments, generate_model_constructor(klass, fields, arguments, meta.defaults)
+
+    def positional(self, keys):
+        # trusted records skip the row dictionary of the plan, the values are passed to the constructor.
+        if not self.trusted or type(self).create is not RecordPydantic.create:
+            return None
+        construct = self.construct(keys)
+        if construct is None:
+            return None
+        arguments, constructor = construct
+        return list(arguments), constructor
+
+    def chunk_factory(self, keys=None):
+        if not self.batch or type(self).create is not RecordPydantic.create:
+            return super().chunk_factory(keys)
+        validate = self.klass.__pydantic_validator__.validate_python
+        arguments = self.arguments(keys)
+        if arguments is None:
+            return lambda chunk: list(map(validate, chunk))
+        return lambda chunk: [validate(arguments(data)) for data in chunk]
+
+
+def positional_factory(arguments: tuple[str, ...], constructor):
+    """returns a factory passing the values of arguments in the row data to constructor, positionally."""
+    if not arguments:
+        return lambda data: constructor()
+    getter = itemgetter(*arguments)
+    if len(arguments) == 1:
+        return lambda data: constructor(getter(data))
+    return lambda data: constructor(*getter(data))
+
+
+def descriptor(klass, name: str):
+    """the attribute name of klass as defined in the class dictionary of klass or its bases, None if there is none."""
+    return next((vars(base)[name] for base in klass.__mro__ if name in vars(base)), None)
+
+
+def compiled(klass, source: str):
+    """
+    the code of source, compiled once per klass and kept in the registry. code objects do not refer to klass,
+    so klass can still be collected, the namespace binding them to klass is created per use.
+    """
+    generated = registry.generated(klass)
+    try:
+        return generated[source]
+    except KeyError:
+        code = generated[source] = compile(source, f'<django_records {klass.__qualname__}>', 'exec')
+        return code
+
+
+def trusted_constructor(klass, arguments: tuple[str, ...]):
+    """
+    generates a function creating an instance of the dataclass klass from the values of arguments, in that order,
+    without calling __init__ or __post_init__. fields that are not in arguments get their default, or call their default_factory.
+
+    fields are stored in the instance dictionary directly, in the order of the fields like __init__ does, which keeps the
+    compact layout of instances sharing their keys, or through the slot descriptors of slotted classes. both work for
+    frozen dataclasses. returns None if a required field is missing, or a field can not be set directly.
+    """
+    fields = dataclasses.fields(klass)
+    names = {f.name for f in fields}
+    if any(argument not in names for argument in arguments):
+        return None
+    has_dict = any('__dict__' in vars(base) for base in klass.__mro__[:-1])
+
+    namespace = {'new': object.__new__, 'klass': klass}
+    parameters = [f'value_{index}' for index in range(len(arguments))]
+    values = dict(zip(arguments, parameters))
+    setters = []
+    for index, f in enumerate(fields):
+        if f.name in values:
+            value = values[f.name]
+        elif f.default is not dataclasses.MISSING:
+            namespace[f'default_{index}'] = f.default
+            value = f'default_{index}'
+        elif f.default_factory is not dataclasses.MISSING:
+            namespace[f'factory_{index}'] = f.default_factory
+            value = f'factory_{index}()'
+        elif f.init:
+            return None
+        else:
+            # like __init__, fields without init and default are left unset.
+            continue
+        attribute = descriptor(klass, f.name)
+        if isinstance(attribute, MemberDescriptorType):
+            namespace[f'set_{index}'] = attribute.__set__
+            setters.append(f"    set_{index}(record, {value})")
+        elif has_dict and not hasattr(type(attribute), '__set__'):
+            setters.append(f"    instance[{f.name!r}] = {value}")
+        else:
+            return None
+
+    lines = [f"def create({', '.join(parameters)}):", "    record = new(klass)"]
+    if has_dict:
+        lines.append("    instance = record.__dict__")
+    lines.extend([*setters, "    return record"])
+    exec(compiled(klass, '\n'.join(lines)), namespace)
+    return namespace['create']
+
+
+def generate_model_constructor(klass, fields: tuple[str, ...], arguments: tuple[str, ...], defaults: dict):
+    """
+    generates a function creating an instance of the pydantic model klass from the values of arguments, in that order,
+    with the instance dictionary of fields, where fields not in arguments get their default, like model_construct() does.
+
+    the attributes are set through the descriptors of BaseModel, which works for frozen models, and is faster than
+    object.__setattr__. the dictionaries are literals of the generated code, so no keys are looked up per row.
+    """
+    namespace = {'new': object.__new__, 'klass': klass}
+    for name in ('__dict__', '__pydantic_fields_set__', '__pydantic_extra__', '__pydantic_private__'):
+        namespace[f'set{name}'] = descriptor(klass, name).__set__
+    parameters = {argument: f'value_{index}' for index, argument in enumerate(arguments)}
+    items = []
+    for index, field in enumerate(fields):
+        if field not in parameters:
+            namespace[f'default_{index}'] = defaults[field]
+        items.append(f"{field!r}: {parameters.get(field, f'default_{index}')}")
+    fields_set = f"{{{', '.join(map(repr, arguments))}}}" if arguments else 'set()'
+    lines = [
+        f"def create({', '.join(parameters.values())}):",
+        "    record = new(klass)",
+        f"    set__dict__(record, {{{', '.join(items)}}})",
+        f"    set__pydantic_fields_set__(record, {fields_set})",
+        "    set__pydantic_extra__(record, None)",
+        "    set__pydantic_private__(record, None)",
+        "    return record",
+    ]
+    exec(compiled(klass, '\n'.join(lines)), namespace)
+    return namespace['create']
+
 
-        # for dataclasses:
-        if hasattr(self.klass, '__dataclass_fields__'):
-            return list(self.klass.__dataclass_fields__.keys())
+# defaults of these types can be shared by all records.
+IMMUTABLE = (type(None), bool, int, float, complex, str, bytes, tuple, frozenset)
 
-        # for pydantic BaseModel:
-        if hasattr(self.klass, '__fields__'):
-            return list(self.klass.__fields__.keys())
 
-        raise RecordClassDefinitionError("Field Names not found.")
+HANDLERS = {
+    'pydantic': RecordPydantic,
+    'namedtuple': RecordNamedTuple,
+    'attrs': RecordAttrs,
+    'msgspec': RecordStruct,
+}
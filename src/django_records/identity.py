@@ -0,0 +1,257 @@
+"""
+Identity maps for nested records.
+
+When an adjunct turns a foreign key into a nested record, every row would create its own copy of the same record.
+Identical wraps such an adjunct, and returns the same record instance for the same key, so memory and construction cost
+scale with the distinct related objects instead of the rows:
+
+    .records(orbits=Ref('orbits_id', Identical(MappedOptionalValue(lambda pk: Orbit(pk)))))
+
+By default, each evaluation of the queryset gets its own EvaluationMap. Pass an IdentityMap to share it between evaluations.
+The records have to be immutable, as they are shared by every row with the same key.
+"""
+import threading
+from collections import OrderedDict
+from copy import copy
+from typing import Callable
+
+from .adjuncts import Adjunct
+
+MISSING = object()
+
+
+class Unhashable:
+    """key of a row without a hashable key, which is only equal to itself."""
+    __slots__ = []
+
+
+class IdentityMap:
+    """
+    maps keys to the record built for them, evicting the least recently used keys beyond maxsize.
+    maxsize None keeps every key, which is fine for querysets with few distinct keys that are not streamed.
+    """
+
+    def __init__(self, maxsize: int | None = 10000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, key, default=None):
+        """returns the record of key, counting a hit, or default."""
+        with self._lock:
+            value = self._entries.get(key, MISSING)
+            if value is MISSING:
+                return default
+            if self.maxsize is not None:
+                self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def store(self, key, value):
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = value
+            if self.maxsize is not None:
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def get(self, key, build: Callable):
+        """returns the record of key, calling build() to create it if it is not known."""
+        value = self.lookup(key, MISSING)
+        if value is MISSING:
+            value = self.store(key, build())
+        return value
+
+    def hit(self, count=1):
+        """counts values served without resolving them, besides the ones of lookup()."""
+        with self._lock:
+            self.hits += count
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else None,
+                'evictions': self.evictions,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+            }
+
+    def __getstate__(self):
+        # the lock can not be pickled, e.g. for the worker processes of parallel(), which get a lock of their own.
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+class EvaluationMap(IdentityMap):
+    """
+    IdentityMap of a single evaluation, which skips the lock and the LRU bookkeeping per lookup, as it does not outlive
+    the evaluation: beyond maxsize, the keys stored first are evicted. the threads of parallel() may share it,
+    their dictionary operations are atomic, but the counts of stats() are approximate then.
+    """
+
+    def __init__(self, maxsize: int | None = 10000):
+        super().__init__(maxsize)
+        self._entries = {}
+
+    def lookup(self, key, default=None):
+        value = self._entries.get(key, MISSING)
+        if value is MISSING:
+            return default
+        self.hits += 1
+        return value
+
+    def store(self, key, value):
+        self.misses += 1
+        entries = self._entries
+        entries[key] = value
+        if self.maxsize is not None:
+            while len(entries) > self.maxsize:
+                try:
+                    del entries[next(iter(entries))]
+                except (KeyError, RuntimeError):
+                    # another thread changed the map meanwhile, the next store evicts.
+                    break
+                self.evictions += 1
+        return value
+
+    def hit(self, count=1):
+        self.hits += count
+
+
+class Identical(Adjunct):
+    """
+    resolves with adjunct, but only once per key, and returns the same value for rows with the same key.
+
+    key is a callable returning the key of the data the adjunct gets, by default that data itself,
+    e.g. the value of the key of a Ref. values without a hashable key are resolved every time.
+    identity_map is shared by all evaluations if given, otherwise every evaluation gets a new EvaluationMap(maxsize).
+    scoped adds the cache_key() of adjunct to the keys, so adjuncts sharing an identity_map do not get each other's values,
+    by default if identity_map is given.
+    """
+    __slots__ = ['adjunct', 'key', 'maxsize', 'identity_map', 'last_map', 'scope']
+
+    def __init__(self, adjunct: Adjunct, key: Callable | None = None, maxsize: int | None = 10000,
+                 identity_map: IdentityMap | None = None, scoped: bool | None = None):
+        self.adjunct = adjunct
+        self.key = key
+        self.maxsize = maxsize
+        self.identity_map = identity_map
+        self.last_map = identity_map  # the map of the latest evaluation, to inspect its stats
+        if scoped is None:
+            scoped = identity_map is not None
+        self.scope = adjunct.cache_key() if scoped else MISSING
+
+    @property
+    def batch(self):
+        return self.adjunct.batch
+
+    @property
+    def asynchronous(self):
+        return self.adjunct.asynchronous
+
+    def bind(self, model):
+        bound = copy(self)
+        bound.adjunct = self.adjunct.bind(model)
+        if self.identity_map is None:
+            bound.identity_map = self.last_map = EvaluationMap(self.maxsize)
+        return bound
+
+    def identify(self, dbdata):
+        key = self.key(dbdata) if self.key is not None else dbdata
+        if self.scope is not MISSING:
+            key = self.scope, key
+        try:
+            hash(key)
+        except TypeError:
+            return MISSING
+        return key
+
+    def resolve(self, model, dbdata):
+        identity_map = self.identity_map if self.identity_map is not None else self.bind(model).identity_map
+        key = self.key(dbdata) if self.key is not None else dbdata
+        if self.scope is not MISSING:
+            key = self.scope, key
+        try:
+            value = identity_map.lookup(key, MISSING)
+        except TypeError:
+            # values without a hashable key are resolved every time.
+            return self.adjunct.resolve(model, dbdata)
+        if value is MISSING:
+            value = identity_map.store(key, self.adjunct.resolve(model, dbdata))
+        return value
+
+    def resolve_batch(self, model, rows):
+        keys, pending, values = self.pending(rows)
+        # only the first row of every unknown key is resolved.
+        resolved = self.adjunct.resolve_batch(model, [rows[index] for index in pending.values()]) if pending else []
+        return self.complete(keys, pending, values, resolved)
+
+    async def resolve_async(self, model, rows):
+        keys, pending, values = self.pending(rows)
+        resolved = await self.adjunct.resolve_async(model, [rows[index] for index in pending.values()]) if pending else []
+        return self.complete(keys, pending, values, resolved)
+
+    def pending(self, rows):
+        """returns the keys of rows, the index of the first row of every unknown key, and the values of the known keys."""
+        identity_map = self.identity_map
+        keys = []
+        pending = {}
+        values = {}
+        for index, dbdata in enumerate(rows):
+            key = self.identify(dbdata)
+            if key is MISSING:
+                # rows without a hashable key are resolved on their own.
+                key = Unhashable()
+                pending[key] = index
+            elif key not in pending and key not in values:
+                value = identity_map.lookup(key, MISSING)
+                if value is MISSING:
+                    pending[key] = index
+                else:
+                    values[key] = value
+            keys.append(key)
+        return keys, pending, values
+
+    def complete(self, keys, pending, values, resolved):
+        identity_map = self.identity_map
+        for key, value in zip(pending, resolved):
+            values[key] = value if isinstance(key, Unhashable) else identity_map.store(key, value)
+        # rows sharing their key with an earlier row of the chunk count as hits as well.
+        identity_map.hit(len(keys) - len(values))
+        return [values[key] for key in keys]
+
+    def values_field(self):
+        return self.adjunct.values_field()
+
+    def dependencies(self):
+        # a key callable may read any key of the row.
+        return self.adjunct.dependencies() if self.key is None else None
+
+    def cache_key(self):
+        return Identical, self.adjunct.cache_key(), self.key
+
+    def cache_models(self, model):
+        return self.adjunct.cache_models(model)
@@ -0,0 +1,172 @@
+"""
+Instrumentation of the records pipeline.
+
+When a receiver is connected to the records_evaluated signal, records querysets of the sender model are evaluated
+phase by phase, and the receiver gets a RecordStats with the timings and counters of every phase:
+fetching each chunk of rows, resolving each adjunct, post-processing and creating the records.
+Without receivers, records() runs its compiled plan as usual, so instrumentation costs nothing when it is not used.
+
+    records_evaluated.connect(receiver, sender=Celestial)
+
+SlowAdjunctLogger is a ready-made receiver, which logs the slowest adjuncts of querysets above a threshold.
+"""
+import logging
+from time import perf_counter
+
+from django.dispatch import Signal
+
+from .errors import RecordInstanceError
+from .plans import RowPlan, chunked
+
+logger = logging.getLogger(f"django_records.{__name__}")
+
+# sent with queryset and stats after a records queryset was iterated, also if it failed or was not consumed.
+records_evaluated = Signal()
+
+
+class RecordStats:
+    """timings in seconds and counters of one evaluation of a records queryset"""
+    __slots__ = ['model', 'rows', 'chunks', 'fetch_times', 'resolve_times', 'prepare_time', 'post_process_time',
+                 'create_time', 'total_time', 'errors']
+
+    def __init__(self, model):
+        self.model = model
+        self.rows = 0  # records yielded
+        self.chunks = 0
+        self.fetch_times = []  # per fetched chunk
+        self.resolve_times = {}  # adjunct key -> total resolve time
+        self.prepare_time = 0.0  # building the row dictionaries
+        self.post_process_time = 0.0
+        self.create_time = 0.0  # handler create, or the whole build of plans without adjuncts to resolve
+        self.total_time = 0.0  # from the start of the iteration to its end, including the time of the consumer
+        self.errors = 0
+
+    @property
+    def fetch_time(self) -> float:
+        return sum(self.fetch_times)
+
+    @property
+    def resolve_time(self) -> float:
+        return sum(self.resolve_times.values())
+
+    def slowest_adjuncts(self, limit=3) -> list[tuple[str, float]]:
+        """the (key, resolve time) of the slowest adjuncts, slowest first."""
+        return sorted(self.resolve_times.items(), key=lambda item: item[1], reverse=True)[:limit]
+
+    def as_dict(self) -> dict:
+        return {
+            'model': self.model._meta.label if self.model is not None else None,
+            'rows': self.rows,
+            'chunks': self.chunks,
+            'fetch_time': self.fetch_time,
+            'fetch_times': list(self.fetch_times),
+            'resolve_time': self.resolve_time,
+            'resolve_times': dict(self.resolve_times),
+            'prepare_time': self.prepare_time,
+            'post_process_time': self.post_process_time,
+            'create_time': self.create_time,
+            'total_time': self.total_time,
+            'errors': self.errors,
+        }
+
+    def __repr__(self):
+        return f"<RecordStats {self.rows} rows in {self.total_time:.6f}s>"
+
+
+def instrumented(model) -> bool:
+    """whether evaluations of records of model are instrumented."""
+    return records_evaluated.has_listeners(model)
+
+
+def send(queryset, stats: RecordStats):
+    for receiver, response in records_evaluated.send_robust(sender=stats.model, queryset=queryset, stats=stats):
+        if isinstance(response, Exception):
+            logger.error("records_evaluated receiver %s failed", receiver, exc_info=response)
+
+
+def instrumented_records(iterable, plan: RowPlan):
+    """yields the records of a RecordIterable like plan would build them, measuring each phase."""
+    stats = RecordStats(plan.model)
+    start = perf_counter()
+    try:
+        yield from measure_phases(iterable, plan, stats)
+    except Exception:
+        stats.errors += 1
+        raise
+    finally:
+        stats.total_time = perf_counter() - start
+        send(iterable.queryset, stats)
+
+
+def measure_phases(iterable, plan: RowPlan, stats: RecordStats):
+    names = plan.names
+    stages = [(key, plan.compile_stage(key, adjunct)) for key, adjunct in plan.adjuncts.items() if adjunct.resolves_field]
+    post_process = plan.compile_post_process()
+    create_chunk = plan.handler.chunk_factory(plan.keys())
+    resolve_times = stats.resolve_times
+    for key, _ in stages:
+        resolve_times[key] = 0.0
+
+    chunks = chunked(iterable.rows(), iterable.chunk_size)
+    while True:
+        started = perf_counter()
+        rows = next(chunks, None)
+        stats.fetch_times.append(perf_counter() - started)
+        if rows is None:
+            break
+
+        if plan.positional:
+            # positional plans have nothing to resolve, the records are built from the row tuples directly.
+            started = perf_counter()
+            records = plan.build_chunk(rows)
+            stats.create_time += perf_counter() - started
+        else:
+            started = perf_counter()
+            chunk = [dict(zip(names, row)) for row in rows]
+            stats.prepare_time += perf_counter() - started
+            for key, stage in stages:
+                started = perf_counter()
+                stage(chunk)
+                resolve_times[key] += perf_counter() - started
+            started = perf_counter()
+            chunk = post_process(chunk)
+            stats.post_process_time += perf_counter() - started
+            started = perf_counter()
+            try:
+                records = create_chunk(chunk)
+            except Exception as e:
+                raise RecordInstanceError("Error creating Record instance") from e
+            stats.create_time += perf_counter() - started
+
+        stats.chunks += 1
+        stats.rows += len(records)
+        yield from records
+
+
+class SlowAdjunctLogger:
+    """
+    logs the slowest adjuncts of every records queryset whose adjuncts took longer than threshold seconds in total.
+
+    slow = SlowAdjunctLogger(threshold=0.05).connect()  # for all models, or connect(sender=Model)
+    """
+
+    def __init__(self, threshold: float = 0.1, limit: int = 3, logger: logging.Logger = logger, level=logging.WARNING):
+        self.threshold = threshold
+        self.limit = limit
+        self.logger = logger
+        self.level = level
+
+    def __call__(self, sender, queryset=None, stats: RecordStats = None, **kwargs):
+        if stats is None or stats.resolve_time < self.threshold:
+            return
+        slowest = ', '.join(f"{key} {seconds * 1000:.1f}ms" for key, seconds in stats.slowest_adjuncts(self.limit))
+        self.logger.log(self.level, "slow adjuncts for %s records: %s (%d rows, %.1fms total)",
+                        stats.model.__name__ if stats.model is not None else None, slowest, stats.rows,
+                        stats.total_time * 1000)
+
+    def connect(self, sender=None):
+        records_evaluated.connect(self, sender=sender, weak=False)
+        return self
+
+    def disconnect(self, sender=None):
+        records_evaluated.disconnect(self, sender=sender)
@@ -0,0 +1,175 @@
+"""
+Nested records of forward foreign keys and one-to-one relations, in the same query.
+
+Nested is the select_related equivalent for records(): the fields of the related record are added to the
+values() call as relation__field columns, so they are fetched with a JOIN in the same query,
+and the nested record is built from these columns of the row. A NULL relation resolves to None.
+
+    @dataclass
+    class PlanetRecord:
+        id: int
+        name: str
+        orbits: CelestialRecord | None = None
+
+    Celestial.objects.record_into(PlanetRecord).records()
+
+records() detects fields of the record, which are forward relations on the model and annotated with a record type,
+and nests them automatically, one level deep by default. queryset.nested(depth) changes the depth, 0 disables it.
+Nested can also be given explicitly, e.g. .records(orbits=Nested(CelestialRecord, depth=2)).
+"""
+import types
+import typing
+from typing import Union
+
+from django.core.exceptions import FieldDoesNotExist
+
+from .adjuncts import Adjunct
+from .errors import RecordClassDefinitionError
+from .handlers import RecordDataclass, RecordHandler, handler_key
+from .registry import registry
+
+
+def record_type(annotation):
+    """the record class of an annotation, e.g. of Record or Record | None, or None if it is not a record type."""
+    if typing.get_origin(annotation) in (Union, types.UnionType):
+        candidates = typing.get_args(annotation)
+    else:
+        candidates = (annotation,)
+    for candidate in candidates:
+        if not isinstance(candidate, type) or candidate is type(None):
+            continue
+        try:
+            registry.describe(candidate)
+        except RecordClassDefinitionError:
+            continue
+        return candidate
+    return None
+
+
+def record_annotations(klass) -> dict:
+    """field name -> annotation of a record class, empty if its annotations can not be resolved."""
+    try:
+        return typing.get_type_hints(klass)
+    except Exception:
+        return {}
+
+
+def forward_relation(model, name):
+    """the field name of model, if it is a forward foreign key or one-to-one relation, otherwise None."""
+    try:
+        field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+    if field.is_relation and field.concrete and (field.many_to_one or field.one_to_one):
+        return field
+    return None
+
+
+def nested_relations(model, handler: RecordHandler, depth: int) -> dict:
+    """
+    key -> Nested for the fields of the record of handler, which are forward relations on model annotated with a record type.
+    """
+    if depth < 1 or model is None:
+        return {}
+    annotations = record_annotations(handler.record)
+    nested = {}
+    for name in handler.get_field_names():
+        into = record_type(annotations.get(name))
+        if into is not None and forward_relation(model, name) is not None:
+            nested[name] = Nested(into, depth=depth)
+    return nested
+
+
+class Nested(Adjunct):
+    """
+    resolves to the record of a forward foreign key or one-to-one relation, fetched in the same query.
+
+    into is the record class or RecordHandler of the nested record, by default the annotation of the field.
+    relation is the name of the relation on the model, by default the key of the adjunct.
+    depth is how many levels of nested records are built, relations of the nested record are nested while depth > 1.
+    """
+    __slots__ = ['into', 'relation', 'depth', 'path', 'check', 'columns', 'children', 'create', 'trusted']
+
+    def __init__(self, into=None, relation: str | None = None, depth: int = 1):
+        self.into = into
+        self.relation = relation
+        self.depth = depth
+        self.path = None  # relation path in values(), once attached to a queryset
+        self.trusted = False  # whether the records are created like the ones of a trusted handler, once attached
+
+    def attach(self, model, key, handler):
+        into = self.into
+        if into is None:
+            into = record_type(record_annotations(handler.record).get(key))
+            if into is None:
+                raise RecordClassDefinitionError(f"Nested {key} without destination class.")
+        return self.expand(model, self.relation or key, '', into, self.depth, handler.trusted)
+
+    def expand(self, model, relation, prefix, into, depth, trusted):
+        """returns a copy of this adjunct, with the columns of the nested record of relation on model."""
+        field = forward_relation(model, relation)
+        if field is None:
+            raise RecordClassDefinitionError(f"Nested needs a foreign key or one-to-one relation, {relation} is neither.")
+        related = field.related_model
+        handler = into if isinstance(into, RecordHandler) else RecordDataclass.wrap(into, trusted=trusted)
+        path = f'{prefix}{relation}'
+        annotations = record_annotations(handler.record)
+        meta = getattr(handler, 'meta', None)
+        required = set(meta.required) if meta is not None else set()
+
+        columns = []
+        children = []
+        for name in handler.get_field_names():
+            nested_into = record_type(annotations.get(name))
+            if nested_into is not None and forward_relation(related, name) is not None:
+                if depth > 1:
+                    child = Nested(nested_into, depth=depth - 1)
+                    children.append((name, child.expand(related, name, f'{path}__', nested_into, depth - 1, trusted)))
+                    continue
+                if name not in required:
+                    # beyond depth, optional nested records keep their default instead of the key of the relation.
+                    continue
+            try:
+                related._meta.get_field(name)
+            except FieldDoesNotExist:
+                # optional fields without a column keep their default, required ones fail in values() like in records().
+                if name not in required:
+                    continue
+            columns.append((name, f'{path}__{name}'))
+
+        bound = Nested(self.into, self.relation, depth)
+        bound.path = path
+        bound.trusted = handler.trusted
+        # the primary key column of the related table is NULL exactly when the relation is.
+        pk_name = related._meta.pk.name
+        bound.check = next((column for name, column in columns if name == pk_name), path)
+        bound.columns = tuple(columns)
+        bound.children = tuple(children)
+        bound.create = handler.factory((*(name for name, _ in columns), *(name for name, _ in children)))
+        return bound
+
+    def resolve(self, model, dbdata):
+        if self.path is None:
+            raise RecordClassDefinitionError("Nested has to be passed to records().")
+        if dbdata[self.check] is None:
+            return None
+        data = {name: dbdata[column] for name, column in self.columns}
+        for name, child in self.children:
+            data[name] = child.resolve(model, dbdata)
+        return self.create(data)
+
+    def values_field(self):
+        if self.path is None:
+            return None
+        fields = [column for _, column in self.columns]
+        if self.check not in fields:
+            fields.append(self.check)
+        for _, child in self.children:
+            fields.extend(child.values_field())
+        return fields
+
+    def dependencies(self):
+        return set(self.values_field() or ())
+
+    def cache_key(self):
+        return Nested, handler_key(self.into), self.relation, self.depth, self.trusted
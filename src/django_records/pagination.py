@@ -0,0 +1,53 @@
+"""
+Keyset pagination of records querysets.
+
+records_in_batches() walks a table page by page with WHERE key > last ORDER BY key LIMIT n, instead of OFFSET
+or a server-side cursor, so every page costs the same and only one page of records is held in memory.
+The row plan is compiled once, and reused for every page.
+
+    for batch in Celestial.objects.record_into(SizedRock).records_in_batches(batch_size=10000):
+        process(batch)
+        save(batch.checkpoint)  # resume later with records_in_batches(batch_size=10000, after=checkpoint)
+
+key is a field name, or a sequence of field names for composite keys, '-name' for descending order.
+The primary key is added as the last key if it is missing, so the key is unique, and the keys must not be NULL.
+"""
+from django.db.models import Q
+
+KEY_PREFIX = 'django_records_page_key_'
+
+
+class RecordBatch(list):
+    """records of one page, with the checkpoint to resume after the page."""
+    __slots__ = ['checkpoint']
+
+    def __init__(self, records=(), checkpoint=None):
+        super().__init__(records)
+        self.checkpoint = checkpoint  # tuple of the key values of the last record
+
+
+def ordering_keys(model, key) -> list[tuple[str, bool]]:
+    """(field name, descending) of the keys, ending with the primary key."""
+    names = [key] if isinstance(key, str) else list(key)
+    keys = [(name[1:], True) if name.startswith('-') else (name, False) for name in names]
+    if not any(name in ('pk', model._meta.pk.name, model._meta.pk.attname) for name, _ in keys):
+        keys.append(('pk', False))
+    return keys
+
+
+def keyset_filter(keys, values) -> Q:
+    """the rows after values in the order of keys: k0 > v0 or (k0 = v0 and k1 > v1) or ..."""
+    condition = Q()
+    equal = {}
+    for (name, descending), value in zip(keys, values):
+        condition |= Q(**equal, **{f'{name}__{"lt" if descending else "gt"}': value})
+        equal[name] = value
+    return condition
+
+
+def checkpoint_values(keys, after) -> tuple:
+    """the key values of a checkpoint, which can be a single value for a single key."""
+    values = tuple(after) if isinstance(after, (list, tuple)) else (after,)
+    if len(values) != len(keys):
+        raise ValueError(f"Checkpoint {after!r} does not match the keys {[name for name, _ in keys]}.")
+    return values
@@ -0,0 +1,149 @@
+"""
+Building records in a pool of threads or processes.
+
+Adjuncts and post-processors with real CPU work, e.g. parsing, geometry or hashing, run one row at a time
+in the thread iterating the queryset. queryset.parallel() hands each fetched chunk of rows to a pool instead,
+while the rows are still fetched in the iterating thread, which keeps the database connection where it belongs:
+
+    for record in Celestial.objects.records(shape=Ref('geometry', parse_geometry)).parallel(workers=4):
+        ...
+
+The records are yielded in the order of the rows, and at most prefetch chunks are fetched ahead of the one yielded.
+
+With executor='thread', the workers share the row plan, so per evaluation state, e.g. identity maps, is shared as well.
+Threads only run Python callbacks at the same time on free-threaded builds, or for callbacks releasing the GIL,
+e.g. in C extensions. With executor='process', the handler and the adjuncts are pickled, and every worker process
+builds its own row plan, so callbacks have to be importable functions, records picklable, and adjuncts must not
+use the database. An Executor can be passed instead, to reuse a pool between evaluations.
+
+Errors are raised as RecordInstanceError, with the index of the failing row, or of the chunk for batched plans.
+"""
+import os
+import pickle
+import reprlib
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from uuid import uuid4
+
+from .errors import RecordClassDefinitionError, RecordInstanceError
+from .plans import RowPlan, chunked
+
+EXECUTORS = ('thread', 'process')
+
+# row plans of the evaluations a worker process took part in, by token.
+process_plans = {}
+PROCESS_PLANS_SIZE = 8
+
+
+def parallel_options(workers: int | None, executor, chunk_size: int, prefetch: int | None) -> tuple:
+    """the (workers, executor, chunk_size, prefetch) of queryset.parallel(), with their defaults."""
+    if not (executor in EXECUTORS or isinstance(executor, Executor)):
+        raise ValueError(f"executor has to be one of {EXECUTORS} or an Executor, not {executor!r}.")
+    workers = workers or os.cpu_count() or 1
+    if workers < 1 or chunk_size < 1:
+        raise ValueError("parallel() needs at least one worker and one row per chunk.")
+    return workers, executor, chunk_size, prefetch or workers * 2
+
+
+def describe_error(e: Exception) -> str:
+    cause = e.__cause__
+    if isinstance(e, RecordInstanceError) and cause is not None:
+        # the message of the RecordInstanceError of the plan says less than its cause.
+        e = cause
+    return f"{type(e).__name__}: {e}"
+
+
+def build_chunk(plan: RowPlan, rows: list, offset: int) -> list:
+    """the records of a chunk of rows, starting at row offset, with the failing row in errors."""
+    if plan.batched:
+        try:
+            return plan.build_chunk(rows)
+        except Exception as e:
+            raise RecordInstanceError(
+                f"Error building the records of rows {offset} to {offset + len(rows) - 1}: {describe_error(e)}") from e
+    build = plan.build
+    records = []
+    for index, row in enumerate(rows, offset):
+        try:
+            records.append(build(row))
+        except Exception as e:
+            raise RecordInstanceError(f"Error building the record of row {index} {reprlib.repr(row)}: {describe_error(e)}") from e
+    return records
+
+
+def build_in_process(token: str, payload: bytes, rows: list, offset: int) -> list:
+    """build_chunk() in a worker process, with the row plan of the evaluation token, unpickled once per process."""
+    plan = process_plans.get(token)
+    if plan is None:
+        if len(process_plans) >= PROCESS_PLANS_SIZE:
+            process_plans.clear()
+        plan = process_plans[token] = RowPlan(*pickle.loads(payload))
+    return build_chunk(plan, rows, offset)
+
+
+def process_payload(plan: RowPlan, adjuncts: dict) -> bytes:
+    """the pickled arguments of the row plan, with the adjuncts before they were bound to the evaluation."""
+    try:
+        return pickle.dumps((plan.model, plan.names, plan.handler, adjuncts))
+    except Exception as e:
+        raise RecordClassDefinitionError(
+            f"parallel(executor='process') can not pickle {unpicklable(plan, adjuncts)}: {describe_error(e)}") from e
+
+
+def unpicklable(plan: RowPlan, adjuncts: dict) -> str:
+    """names the part of the payload that can not be pickled, down to the attribute of an adjunct."""
+    parts = [('the model', plan.model), ('the record handler', plan.handler)]
+    parts.extend((f"the {type(adjunct).__name__} of {key}", adjunct) for key, adjunct in adjuncts.items())
+    for name, part in parts:
+        if not picklable(part):
+            for attribute, value in attributes(part):
+                if not picklable(value):
+                    return f"{attribute} of {name}"
+            return name
+    return 'the row plan'
+
+
+def picklable(value) -> bool:
+    try:
+        pickle.dumps(value)
+    except Exception:
+        return False
+    return True
+
+
+def attributes(value) -> list[tuple]:
+    """the attributes of value, in its __slots__ and its __dict__."""
+    names = [name for base in type(value).__mro__ for name in getattr(base, '__slots__', ())]
+    names.extend(getattr(value, '__dict__', ()))
+    return [(name, getattr(value, name)) for name in names if hasattr(value, name)]
+
+
+def parallel_records(plan: RowPlan, rows, adjuncts: dict, workers: int, executor, chunk_size: int, prefetch: int):
+    """yields the records plan builds from rows, in order, building chunks of them in a pool. see parallel()."""
+    if executor == 'process' or isinstance(executor, ProcessPoolExecutor):
+        token = uuid4().hex
+        payload = process_payload(plan, adjuncts)
+        work = lambda chunk, offset: pool.submit(build_in_process, token, payload, chunk, offset)
+    else:
+        work = lambda chunk, offset: pool.submit(build_chunk, plan, chunk, offset)
+
+    owned = not isinstance(executor, Executor)
+    if owned:
+        pool = ProcessPoolExecutor(workers) if executor == 'process' else ThreadPoolExecutor(workers, 'django_records')
+    else:
+        pool = executor
+    pending = deque()
+    try:
+        offset = 0
+        for chunk in chunked(rows, chunk_size):
+            pending.append(work(chunk, offset))
+            offset += len(chunk)
+            if len(pending) > prefetch:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        if owned:
+            pool.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,286 @@
+"""
+Row plans compile everything records() knows about a result set into one callable.
+
+The column names, the adjunct resolution order, the post-processors and the target field filter
+are the same for every row of a queryset, so they are worked out once when iteration starts,
+and the per row loop only has to call the compiled build function.
+
+If no adjunct needs a dictionary view of the row, and the handler can take positional arguments,
+the record is built straight from the row tuple, skipping the intermediate dictionary.
+
+Adjuncts with batch support are resolved once per chunk of rows, see RowPlan.build_chunk,
+as are the records of handlers with batch support, e.g. pydantic models validated a chunk at a time,
+and asynchronous adjuncts are awaited once per chunk, see RowPlan.abuild_chunk.
+"""
+from itertools import islice
+from operator import itemgetter
+
+from asgiref.sync import async_to_sync, sync_to_async
+
+from .errors import RecordInstanceError
+from .handlers import RecordHandler
+
+
+def chunked(rows, size):
+    """groups an iterator of rows into lists of size rows."""
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+class RowPlan:
+    """
+    compiled plan to turn database rows into records.
+
+    names are the result columns in row order, handler the RecordHandler of the target,
+    and adjuncts the dictionary of adjuncts records() stored on the queryset.
+    """
+    __slots__ = ['model', 'names', 'handler', 'adjuncts', 'resolvers', 'post_processors', 'positional', 'batched',
+                 'asynchronous', 'build', 'build_chunk']
+
+    def __init__(self, model, names, handler: RecordHandler, adjuncts: dict):
+        self.model = model
+        self.names = tuple(names)
+        self.handler = handler
+        # adjuncts with state per evaluation, e.g. identity maps, get it here.
+        self.adjuncts = adjuncts = {k: v.bind(model) for k, v in adjuncts.items()}
+        # adjuncts are resolved in the order they were given to records(), post-processors run afterwards.
+        self.resolvers = tuple((k, v.resolve) for k, v in adjuncts.items() if v.resolves_field)
+        self.post_processors = tuple(v.post_process for v in adjuncts.values() if v.post_processing)
+        self.positional = False
+        self.asynchronous = any(v.asynchronous for v in adjuncts.values() if v.resolves_field)
+        # handlers with batch support create the records of a whole chunk at once.
+        self.batched = self.asynchronous or handler.batch or any(v.batch for v in adjuncts.values() if v.resolves_field)
+        self.build = self.compile()
+        self.build_chunk = self.compile_chunk()
+
+    def __call__(self, row):
+        return self.build(row)
+
+    def keys(self) -> tuple[str, ...] | None:
+        """the keys of the dictionary handed to the handler, or None if post-processors may rewrite it."""
+        if self.post_processors:
+            return None
+        return tuple(dict.fromkeys([*self.names, *(k for k, _ in self.resolvers)]))
+
+    def compile(self):
+        """returns the build function specialized for this plan."""
+        build = self.compile_positional()
+        if build is not None:
+            self.positional = True
+            return build
+        return self.compile_dict()
+
+    def compile_chunk(self):
+        """returns a function building the list of records of a chunk of rows."""
+        build = self.build
+        if not self.batched:
+            return lambda rows: list(map(build, rows))
+
+        names = self.names
+        stages = [self.compile_stage(k, v) for k, v in self.adjuncts.items() if v.resolves_field]
+        finish = self.compile_finish()
+
+        def build_chunk(rows):
+            chunk = [dict(zip(names, row)) for row in rows]
+            # every adjunct resolves the whole chunk before the next one, which keeps the order of resolution per row.
+            for stage in stages:
+                stage(chunk)
+            return finish(chunk)
+        return build_chunk
+
+    def compile_prepare(self):
+        """returns a function resolving a chunk of rows into the dictionaries the handler would be called with."""
+        names = self.names
+        stages = [self.compile_stage(k, v) for k, v in self.adjuncts.items() if v.resolves_field]
+        post_process = self.compile_post_process()
+
+        def prepare(rows):
+            chunk = [dict(zip(names, row)) for row in rows]
+            for stage in stages:
+                stage(chunk)
+            return post_process(chunk)
+        return prepare
+
+    def compile_stage(self, key, adjunct):
+        """returns a function resolving key with adjunct for a whole chunk of row dictionaries."""
+        model = self.model
+        if adjunct.asynchronous:
+            resolve_batch = async_to_sync(adjunct.resolve_async)
+        elif adjunct.batch:
+            resolve_batch = adjunct.resolve_batch
+        else:
+            resolve = adjunct.resolve
+
+            def stage(chunk):
+                for dbdata in chunk:
+                    dbdata[key] = resolve(model, dbdata)
+            return stage
+
+        def stage(chunk):
+            for dbdata, value in zip(chunk, resolve_batch(model, chunk)):
+                dbdata[key] = value
+        return stage
+
+    def compile_post_process(self):
+        """returns a function running the post-processors over a chunk of row dictionaries."""
+        model = self.model
+        post_processors = self.post_processors
+        if not post_processors:
+            return lambda chunk: chunk
+
+        def post_process_chunk(chunk):
+            processed_chunk = []
+            for dbdata in chunk:
+                for post_process in post_processors:
+                    processed = post_process(model, dbdata)
+                    if processed is not None:
+                        dbdata = processed
+                processed_chunk.append(dbdata)
+            return processed_chunk
+        return post_process_chunk
+
+    def compile_finish(self):
+        """returns a function running the post-processors and creating the records of a chunk of row dictionaries."""
+        post_process = self.compile_post_process()
+        create_chunk = self.handler.chunk_factory(self.keys())
+
+        def finish(chunk):
+            chunk = post_process(chunk)
+            try:
+                return create_chunk(chunk)
+            except Exception as e:
+                raise RecordInstanceError("Error creating Record instance") from e
+        return finish
+
+    async def abuild_chunk(self, rows):
+        """
+        builds the records of a chunk of rows without blocking the event loop.
+
+        synchronous work runs in the thread of sync_to_async, asynchronous adjuncts are awaited in the event loop.
+        """
+        if not self.asynchronous:
+            return await sync_to_async(self.build_chunk)(rows)
+
+        names = self.names
+        chunk = []
+
+        def run(stages):
+            for stage in stages:
+                stage(chunk)
+
+        # synchronous stages are collected, and run in one call to the sync thread before the next await.
+        pending = [lambda chunk: chunk.extend(dict(zip(names, row)) for row in rows)]
+        for key, adjunct in self.adjuncts.items():
+            if not adjunct.resolves_field:
+                continue
+            if not adjunct.asynchronous:
+                pending.append(self.compile_stage(key, adjunct))
+                continue
+            await sync_to_async(run)(pending)
+            pending = []
+            for dbdata, value in zip(chunk, await adjunct.resolve_async(self.model, chunk)):
+                dbdata[key] = value
+        finish = self.compile_finish()
+
+        def complete():
+            run(pending)
+            return finish(chunk)
+        return await sync_to_async(complete)()
+
+    def compile_positional(self):
+        """returns a build function that passes row values positionally, or None if this plan needs the dict path."""
+        if self.post_processors:
+            return None
+        adjuncts = [(k, v) for k, v in self.adjuncts.items() if v.resolves_field]
+        if not all(v.positional for _, v in adjuncts):
+            return None
+
+        # sources are either ('column', index) or ('constant', value), following the resolution order.
+        sources = {name: ('column', index) for index, name in enumerate(self.names)}
+        for key, adjunct in adjuncts:
+            source_key, value = adjunct.row_source()
+            if source_key is None:
+                sources[key] = ('constant', value)
+            else:
+                sources[key] = sources.get(source_key, ('constant', None))
+
+        positional = self.handler.positional(sources.keys())
+        if positional is None:
+            return None
+        arguments, create = positional
+
+        constants = []
+        indexes = []
+        for argument in arguments:
+            kind, value = sources[argument]
+            if kind == 'column':
+                indexes.append(value)
+            else:
+                indexes.append(len(self.names) + len(constants))
+                constants.append(value)
+        constants = tuple(constants)
+
+        if not indexes:
+            def build(row):
+                try:
+                    return create()
+                except Exception as e:
+                    raise RecordInstanceError("Error creating Record instance") from e
+        elif constants:
+            getter = itemgetter(*indexes) if len(indexes) > 1 else lambda row: (row[indexes[0]],)
+
+            def build(row):
+                try:
+                    return create(*getter((*row, *constants)))
+                except Exception as e:
+                    raise RecordInstanceError("Error creating Record instance") from e
+        elif len(indexes) == 1:
+            index = indexes[0]
+
+            def build(row):
+                try:
+                    return create(row[index])
+                except Exception as e:
+                    raise RecordInstanceError("Error creating Record instance") from e
+        else:
+            getter = itemgetter(*indexes)
+
+            def build(row):
+                try:
+                    return create(*getter(row))
+                except Exception as e:
+                    raise RecordInstanceError("Error creating Record instance") from e
+        return build
+
+    def compile_dict(self):
+        """returns a build function that creates the row dictionary and lets adjuncts work on it."""
+        model = self.model
+        names = self.names
+        resolvers = self.resolvers
+        post_processors = self.post_processors
+        create = self.handler.factory(self.keys())
+
+        if not resolvers and not post_processors:
+            def build(row):
+                try:
+                    return create(dict(zip(names, row)))
+                except Exception as e:
+                    raise RecordInstanceError("Error creating Record instance") from e
+            return build
+
+        def build(row):
+            dbdata = dict(zip(names, row))
+            # we overwrite db data bluntly for now. actually we would provide callbacks the current dict.
+            for key, resolve in resolvers:
+                dbdata[key] = resolve(model, dbdata)
+            # post-processors will be able to rewrite the whole dictionary.
+            for post_process in post_processors:
+                processed = post_process(model, dbdata)
+                if processed is not None:
+                    dbdata = processed
+            try:
+                return create(dbdata)
+            except Exception as e:
+                raise RecordInstanceError("Error creating Record instance") from e
+        return build
@@ -0,0 +1,83 @@
+"""
+Records from hand-written SQL.
+
+Queries with window functions, common table expressions or anything else values() can not express still get records,
+built by the same row plans as records(), instead of tuples turned into records by hand:
+
+    ranked = Celestial.objects.raw_records(
+        "SELECT id, name, RANK() OVER (ORDER BY size DESC) AS position FROM app_celestial WHERE orbits_id = %s",
+        [sun.pk], into=RankedBody, size_class=Ref('position', classify))
+
+cursor_records() does the same for a cursor with an executed query. The column names are taken from
+cursor.description, and the rows are fetched with fetchmany() in chunks of chunk_size, without RawQuerySet
+or model instances. Adjuncts work as in records(), but nothing is added to the SELECT for them,
+so the columns they read, e.g. the key of a Ref, have to be selected by the SQL.
+
+With a model, the columns named like a field of the model, by column or attname, are converted like RawQuerySet does,
+with the converters of the database backend and of the field, e.g. from_db_value(). The other columns, and all of them
+without a model, are the values of the cursor as they are, e.g. strings for dates on SQLite.
+"""
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.models.sql import Query
+
+from .adjuncts import Adjunct
+from .errors import RecordClassDefinitionError
+from .handlers import RecordDataclass, RecordHandler
+from .plans import RowPlan
+
+
+def raw_adjuncts(model, handler: RecordHandler, kwargs: dict) -> dict:
+    """the adjuncts of kwargs, attached like records() does. raw SQL has no expressions to add."""
+    adjuncts = {}
+    for key, adjunct in kwargs.items():
+        if adjunct is None:
+            continue
+        if not isinstance(adjunct, Adjunct):
+            raise RecordClassDefinitionError(f"Raw records take adjuncts only, {key} is {adjunct!r}.")
+        adjunct = adjunct.attach(model, key, handler)
+        if not adjunct.skip:
+            adjuncts[key] = adjunct
+    return adjuncts
+
+
+def field_converters(model, names: list, using: str):
+    """the SQLCompiler of model on the database using, and its converters for the columns of names matching a field."""
+    connection = connections[using]
+    fields = {}
+    for field in model._meta.concrete_fields:
+        fields.setdefault(field.column, field)
+        fields.setdefault(field.attname, field)
+    compiler = connection.ops.compiler('SQLCompiler')(Query(model), connection, using)
+    columns = [fields[name].get_col(model._meta.db_table) if name in fields else None for name in names]
+    return compiler, compiler.get_converters(columns)
+
+
+def cursor_records(cursor, into, model=None, chunk_size: int = 2000, using: str | None = None, **kwargs):
+    """
+    yields the records of the rows of an executed cursor, fetched with fetchmany(chunk_size).
+    into is the record class or RecordHandler, model is passed to the adjuncts, kwargs are adjuncts.
+    with model, the columns of its fields are converted for the database using, by default the one of a Django cursor.
+    """
+    handler = into if isinstance(into, RecordHandler) else RecordDataclass.wrap(into)
+    if cursor.description is None:
+        raise RecordClassDefinitionError("Raw records need a query returning rows.")
+    names = [column[0] for column in cursor.description]
+    plan = RowPlan(model, names, handler, raw_adjuncts(model, handler, kwargs))
+    converters = None
+    if model is not None:
+        using = using or getattr(getattr(cursor, 'db', None), 'alias', DEFAULT_DB_ALIAS)
+        compiler, converters = field_converters(model, names, using)
+    while rows := cursor.fetchmany(chunk_size):
+        if converters:
+            rows = list(compiler.apply_converters(rows, converters))
+        if plan.batched:
+            yield from plan.build_chunk(rows)
+        else:
+            yield from map(plan.build, rows)
+
+
+def raw_records(sql: str, params=None, into=None, model=None, using: str = 'default', chunk_size: int = 2000, **kwargs):
+    """yields the records of sql with params, run on the database using, see cursor_records()."""
+    with connections[using].cursor() as cursor:
+        cursor.execute(sql, params)
+        yield from cursor_records(cursor, into, model, chunk_size, using, **kwargs)
@@ -1,16 +1,32 @@
+import asyncio
 import logging
+from copy import copy
+from time import perf_counter
 
-from django.db.models import QuerySet, Model
-from django.db.models.expressions import BaseExpression, Combinable
+from asgiref.sync import sync_to_async
+
+from django.db import connections
+from django.db.models import F, QuerySet
 from django.db.models.manager import Manager
 from django.db.models.query import ValuesIterable
 
-from .adjuncts import Adjunct
-from .handlers import RecordDataclass, RecordHandler
+from .bulk import WriteResult, save_records
+from .cache import RecordCache, record_cache
+from .handlers import RecordDataclass, RecordHandler, queryset_handler
+from .columns import collect_columns
+from .instrumentation import RecordStats, instrumented, instrumented_records, send
+from .specs import RecordSpec, compile_records
+from .parallel import parallel_options, parallel_records
+from .raw import raw_records
+from .pagination import KEY_PREFIX, RecordBatch, checkpoint_values, keyset_filter, ordering_keys
+from .plans import RowPlan, chunked
+from .related import KeyedRecord
+from .trees import records_tree
 from .errors import RecordClassDefinitionError, RecordInstanceError
 
 logger = logging.getLogger(f"django_records.{__name__}")
 
+
 class RecordIterable(ValuesIterable):
     """
     Iterable returned by records() that yields a record class for each row.
@@ -18,52 +34,238 @@ class RecordIterable(ValuesIterable):
     """
 
     def __iter__(self):
+        cached = getattr(self.queryset, '_record_cache', None)
+        if cached is not None:
+            cache, ttl, key = cached
+            return iter(cache.evaluate(self, ttl, key))
+        plan = self.plan()
+        if instrumented(plan.model):
+            return instrumented_records(self, plan)
+        return self.build(plan, self.rows())
+
+    def build(self, plan: RowPlan, rows):
+        """yields the records built by plan from rows."""
+        parallel = getattr(self.queryset, '_record_parallel', None)
+        if parallel is not None:
+            # chunks of rows are built in a pool, see parallel().
+            yield from parallel_records(plan, rows, getattr(self.queryset, '_record_kwargs', {}), *parallel)
+        elif plan.batched:
+            # batch adjuncts are resolved once per fetched chunk.
+            for chunk in chunked(rows, self.chunk_size):
+                yield from plan.build_chunk(chunk)
+        else:
+            yield from map(plan.build, rows)
+
+    async def _async_generator(self):
+        # rows are fetched in chunks in the sync thread, and the next chunk is already fetched
+        # while the records of the current chunk are built and asynchronous adjuncts are awaited.
+        if getattr(self.queryset, '_record_cache', None) is not None:
+            for record in await sync_to_async(list)(self):
+                yield record
+            return
+        plan = self.plan()
+        # instrumented async iteration measures the wait for each chunk as fetch time, and building it as create time.
+        stats = RecordStats(plan.model) if instrumented(plan.model) else None
+        began = start = perf_counter()
+        chunks = await sync_to_async(lambda: chunked(self.rows(), self.chunk_size))()
+        fetch = sync_to_async(next)
+        pending = asyncio.ensure_future(fetch(chunks, None))
+        try:
+            while (rows := await pending) is not None:
+                pending = asyncio.ensure_future(fetch(chunks, None))
+                if stats is None:
+                    records = await plan.abuild_chunk(rows)
+                else:
+                    stats.fetch_times.append(perf_counter() - start)
+                    started = perf_counter()
+                    records = await plan.abuild_chunk(rows)
+                    stats.create_time += perf_counter() - started
+                    stats.chunks += 1
+                    stats.rows += len(records)
+                for record in records:
+                    yield record
+                start = perf_counter()
+        except Exception:
+            if stats is not None:
+                stats.errors += 1
+            raise
+        finally:
+            if not pending.done():
+                pending.cancel()
+            await sync_to_async(chunks.close)()
+            if stats is not None:
+                stats.total_time = perf_counter() - began
+                await sync_to_async(send)(self.queryset, stats)
+
+    def rows(self):
+        """executes the query and returns the iterator over its rows."""
         queryset: QuerySet = self.queryset
-        model: Model = self.queryset.model
-        query = queryset.query
-        compiler = query.get_compiler(queryset.db)
-        record_data = getattr(queryset, '_record_kwargs', {})
-        record_handler = queryset._record
+        compiler = queryset.query.get_compiler(queryset.db)
+        return compiler.results_iter(chunked_fetch=self.chunked_fetch, chunk_size=self.chunk_size)
 
+    def plan(self) -> RowPlan:
+        """compiles the row plan for the queryset of this iterable."""
+        queryset: QuerySet = self.queryset
+        query = queryset.query
         # extra(select=...) cols are always at the start of the row.
         names = [
             *query.extra_select,
             *query.values_select,
             *query.annotation_select,
         ]
-        indexes = range(len(names))
-
-        for row in compiler.results_iter(chunked_fetch=self.chunked_fetch, chunk_size=self.chunk_size):
-            dbdata = {names[i]: row[i] for i in indexes}
-
-            # post-processors will be able to rewrite the whole dictionary.
-            post_processors = []
-            # we overwrite db data bluntly for now. actually we would provide callbacks the current dict.
-            for k, v in record_data.items():
-                if v.resolves_field:
-                    dbdata[k] = v.resolve(model, dbdata)
-                if v.post_processing:
-                    post_processors.append(v)
-            if post_processors:
-                for processor in post_processors:
-                    processed = processor.post_process(model, dbdata)
-                    if processed is not None:
-                        dbdata = processed
-            try:
-                record = record_handler.create(**dbdata)
-            except Exception as e:
-                raise RecordInstanceError("Error creating Record instance") from e
-            
-            yield record
+        return RowPlan(queryset.model, names, queryset._record, getattr(queryset, '_record_kwargs', {}))
+
+
+def streaming_iterable(queryset, chunk_size=2000) -> RecordIterable:
+    """returns a RecordIterable over queryset, fetching in chunks like iterator() does."""
+    use_chunked_fetch = not connections[queryset.db].settings_dict.get("DISABLE_SERVER_SIDE_CURSORS")
+    return RecordIterable(queryset, chunked_fetch=use_chunked_fetch, chunk_size=chunk_size)
 
 
 class RecordQuerySetMixin:
     _record_handler = RecordDataclass
 
-    def record_into(self, handler):
+    def record_into(self, handler, trusted=False):
+        """
+        sets the record class, RecordHandler or RecordSpec records() creates.
+        with trusted=True, the handler may skip validation and __init__ logic, e.g. __post_init__ of dataclasses.
+        """
+        if isinstance(handler, RecordSpec):
+            self._record = handler.handler
+            self._record_spec = handler
+            return self
+        self._record_spec = None
+        if trusted:
+            if isinstance(handler, RecordHandler):
+                handler = copy(handler)
+                handler.trusted = True
+            else:
+                handler = self._record_handler.wrap(handler, trusted=True)
         self._record = handler
         return self
 
+    def cached(self, ttl: float | None = None, key=None, cache: RecordCache | None = None):
+        """
+        keeps the evaluated records in a RecordCache, and takes them from there while the entry is valid.
+
+        ttl is in seconds, by default the timeout of the cache. key replaces the key computed from the query,
+        the handler and the adjuncts, e.g. for adjuncts with inline lambdas. cache defaults to cache.record_cache.
+        """
+        clone = self.all()
+        clone._record_cache = (cache if cache is not None else record_cache, ttl, key)
+        return clone
+
+    def parallel(self, workers: int | None = None, executor='thread', chunk_size: int = 500, prefetch: int | None = None):
+        """
+        builds the records of chunks of chunk_size rows in a pool of workers, by default one per CPU,
+        for adjuncts and post-processors with CPU heavy callbacks. rows are still fetched by the iterating thread.
+
+        executor is 'thread', 'process', or an Executor to reuse. prefetch limits the chunks fetched ahead of the
+        records yielded, by default two per worker. instrumented querysets and async iteration build serially.
+        see parallel for the restrictions of each executor.
+        """
+        clone = self.all()
+        clone._record_parallel = parallel_options(workers, executor, chunk_size, prefetch)
+        return clone
+
+    def nested(self, depth: int = 1):
+        """
+        sets how many levels of nested records records() builds for forward relations annotated with a record type.
+        0 disables nesting, and the fields get the value of the relation column as before. see nested.Nested.
+        """
+        clone = self.all()
+        clone._record_depth = depth
+        return clone
+
+    def records_tree(self, parent_field: str, *args, children: str | None = None, root=None, container=tuple,
+                     max_depth: int = 32, max_rows: int | None = None, recursive: bool | None = None, **kwargs) -> list:
+        """
+        evaluates the records of a hierarchy of the self-referencing foreign key parent_field into a list of root records,
+        with the records of their children in the field children, by default the related name of parent_field.
+
+        root is a queryset, an instance, a primary key or an iterable of them, by default every node without parent.
+        container builds the children collection, tuple by default. max_depth limits the levels below the roots,
+        and more than max_rows nodes raise RecordTreeLimitError. recursive forces the recursive CTE query on or off,
+        by default it is used on backends that support it. args and kwargs are passed to records(). see trees.
+        """
+        return records_tree(self, parent_field, args, kwargs, children=children, root=root, container=container,
+                            max_depth=max_depth, max_rows=max_rows, recursive=recursive)
+
+    def bulk_write(self, records, fields=None, key: str = 'id', mapping: dict | None = None, batch_size: int = 1000,
+                   upsert: bool = False) -> WriteResult:
+        """
+        writes records back to the model, inserting the ones whose key is None or not in the table, updating the others.
+
+        fields are the record fields updated, by default every written field. key is the record field of a unique
+        model field, by default id. mapping takes the keyword arguments of records(), e.g. {'street': Ref('street_id')},
+        to write fields to the model fields they were read from. upsert uses the upsert of the backend instead,
+        if it supports it. returns a WriteResult with the counts. see bulk.
+        """
+        return save_records(self, records, fields=fields, key=key, mapping=mapping, batch_size=batch_size, upsert=upsert)
+
+    def records_in_batches(self, *args, batch_size: int = 2000, key='pk', after=None, **kwargs):
+        """
+        yields the records in RecordBatch lists of batch_size records, paginated by key instead of OFFSET or cursors.
+
+        key is a field name or a sequence of them, see pagination. after is the checkpoint of a previous batch to resume
+        after it. args and kwargs are passed to records(), whose row plan is compiled once for all pages.
+        """
+        keys = ordering_keys(self.model, key)
+        names = tuple(f'{KEY_PREFIX}{index}' for index in range(len(keys)))
+        handler = KeyedRecord(queryset_handler(self, 'records_in_batches'), names)
+        base = self.all()
+        # the handler is set directly, so the arguments of a RecordSpec given to record_into() still apply.
+        base._record = handler
+        base = base.records(
+            *args, **{name: F(field) for name, (field, _) in zip(names, keys)}, **kwargs,
+        ).order_by(*(f"{'-' if descending else ''}{field}" for field, descending in keys))
+
+        plan = None
+        checkpoint = checkpoint_values(keys, after) if after is not None else None
+        while True:
+            page = base.filter(keyset_filter(keys, checkpoint)) if checkpoint is not None else base
+            iterable = RecordIterable(page[:batch_size], chunk_size=batch_size)
+            if plan is None:
+                plan = iterable.plan()
+            pairs = list(iterable.build(plan, iterable.rows()))
+            if not pairs:
+                return
+            checkpoint = pairs[-1][0]
+            yield RecordBatch([record for _, record in pairs], checkpoint)
+            if len(pairs) < batch_size:
+                return
+
+    def raw_records(self, sql: str, params=None, into=None, chunk_size: int = 2000, **kwargs):
+        """
+        yields records of hand-written sql with params, run on the database of this queryset,
+        and fetched in chunks of chunk_size rows. into defaults to the record class of records().
+        kwargs are adjuncts, which only see the columns the sql selects. see raw.
+        """
+        handler = into if into is not None else queryset_handler(self, 'raw_records')
+        if not isinstance(handler, RecordHandler):
+            handler = self._record_handler.wrap(handler)
+        return raw_records(sql, params, handler, model=self.model, using=self.db, chunk_size=chunk_size, **kwargs)
+
+    def as_columns(self, format='numpy', chunk_size=2000):
+        """
+        evaluates the records queryset into columns instead of records.
+        a queryset without records(), or a manager, gets records() of the record class set on it first.
+
+        format is 'numpy' for a dictionary of numpy arrays, 'arrow' for a pyarrow Table,
+        or 'array' for a dictionary of array.array buffers (or lists for non numeric columns).
+        """
+        queryset = self if getattr(self, '_iterable_class', None) is RecordIterable else self.records()
+        return collect_columns(streaming_iterable(queryset, chunk_size), format)
+
+    def records_columns(self, *args, **kwargs):
+        """records(), evaluated into a dictionary of numpy arrays. see as_columns()."""
+        return self.records(*args, **kwargs).as_columns()
+
+    async def alist(self):
+        """asynchronously evaluates the records queryset into a list."""
+        # managers are not async iterable themselves, all() gives their queryset.
+        return [record async for record in self.all()]
+
     def records(self, *args, **kwargs):
         """
         generates record objects
@@ -73,63 +275,61 @@ class RecordQuerySetMixin:
               otherwise it will raise a RuntimeError.
             - keyword arguments of type "Adjunct" are used as deferred values, and resolved independently.
             - values() is called with every required_argument on the dataclass not handled by an Adjunct
+            - columns neither the record nor an adjunct consumes are not fetched, unless the queryset is distinct()
         """
-        if len(args) and not isinstance(args[0], str):
+        spec = getattr(self, '_record_spec', None)
+        if len(args) and isinstance(args[0], RecordSpec):
+            spec = args[0]
+            handler = spec.handler
+            args = args[1:]
+        elif len(args) and not isinstance(args[0], str):
             # we assume this is our dataclass
             handler = args[0]
             args = args[1:]
+            spec = None
             # @deprecate: we might remove this
             logger.warning("Defining the target class in args might be soon deprecated: %s", handler)
         else:
-            handler = getattr(self, '_record', 
-                              getattr(self, '_default_record', 
-                                      getattr(self.model, '_default_record', None)))
+            handler = queryset_handler(self)
         if not handler:
             raise RecordClassDefinitionError("Trying records() on a Queryset without destination class.")
 
         if not isinstance(handler, RecordHandler):
             handler = self._record_handler.wrap(handler)
 
-        all_keys = [*args, *kwargs.keys()]
-        unhandled_keys = list(set(handler.required_arguments) - set(all_keys))
-        args = [*args, *unhandled_keys]
-
-        # rebuild keyword arguments for values, by filtering out our adjuncts
-        new_kw = {}
-        adjuncts = {}
-        for k, v in kwargs.items():
-            if isinstance(v, Adjunct):
-                # skip allows an adjunct to completely ignore a key.
-                if not v.skip:
-                    adjuncts[k] = v
-                # check if we have to add to values. adjuncts can define a field to add here.
-                add_to_values = v.values_field()
-                if isinstance(add_to_values, str) and add_to_values not in args:
-                    args.append(add_to_values)
-                elif isinstance(add_to_values, tuple):
-                    new_kw[add_to_values[0]] = add_to_values[1]
-            elif isinstance(v, BaseExpression) or isinstance(v, Combinable) or hasattr(v, 'resolve_expression'):
-                new_kw[k] = v
-            elif v is None:
-                # ignore None
-                pass
-            else:
-                # this will fail in values() for now, but i do not want to hijack future django functionality here.
-                # however it would be just funky if we actually replace this with new_kw[k] = Val(v).
-                new_kw[k] = v
+        model = getattr(self, 'model', None)
+        depth = getattr(self, '_record_depth', 1)
+        # pruning columns would change which rows are distinct.
+        query = getattr(self, 'query', None)
+        prune = not (query is not None and query.distinct)
+        if spec is not None and handler is spec.handler and not args and not kwargs:
+            # everything but the values() call was compiled when the spec was declared.
+            compiled = spec.compile(model, depth, prune)
+        else:
+            if spec is not None:
+                # e.g. records_tree() on a spec queryset, which wraps the handler of the spec.
+                args = (*spec.args, *args)
+                kwargs = {**spec.kwargs, **kwargs}
+            compiled = compile_records(model, handler, args, kwargs, depth, prune)
 
         # copy ourself with values() and save the results on the cloned queryset values produces.
         try:
-            values = self.values(*args, **new_kw)
+            values = self.values(*compiled.values_args, **compiled.values_kwargs)
         except Exception as e:
             raise RecordInstanceError("Error with calculated values") from e
         values._iterable_class = RecordIterable
-        values._record_kwargs = adjuncts
-        values._record = handler
+        values._record_kwargs = compiled.adjuncts
+        values._record = compiled.handler
         return values
 
 
 class RecordQuerySet(RecordQuerySetMixin, QuerySet):
+    def __aiter__(self):
+        # records are streamed chunk by chunk, instead of fetching everything into the result cache first.
+        if self._result_cache is None and self._iterable_class is RecordIterable:
+            return aiter(self.aiterator())
+        return super().__aiter__()
+
     # overwrite cloning. I would love to have a way to inject this into django directly (or use model.Meta)
     def _clone(self):
         c = super()._clone()
@@ -137,6 +337,10 @@ class RecordQuerySet(RecordQuerySetMixin, QuerySet):
                     '_record_kwargs', # saves the actual kwargs to records until the iterator is consumed
                     '_record_handler', # if the default handler to transform target classes, by default dataclasses
                     '_default_record', # the default target class for this particular model
+                    '_record_cache', # (cache, ttl, key) if the records are cached
+                    '_record_depth', # levels of nested records of forward relations, see nested()
+                    '_record_spec', # the RecordSpec given to record_into()
+                    '_record_parallel', # (workers, executor, chunk_size, prefetch) if records are built in a pool
                     ]:
             if hasattr(self, key):
                 setattr(c, key, getattr(self, key))
@@ -0,0 +1,177 @@
+"""
+Process-wide registry of introspected record classes.
+
+Introspecting a record class (field names, required fields, defaults, how it is constructed)
+only depends on the class itself, so it is done once per class and cached here.
+Classes are held weakly, so classes created at runtime can still be garbage collected.
+
+Use registry.invalidate(klass) or registry.clear() if a class is changed or reloaded.
+
+Code generated for a class, e.g. constructors, is compiled once and kept in registry.generated(klass). Only code objects
+are kept there, which do not refer to the class, the functions binding them to the class are created per use.
+"""
+import dataclasses
+import threading
+import weakref
+from inspect import Parameter, signature
+
+from .errors import RecordClassDefinitionError
+
+
+class RecordMeta:
+    """introspected metadata of a record class"""
+    __slots__ = ['strategy', 'field_names', 'field_set', 'required', 'optional', 'defaults', 'factories', 'positional',
+                 'aliases']
+
+    def __init__(self, strategy: str, field_names, required, defaults: dict, factories: dict, positional, aliases=None):
+        self.strategy = strategy  # how the class is constructed, e.g. 'dataclass', 'pydantic', 'namedtuple'
+        self.field_names = tuple(field_names)
+        self.field_set = frozenset(self.field_names)
+        self.required = tuple(required)
+        self.optional = tuple(f for f in self.field_names if f not in self.required)
+        self.defaults = defaults  # field name -> default value
+        self.factories = factories  # field name -> callable producing the default value
+        self.positional = tuple(positional)  # constructor arguments which can be passed by position, in order
+        self.aliases = aliases or {}  # field name -> name the constructor expects instead, e.g. pydantic aliases
+
+    def __repr__(self):
+        return f"<RecordMeta {self.strategy} {self.field_names}>"
+
+
+def positional_arguments(klass) -> list[str]:
+    """the arguments of the constructor of klass that can be passed by position, in order."""
+    try:
+        parameters = signature(klass).parameters.values()
+    except (TypeError, ValueError):
+        return []
+    return [p.name for p in parameters if p.kind in (Parameter.POSITIONAL_ONLY, Parameter.POSITIONAL_OR_KEYWORD)]
+
+
+def introspect(klass) -> RecordMeta:
+    """introspects klass without caching. raises RecordClassDefinitionError if klass is not a known record type."""
+    # for dataclasses:
+    if dataclasses.is_dataclass(klass):
+        fields = [f for f in dataclasses.fields(klass) if f.init]
+        return RecordMeta(
+            'dataclass',
+            [f.name for f in fields],
+            [f.name for f in fields if f.default is dataclasses.MISSING and f.default_factory is dataclasses.MISSING],
+            {f.name: f.default for f in fields if f.default is not dataclasses.MISSING},
+            {f.name: f.default_factory for f in fields if f.default_factory is not dataclasses.MISSING},
+            positional_arguments(klass),
+        )
+
+    # for attrs classes, the constructor takes private attributes without their leading underscore:
+    attrs_fields = getattr(klass, '__attrs_attrs__', None)
+    if attrs_fields is not None:
+        import attr
+        fields = [(getattr(a, 'alias', None) or a.name.lstrip('_'), a) for a in attrs_fields if a.init]
+        return RecordMeta(
+            'attrs',
+            [name for name, _ in fields],
+            [name for name, a in fields if a.default is attr.NOTHING],
+            {name: a.default for name, a in fields if a.default is not attr.NOTHING and not isinstance(a.default, attr.Factory)},
+            {name: a.default.factory for name, a in fields
+             if isinstance(a.default, attr.Factory) and not a.default.takes_self},
+            positional_arguments(klass),
+        )
+
+    # for msgspec structs:
+    if getattr(klass, '__struct_fields__', None) is not None:
+        import msgspec
+        fields = msgspec.structs.fields(klass)
+        return RecordMeta(
+            'msgspec',
+            [f.name for f in fields],
+            [f.name for f in fields if f.required],
+            {f.name: f.default for f in fields if f.default is not msgspec.NODEFAULT},
+            {f.name: f.default_factory for f in fields if f.default_factory is not msgspec.NODEFAULT},
+            positional_arguments(klass),
+        )
+
+    # for pydantic BaseModel (v2 and v1):
+    model_fields = getattr(klass, 'model_fields', None)
+    if isinstance(model_fields, dict):
+        return RecordMeta(
+            'pydantic',
+            model_fields.keys(),
+            [name for name, f in model_fields.items() if f.is_required()],
+            {name: f.default for name, f in model_fields.items() if not f.is_required() and f.default_factory is None},
+            {name: f.default_factory for name, f in model_fields.items() if f.default_factory is not None},
+            [],
+            {name: alias for name, f in model_fields.items()
+             if (alias := f.validation_alias if isinstance(f.validation_alias, str) else f.alias) and alias != name},
+        )
+    if isinstance(getattr(klass, '__fields__', None), dict):
+        fields = klass.__fields__
+        return RecordMeta(
+            'pydantic',
+            fields.keys(),
+            [name for name, f in fields.items() if f.required],
+            {name: f.default for name, f in fields.items() if not f.required and f.default_factory is None},
+            {name: f.default_factory for name, f in fields.items() if f.default_factory is not None},
+            [],
+        )
+
+    # for namedtuples:
+    if isinstance(klass, type) and issubclass(klass, tuple) and hasattr(klass, '_fields'):
+        defaults = getattr(klass, '_field_defaults', {})
+        return RecordMeta(
+            'namedtuple',
+            klass._fields,
+            [f for f in klass._fields if f not in defaults],
+            dict(defaults),
+            {},
+            klass._fields,
+        )
+
+    raise RecordClassDefinitionError("Field Names not found.")
+
+
+class RecordRegistry:
+    """weakly keyed cache of RecordMeta per record class"""
+
+    def __init__(self):
+        self._entries = weakref.WeakKeyDictionary()
+        self._generated = weakref.WeakKeyDictionary()  # class -> code generated for it
+        self._lock = threading.Lock()
+
+    def describe(self, klass) -> RecordMeta:
+        """returns the cached metadata of klass, introspecting it on first use."""
+        try:
+            return self._entries[klass]
+        except KeyError:
+            pass
+        meta = introspect(klass)
+        with self._lock:
+            return self._entries.setdefault(klass, meta)
+
+    def generated(self, klass) -> dict:
+        """
+        the dictionary of code generated for klass, e.g. compiled constructors, which is dropped with its metadata.
+        its values must not refer to klass, or klass is never collected.
+        """
+        try:
+            return self._generated[klass]
+        except KeyError:
+            pass
+        with self._lock:
+            return self._generated.setdefault(klass, {})
+
+    def invalidate(self, klass):
+        """forgets the metadata of klass, e.g. after it has been changed."""
+        with self._lock:
+            self._entries.pop(klass, None)
+            self._generated.pop(klass, None)
+
+    def clear(self):
+        """forgets all metadata."""
+        with self._lock:
+            self._entries.clear()
+            self._generated.clear()
+
+    def __contains__(self, klass):
+        return klass in self._entries
+
+
+registry = RecordRegistry()
@@ -0,0 +1,185 @@
+"""
+Nested record collections for reverse and many-to-many relations.
+
+RelatedRecords is the prefetch_related equivalent for records(): for each chunk of parent rows,
+it runs one query with an IN lookup on the parent keys, builds the child records with their own adjuncts,
+and attaches them to the parent before the parent record is created.
+"""
+from django.core.exceptions import EmptyResultSet
+from django.db.models import F
+
+from .adjuncts import Adjunct
+from .cache import query_key
+from .errors import RecordClassDefinitionError
+from .handlers import RecordDataclass, RecordHandler, handler_key
+
+
+class KeyedRecord(RecordHandler):
+    """
+    wraps a handler, so that each row creates a (key, record) pair.
+
+    the key is taken out of the row data before the wrapped handler creates the record.
+    key is one key name, or a tuple of key names for a tuple of their values.
+    """
+    __slots__ = ['handler', 'key']
+
+    def __init__(self, handler: RecordHandler, key: str | tuple[str, ...]):
+        self.handler = handler
+        self.key = key
+        self.klass = handler.klass
+        self.trusted = handler.trusted
+
+    def create(self, **kwargs):
+        return self.pop_key(kwargs), self.handler.create(**kwargs)
+
+    def pop_key(self, data):
+        if isinstance(self.key, tuple):
+            return tuple([data.pop(k) for k in self.key])
+        return data.pop(self.key)
+
+    def record_keys(self, keys):
+        """keys without the key names, for the wrapped handler."""
+        if keys is None:
+            return None
+        names = self.key if isinstance(self.key, tuple) else (self.key,)
+        return [k for k in keys if k not in names]
+
+    def factory(self, keys=None):
+        pop_key = self.pop_key
+        create = self.handler.factory(self.record_keys(keys))
+
+        def build(data):
+            key = pop_key(data)
+            return key, create(data)
+        return build
+
+    def chunk_factory(self, keys=None):
+        pop_key = self.pop_key
+        create_chunk = self.handler.chunk_factory(self.record_keys(keys))
+
+        def build_chunk(chunk):
+            keys = [pop_key(data) for data in chunk]
+            return list(zip(keys, create_chunk(chunk)))
+        return build_chunk
+
+    @property
+    def batch(self):
+        return self.handler.batch
+
+    def get_field_names(self):
+        return self.handler.get_field_names()
+
+    def consumed_keys(self):
+        consumed = self.handler.consumed_keys()
+        if consumed is None:
+            return None
+        return consumed | frozenset(self.key if isinstance(self.key, tuple) else (self.key,))
+
+    @property
+    def required_arguments(self):
+        return self.handler.required_arguments
+
+
+class RelatedRecords(Adjunct):
+    """
+    resolves to the records of a reverse or many-to-many relation of the row, e.g.
+    .records(spaceports=RelatedRecords('spaceports', into=SpaceportRecord))
+
+    args and kwargs are passed to records() of the related queryset, so related records can have their own adjuncts,
+    including RelatedRecords for further nesting.
+    queryset can be given to filter or order the related records, by default the default manager of the related model is used.
+    container builds the collection from the list of related records, e.g. tuple for immutable records.
+    the key of the row is fetched under pk_name, and removed again before the record is created.
+    """
+    __slots__ = ['relation', 'into', 'queryset', 'container', 'args', 'kwargs']
+
+    batch = True
+    post_processing = True
+    key_name = 'django_records_related_key'
+    pk_name = 'django_records_related_pk'
+
+    def __init__(self, relation: str, *args, into=None, queryset=None, container=list, **kwargs):
+        self.relation = relation
+        self.into = into
+        self.queryset = queryset
+        self.container = container
+        self.args = args
+        self.kwargs = kwargs
+
+    def describe(self, model):
+        """returns (lookup, related model, single) for the relation on model, lookup pointing from the related model back."""
+        try:
+            field = model._meta.get_field(self.relation)
+        except Exception as e:
+            raise RecordClassDefinitionError(f"Relation {self.relation} not found on {model}.") from e
+        if field.many_to_many and field.concrete:
+            # forward many-to-many
+            return field.related_query_name(), field.related_model, False
+        if field.auto_created and not field.concrete:
+            # reverse foreign key, one-to-one or many-to-many
+            return field.field.name, field.related_model, field.one_to_one
+        raise RecordClassDefinitionError(f"RelatedRecords needs a reverse or many-to-many relation, {self.relation} is neither.")
+
+    def related_queryset(self, model):
+        lookup, related_model, single = self.describe(model)
+        queryset = self.queryset if self.queryset is not None else related_model._default_manager.all()
+        if not hasattr(queryset, 'records'):
+            raise RecordClassDefinitionError(f"RelatedRecords needs a RecordQuerySet for {related_model}.")
+        return queryset, lookup, single
+
+    def handler(self, queryset):
+        handler = self.into or getattr(queryset, '_default_record', getattr(queryset.model, '_default_record', None))
+        if not handler:
+            raise RecordClassDefinitionError(f"RelatedRecords {self.relation} without destination class.")
+        if not isinstance(handler, RecordHandler):
+            handler = getattr(queryset, '_record_handler', RecordDataclass).wrap(handler)
+        return handler
+
+    def resolve(self, model, dbdata):
+        return self.resolve_batch(model, [dbdata])[0]
+
+    def resolve_batch(self, model, rows):
+        keys = [dbdata.get(self.pk_name) for dbdata in rows]
+        queryset, lookup, single = self.related_queryset(model)
+        queryset = queryset.filter(**{f'{lookup}__pk__in': {key for key in keys if key is not None}})
+        related = queryset.record_into(KeyedRecord(self.handler(queryset), self.key_name)).records(
+            *self.args, **{self.key_name: F(f'{lookup}__pk')}, **self.kwargs)
+
+        grouped = {}
+        for key, record in related:
+            grouped.setdefault(key, []).append(record)
+        if single:
+            return [grouped[key][0] if key in grouped else None for key in keys]
+        container = self.container
+        return [container(grouped.get(key, ())) for key in keys]
+
+    def post_process(self, model, dbdata):
+        # the key column is only fetched for resolve_batch, records do not get it.
+        dbdata.pop(self.pk_name, None)
+
+    def values_field(self):
+        return self.pk_name, F('pk')
+
+    def dependencies(self):
+        return {self.pk_name}
+
+    def cache_key(self):
+        into = handler_key(self.into)
+        queryset = self.queryset
+        if queryset is not None:
+            try:
+                queryset = query_key(queryset)
+            except EmptyResultSet:
+                pass
+        # skipped keys are only left out, whichever Skip instance it is.
+        kwargs = tuple((k, (type(v) if v.skip else v.cache_key()) if isinstance(v, Adjunct) else v)
+                       for k, v in self.kwargs.items())
+        return RelatedRecords, self.relation, into, queryset, self.container, self.args, kwargs
+
+    def cache_models(self, model):
+        queryset, lookup, single = self.related_queryset(model)
+        models = [queryset.model]
+        for adjunct in self.kwargs.values():
+            if isinstance(adjunct, Adjunct):
+                models.extend(adjunct.cache_models(queryset.model))
+        return models
@@ -0,0 +1,173 @@
+"""
+Precompiled records() declarations.
+
+records() works out the handler, the values() arguments and the adjuncts on every call. A RecordSpec does this once,
+when it is declared, usually at module level, so only the queryset clone and the values() call are left per request:
+
+    PLANETS = RecordSpec(PlanetRecord, 'orbits__name', model=Celestial, size=Ref('size', round))
+
+    Celestial.objects.filter(celestial_type=2).records(PLANETS)
+    Celestial.objects.record_into(PLANETS).records()
+
+The handler and the keyword arguments are validated when the spec is created. With model, the values() call is
+validated against the model as well, which needs the apps to be loaded. Specs compile once per model and nesting depth,
+further arguments to records() are added to the ones of the spec, which compiles them per call like records() does.
+
+compile_records() prunes the values() arguments to the columns something consumes: the handler, with consumed_keys(),
+or an adjunct, with dependencies(). A field passed by mistake, or only read by a Ref under another key, is not selected,
+the queryset can still filter and order on it. Expressions are always selected, as the queryset may refer to their
+annotation, and so is every column of distinct() querysets, whose rows depend on them.
+An adjunct or handler which may read any key, e.g. a MappedValue without requires, or a RecordDict, keeps every column.
+With DEBUG, the pruned columns are logged as a warning, so the records() call can be fixed.
+"""
+import logging
+
+from django.conf import settings
+from django.db.models.expressions import BaseExpression, Combinable
+
+from .adjuncts import Adjunct
+from .errors import RecordClassDefinitionError
+from .handlers import RecordDataclass, RecordHandler
+from .nested import nested_relations
+
+logger = logging.getLogger(f"django_records.{__name__}")
+
+
+class CompiledRecords:
+    """the arguments records() sets up a values() queryset with."""
+    __slots__ = ['handler', 'values_args', 'values_kwargs', 'adjuncts']
+
+    def __init__(self, handler: RecordHandler, values_args: list, values_kwargs: dict, adjuncts: dict):
+        self.handler = handler
+        self.values_args = values_args
+        self.values_kwargs = values_kwargs
+        self.adjuncts = adjuncts
+
+
+def is_expression(value) -> bool:
+    return isinstance(value, BaseExpression) or isinstance(value, Combinable) or hasattr(value, 'resolve_expression')
+
+
+def compile_records(model, handler: RecordHandler, args, kwargs: dict, depth: int = 1, prune: bool = True) -> CompiledRecords:
+    """
+    works out the values() arguments and the adjuncts of records(*args, **kwargs) on a queryset of model.
+    prune drops the values() arguments nothing consumes, see prune_values().
+    """
+    # forward relations annotated with a record type are nested, unless the key is handled already.
+    nested = nested_relations(model, handler, depth)
+    kwargs = {**{k: v for k, v in nested.items() if k not in args and k not in kwargs}, **kwargs}
+
+    # the queryset may refer to the annotations of expressions, even if the record does not consume them.
+    annotations = {k for k, v in kwargs.items() if v is not None and not isinstance(v, Adjunct)}
+    all_keys = [*args, *kwargs.keys()]
+    unhandled_keys = list(set(handler.required_arguments) - set(all_keys))
+    args = [*args, *unhandled_keys]
+
+    # rebuild keyword arguments for values, by filtering out our adjuncts
+    new_kw = {}
+    adjuncts = {}
+    attached = {}
+    for k, v in kwargs.items():
+        if isinstance(v, Adjunct):
+            v = attached[k] = v.attach(model, k, handler)
+            # skip allows an adjunct to completely ignore a key.
+            if not v.skip:
+                adjuncts[k] = v
+            # check if we have to add to values. adjuncts can define a field to add here.
+            add_to_values = v.values_field()
+            if isinstance(add_to_values, str) and add_to_values not in args:
+                args.append(add_to_values)
+            elif isinstance(add_to_values, tuple):
+                new_kw[add_to_values[0]] = add_to_values[1]
+            elif isinstance(add_to_values, list):
+                args.extend(field for field in add_to_values if field not in args)
+        elif is_expression(v):
+            new_kw[k] = v
+        elif v is None:
+            # ignore None
+            pass
+        else:
+            # this will fail in values() for now, but i do not want to hijack future django functionality here.
+            # however it would be just funky if we actually replace this with new_kw[k] = Val(v).
+            new_kw[k] = v
+    if prune:
+        args, new_kw = prune_values(model, handler, args, new_kw, attached, annotations)
+    return CompiledRecords(handler, args, new_kw, adjuncts)
+
+
+def consumed_columns(handler: RecordHandler, adjuncts: dict) -> set[str] | None:
+    """the keys of the row read by handler or adjuncts, or None if any key may be read."""
+    consumed = handler.consumed_keys()
+    if consumed is None:
+        return None
+    # keys an adjunct resolves, or skips, do not need a column of their own.
+    needed = {k for k in consumed if not (k in adjuncts and (adjuncts[k].skip or adjuncts[k].resolves_field))}
+    for adjunct in adjuncts.values():
+        dependencies = adjunct.dependencies()
+        if dependencies is None:
+            return None
+        needed.update(dependencies)
+    return needed
+
+
+def prune_values(model, handler: RecordHandler, args: list, new_kw: dict, adjuncts: dict,
+                 annotations=frozenset()) -> tuple[list, dict]:
+    """args and new_kw without the columns consumed_columns() does not need, keeping the annotations."""
+    needed = consumed_columns(handler, adjuncts)
+    if needed is None:
+        return args, new_kw
+    needed = needed | set(annotations)
+    pruned = [k for k in args if k not in needed] + [k for k in new_kw if k not in needed]
+    if not pruned:
+        return args, new_kw
+    args = [k for k in args if k in needed]
+    new_kw = {k: v for k, v in new_kw.items() if k in needed}
+    if not args and not new_kw:
+        # values() without arguments would select every column.
+        args = ['pk']
+    if settings.configured and settings.DEBUG:
+        logger.warning("records() of %s does not fetch %s, %s does not consume them.",
+                       getattr(model, '__name__', model), ', '.join(pruned), handler.record)
+    return args, new_kw
+
+
+class RecordSpec:
+    """
+    records() arguments compiled ahead of time, for records(spec) or record_into(spec).
+
+    into is the record class or RecordHandler, args and kwargs are the arguments of records().
+    model compiles and validates the spec right away, handler_class and trusted wrap into like record_into() does.
+    """
+
+    def __init__(self, into, *args, model=None, handler_class=RecordDataclass, trusted=False, **kwargs):
+        self.handler = into if isinstance(into, RecordHandler) else handler_class.wrap(into, trusted=trusted)
+        self.args = args
+        self.kwargs = kwargs
+        self._compiled = {}
+        try:
+            self.handler.required_arguments
+        except Exception as e:
+            raise RecordClassDefinitionError(f"RecordSpec for {into} without known fields.") from e
+        for key in args:
+            if not isinstance(key, str):
+                raise RecordClassDefinitionError(f"RecordSpec arguments have to be field names, not {key!r}.")
+        for key, value in kwargs.items():
+            if not (value is None or isinstance(value, Adjunct) or is_expression(value)):
+                raise RecordClassDefinitionError(f"RecordSpec argument {key} is neither an Adjunct nor an expression.")
+        if model is not None:
+            compiled = self.compile(model)
+            try:
+                model._base_manager.none().values(*compiled.values_args, **compiled.values_kwargs)
+            except Exception as e:
+                raise RecordClassDefinitionError(f"RecordSpec does not match {model.__name__}: {e}") from e
+
+    def compile(self, model, depth: int = 1, prune: bool = True) -> CompiledRecords:
+        """the compiled arguments for querysets of model, compiled on first use."""
+        key = (model, depth, prune)
+        compiled = self._compiled.get(key)
+        if compiled is None:
+            compiled = self._compiled[key] = compile_records(model, self.handler, self.args, self.kwargs, depth, prune)
+        return compiled
+
+    def __repr__(self):
+        return f"<RecordSpec {self.handler.record!r}>"
@@ -1,10 +1,59 @@
+import asyncio
+import gc
+import math
+import tracemalloc
+import weakref
+from array import array
+from collections import namedtuple
+from operator import itemgetter
+import dataclasses
 from dataclasses import dataclass
-from unittest import mock, TestCase
+from typing import NamedTuple, Optional
+from unittest import mock, skipIf, TestCase
 
-from django.db.models import F
+from django.db.models import F, Q
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pydantic
+except ImportError:
+    pydantic = None
+
+try:
+    import attr
+except ImportError:
+    attr = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
 
 from . import handlers
-from .adjuncts import MappedValue as Mut, FixedValue as Val, Skip, PostProcess, Ref
+from .adjuncts import MappedValue as Mut, FixedValue as Val, Skip, PostProcess, Ref, BatchMappedValue, BatchMappedOptionalValue, AsyncMappedValue
+from . import cache as cache_module
+from .cache import RecordCache
+from .identity import EvaluationMap, Identical, IdentityMap
+from .nested import Nested, record_type
+from . import gather as gather_module
+from .gather import agather_records, gather_records, merge_records
+from .pagination import checkpoint_values, keyset_filter
+from .raw import cursor_records
+from .parallel import parallel_options, parallel_records
+from . import specs as specs_module
+from .specs import RecordSpec
+from .instrumentation import RecordStats, SlowAdjunctLogger, records_evaluated
+from .columns import ColumnBuffer, annotation_dtype, collect_columns
+from .plans import RowPlan
+from . import registry as registry_module
+from .registry import registry
+from .errors import RecordClassDefinitionError, RecordInstanceError
+from .related import KeyedRecord
+from .writers import record_values
 from .records import RecordIterable, RecordQuerySetMixin
 
 
@@ -17,6 +66,12 @@ class TestDataClass:
     parent: 'TestDataClass' = None
 
 
+def double_age(age):
+    if age == 13:
+        raise ValueError('unlucky')
+    return age * 2
+
+
 class TestRecords(TestCase):
     def test_records_basic(self):
         lam = lambda entry: entry.get('name')
@@ -107,9 +162,918 @@ class TestRecords(TestCase):
         self.assertEqual(entry.street, 'Street 12')
         self.assertEqual(entry.parent, root)
 
+    def test_row_plan_compiled_once(self):
+        handler = handlers.RecordDataclass.wrap(TestDataClass)
+        registry.clear()
+        with mock.patch.object(registry_module, 'introspect', wraps=registry_module.introspect) as introspected:
+            plan = RowPlan(None, ['id', 'name', 'age', 'street', 'one'], handler, {'parent': PostProcess(None)})
+            entries = [plan(row) for row in [[1, 'a', 1, 's', 'x'], [2, 'b', 2, 't', 'y'], [3, 'c', 3, 'u', 'z']]]
+            entries.append(handler.create(id=4, name='d', age=4, street='v', one='w'))
+        self.assertEqual(introspected.call_count, 1)
+        self.assertEqual([e.id for e in entries], [1, 2, 3, 4])
+        self.assertIsNone(entries[0].parent)
+        self.assertIsNone(plan.keys())
+
+    def test_row_plan_positional(self):
+        handler = handlers.RecordDataclass.wrap(TestDataClass)
+        adjuncts = {'street': Ref('street_id'), 'age': Val(18)}
+        plan = RowPlan(None, ['id', 'name', 'street_id', 'one'], handler, adjuncts)
+        self.assertTrue(plan.positional)
+        entry = plan((1, 'arthus', 12, 'One'))
+        self.assertEqual(entry, TestDataClass(id=1, name='arthus', age=18, street=12))
+
+        # callbacks need the dictionary path.
+        adjuncts = {'street': Ref('street_id', lambda pk: f'Street {pk}'), 'age': Val(18)}
+        plan = RowPlan(None, ['id', 'name', 'street_id'], handler, adjuncts)
+        self.assertFalse(plan.positional)
+        self.assertEqual(plan((1, 'arthus', 12)).street, 'Street 12')
+
+        # a missing argument in between cannot be passed by position.
+        plan = RowPlan(None, ['id', 'name', 'street', 'parent'], handler, {})
+        self.assertFalse(plan.positional)
+
+    def test_row_plan_namedtuple(self):
+        Point = namedtuple('Point', ['x', 'y', 'label'], defaults=[None])
+        handler = handlers.RecordDataclass.wrap(Point)
+        plan = RowPlan(None, ['y', 'x'], handler, {})
+        self.assertTrue(plan.positional)
+        self.assertEqual(plan((2, 1)), Point(1, 2))
+
+    def test_records_iterator_batch(self):
+        lookups = []
+
+        def lookup(pks):
+            lookups.append(pks)
+            return [f'Street {pk}' for pk in pks]
+
+        class FakeQuerySet:
+            class FakeQuery:
+                extra_select = []
+                values_select = ['id', 'name', 'street_id']
+                annotation_select = []
+
+                def get_compiler(self, db):
+                    compiler = mock.MagicMock()
+                    compiler.results_iter.return_value = iter([
+                        [1, 'arthus', 12], [2, 'berta', None], [3, 'conrad', 14], [4, 'dora', 12], [5, 'emil', 15],
+                    ])
+                    return compiler
+
+            db = mock.MagicMock()
+            model = mock.MagicMock()
+            query = FakeQuery()
+            _record = handlers.RecordDataclass.wrap(TestDataClass)
+            _record_kwargs = {
+                'street': Ref('street_id', BatchMappedOptionalValue(lookup)),
+                'age': BatchMappedValue(lambda rows: [len(entry['name']) for entry in rows]),
+            }
+
+        entries = list(RecordIterable(FakeQuerySet(), chunk_size=2))
+        self.assertEqual(lookups, [[12], [14, 12], [15]])
+        self.assertEqual([e.street for e in entries], ['Street 12', None, 'Street 14', 'Street 12', 'Street 15'])
+        self.assertEqual([e.age for e in entries], [6, 5, 6, 4, 4])
+
+    def test_records_async_iterator(self):
+        awaited = []
+
+        async def lookup(pks):
+            awaited.append(pks)
+            await asyncio.sleep(0)
+            return [f'Street {pk}' for pk in pks]
+
+        class FakeQuerySet:
+            class FakeQuery:
+                extra_select = []
+                values_select = ['id', 'name', 'street_id']
+                annotation_select = []
+
+                def get_compiler(self, db):
+                    compiler = mock.MagicMock()
+                    compiler.results_iter.return_value = iter([
+                        [1, 'arthus', 12], [2, 'berta', 13], [3, 'conrad', 14],
+                    ])
+                    return compiler
+
+            db = mock.MagicMock()
+            model = mock.MagicMock()
+            query = FakeQuery()
+            _record = handlers.RecordDataclass.wrap(TestDataClass)
+            _record_kwargs = {
+                'street': Ref('street_id', AsyncMappedValue(lookup)),
+                'age': Mut(lambda entry: len(entry['name'])),
+            }
+
+        async def collect():
+            return [entry async for entry in RecordIterable(FakeQuerySet(), chunk_size=2)]
+
+        entries = asyncio.run(collect())
+        self.assertEqual(awaited, [[12, 13], [14]])
+        self.assertEqual([e.street for e in entries], ['Street 12', 'Street 13', 'Street 14'])
+        self.assertEqual([e.age for e in entries], [6, 5, 6])
+
+        # synchronous iteration runs the awaitable adjunct with async_to_sync.
+        entries = list(RecordIterable(FakeQuerySet(), chunk_size=2))
+        self.assertEqual([e.street for e in entries], ['Street 12', 'Street 13', 'Street 14'])
+
+    def test_keyed_record(self):
+        handler = KeyedRecord(handlers.RecordDataclass.wrap(TestDataClass), 'key')
+        plan = RowPlan(None, ['id', 'name', 'age', 'street', 'key'], handler, {})
+        self.assertEqual(plan((1, 'a', 2, 's', 7)), (7, TestDataClass(id=1, name='a', age=2, street='s')))
+
+        handler = KeyedRecord(handlers.RecordDataclass.wrap(TestDataClass), ('key', 'other'))
+        plan = RowPlan(None, ['id', 'name', 'age', 'street', 'key', 'other'], handler, {})
+        self.assertEqual(plan((1, 'a', 2, 's', 7, 8)), ((7, 8), TestDataClass(id=1, name='a', age=2, street='s')))
+
+    def test_keyset_filter(self):
+        keys = [('age', False), ('name', True), ('pk', False)]
+        self.assertEqual(keyset_filter(keys, (18, 'b', 3)),
+                         Q(age__gt=18) | Q(age=18, name__lt='b') | Q(age=18, name='b', pk__gt=3))
+        self.assertEqual(checkpoint_values(keys[2:], 3), (3,))
+        with self.assertRaises(ValueError):
+            checkpoint_values(keys, (18, 'b'))
+
+
+def fake_iterable(rows, adjuncts=None, record=TestDataClass):
+    class FakeQuerySet:
+        class FakeQuery:
+            extra_select = []
+            values_select = ['id', 'name', 'age']
+            annotation_select = []
+
+            def get_compiler(self, db):
+                compiler = mock.MagicMock()
+                compiler.results_iter.return_value = iter(rows)
+                return compiler
+
+        db = mock.MagicMock()
+        model = None
+        query = FakeQuery()
+        _record = handlers.RecordDataclass.wrap(record)
+        _record_kwargs = adjuncts or {}
+
+    return RecordIterable(FakeQuerySet(), chunk_size=2)
+
+
+class ColumnTests(TestCase):
+    def test_columns(self):
+        rows = [(1, 'a', 10), (2, 'b', 20), (3, 'c', None)]
+        columns = collect_columns(fake_iterable(rows, {'street': Val('x')}), format='array')
+        self.assertEqual(columns['id'], array('q', [1, 2, 3]))
+        self.assertEqual(columns['name'], ['a', 'b', 'c'])
+        # an int column with None becomes a list of objects.
+        self.assertEqual(columns['age'], [10, 20, None])
+        self.assertEqual(columns['street'], ['x', 'x', 'x'])
+        self.assertEqual(columns['parent'], [None, None, None])
+
+    def test_column_buffer(self):
+        buffer = ColumnBuffer('weight', 'float64')
+        buffer.extend((1.5, None))
+        buffer.extend([2.5])
+        self.assertTrue(buffer.typed)
+        self.assertEqual(buffer.values[0], 1.5)
+        self.assertTrue(math.isnan(buffer.values[1]))
+        self.assertEqual(len(buffer), 3)
+
+    def test_annotation_dtype(self):
+        self.assertEqual(annotation_dtype(int), 'int64')
+        self.assertEqual(annotation_dtype(float | None), 'float64')
+        self.assertEqual(annotation_dtype(bool), 'bool')
+        self.assertEqual(annotation_dtype(str), 'object')
+
+    @skipIf(numpy is None, "numpy not installed")
+    def test_columns_numpy(self):
+        columns = collect_columns(fake_iterable([(1, 'a', 10), (2, 'b', 20)], {'street': Val('x')}))
+        self.assertEqual(columns['id'].dtype, numpy.int64)
+        self.assertEqual(columns['age'].tolist(), [10, 20])
+
+
+class WriterTests(TestCase):
+    def test_record_values(self):
+        rows = [(1, 'a', 10), (2, 'b', 20), (3, 'c', 30)]
+        fields, chunks = record_values(fake_iterable(rows, {'street': Val('x')}))
+        self.assertEqual(fields, ['id', 'name', 'age', 'street', 'parent'])
+        self.assertEqual(list(chunks), [[(1, 'a', 10, 'x', None), (2, 'b', 20, 'x', None)], [(3, 'c', 30, 'x', None)]])
+
+    def test_record_values_shape_only(self):
+        rows = [(1, 'a', 10), (2, 'b', 20), (3, 'c', 30)]
+        with mock.patch.object(TestDataClass, '__init__') as init:
+            fields, chunks = record_values(fake_iterable(rows, {'street': Val('x')}), shape_only=True)
+            self.assertEqual(list(chunks)[1], [(3, 'c', 30, 'x', None)])
+            # fields without default have to be fetched.
+            with self.assertRaisesRegex(RecordClassDefinitionError, 'Field street'):
+                record_values(fake_iterable(rows), shape_only=True)
+            fields, chunks = record_values(fake_iterable(rows, {'parent': Val(None)}), shape_only=True)
+            with self.assertRaisesRegex(RecordClassDefinitionError, 'Field street'):
+                list(chunks)
+        self.assertFalse(init.called)
+
+        # default factories give every row a value of its own.
+        @dataclass
+        class Tagged:
+            id: int
+            tags: list = dataclasses.field(default_factory=list)
+        for adjuncts in [None, {'id': Ref('id')}]:
+            values = [row for chunk in record_values(fake_iterable(rows, adjuncts, record=Tagged), shape_only=True)[1]
+                      for row in chunk]
+            self.assertEqual(values, [(1, []), (2, []), (3, [])])
+            self.assertIsNot(values[0][1], values[1][1])
+
+        # without adjuncts, values are taken from the rows.
+        Row = namedtuple('Row', ['age', 'id', 'label'], defaults=['-'])
+        with mock.patch.object(Row, '__new__') as new:
+            fields, chunks = record_values(fake_iterable(rows, record=Row), shape_only=True)
+            self.assertEqual(fields, ['age', 'id', 'label'])
+            self.assertEqual(list(chunks)[0], [(10, 1, '-'), (20, 2, '-')])
+        self.assertFalse(new.called)
+
+
+class RegistryTests(TestCase):
+    def setUp(self):
+        registry.clear()
+
+    def test_describe_dataclass(self):
+        meta = registry.describe(TestDataClass)
+        self.assertIs(meta, registry.describe(TestDataClass))
+        self.assertEqual(meta.field_names, ('id', 'name', 'age', 'street', 'parent'))
+        self.assertEqual(meta.required, ('id', 'name', 'age', 'street'))
+        self.assertEqual(meta.optional, ('parent',))
+        self.assertEqual(meta.defaults, {'parent': None})
+        self.assertEqual(meta.strategy, 'dataclass')
+
+    def test_invalidate(self):
+        meta = registry.describe(TestDataClass)
+        registry.invalidate(TestDataClass)
+        self.assertNotIn(TestDataClass, registry)
+        self.assertIsNot(meta, registry.describe(TestDataClass))
+
+    def test_weak_keys(self):
+        Temporary = dataclass(type('Temporary', (), {'__annotations__': {'id': int}}))
+        registry.describe(Temporary)
+        self.assertIn(Temporary, registry)
+        del Temporary
+        gc.collect()
+        self.assertEqual(len(registry._entries), 0)
+
+    def test_generated_constructors(self):
+        Temporary = dataclass(type('Temporary', (), {'__annotations__': {'id': int}}))
+        create = handlers.RecordDataclass(Temporary, trusted=True).factory(['id'])
+        self.assertEqual(create({'id': 1}), Temporary(id=1))
+        constructor = handlers.trusted_constructor(Temporary, ('id',))
+        self.assertIs(handlers.trusted_constructor(Temporary, ('id',)).__code__, constructor.__code__)
+        self.assertEqual(vars(Temporary).keys() & {'_django_records_generated'}, set())
+        registry.invalidate(Temporary)
+        self.assertIsNot(handlers.trusted_constructor(Temporary, ('id',)).__code__, constructor.__code__)
+
+        # generated code does not keep the class alive, neither through the slot descriptors of slotted classes.
+        Slotted = dataclass(slots=True)(type('Slotted', (), {'__annotations__': {'id': int}}))
+        self.assertEqual(handlers.RecordDataclass(Slotted, trusted=True).factory(['id'])({'id': 1}), Slotted(id=1))
+        temporary, slotted = weakref.ref(Temporary), weakref.ref(Slotted)
+        del Temporary, Slotted, create, constructor
+        gc.collect()
+        self.assertIsNone(temporary())
+        self.assertIsNone(slotted())
+        self.assertEqual(len(registry._entries), 0)
+
+
+class CacheTests(TestCase):
+    def test_lru_eviction(self):
+        cache = RecordCache(maxsize=2)
+        cache.set('a', [1])
+        cache.set('b', [2])
+        self.assertEqual(cache.get('a').records, [1])
+        cache.set('c', [3])
+        self.assertNotIn('b', cache)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(len(cache), 2)
+
+    def test_ttl(self):
+        cache = RecordCache()
+        cache.set('a', [1], ttl=10)
+        cache.set('b', [2], ttl=-1)
+        self.assertEqual(cache.get('a').records, [1])
+        self.assertIsNone(cache.get('b'))
+        self.assertNotIn('b', cache)
+
+    def test_invalidate_model(self):
+        model = mock.MagicMock()
+        model._meta.concrete_model._meta.label = 'app.Star'
+        cache = RecordCache()
+        cache.set('stars', [1], models={'app.Star'})
+        cache.set('planets', [2], models={'app.Planet'})
+        cache.invalidate(model)
+        self.assertNotIn('stars', cache)
+        self.assertIn('planets', cache)
+        self.assertEqual(cache.stats()['invalidations'], 1)
+
+    def test_adjunct_cache_keys(self):
+        callback = lambda value: value
+        self.assertEqual(Val(1).cache_key(), Val(1).cache_key())
+        self.assertEqual(Ref('a', callback).cache_key(), Ref('a', callback).cache_key())
+        self.assertNotEqual(Ref('a', callback).cache_key(), Ref('b', callback).cache_key())
+        self.assertNotEqual(Mut(callback).cache_key(), Mut(lambda value: value).cache_key())
+        skip = Skip()
+        self.assertIs(skip.cache_key(), skip)
+
+    def test_trusted_cache_keys(self):
+        # trusted records skip __post_init__ or validation, they are not the records of the validating handler.
+        plan = lambda trusted: RowPlan(None, ['id'], handlers.RecordDataclass(TestDataClass, trusted=trusted), {})
+        self.assertNotEqual(cache_module.plan_key(plan(True)), cache_module.plan_key(plan(False)))
+        nested, trusted = Nested(TestDataClass), Nested(TestDataClass)
+        trusted.trusted = True
+        self.assertNotEqual(nested.cache_key(), trusted.cache_key())
+        self.assertNotEqual(Nested(handlers.RecordDataclass(TestDataClass)).cache_key(),
+                            Nested(handlers.RecordDataclass(TestDataClass, trusted=True)).cache_key())
+
+
+class HandlerTests(TestCase):
+    rows = [(1, 'a', 10), (2, 'b', 20)]
+
+    def build(self, handler, rows=None):
+        plan = RowPlan(None, ['id', 'name', 'age'], handler, {})
+        return [plan(row) for row in rows or self.rows]
+
+    def test_wrap_picks_handler(self):
+        Row = namedtuple('Row', ['id', 'name'])
+        self.assertIsInstance(handlers.RecordDataclass.wrap(Row), handlers.RecordNamedTuple)
+        self.assertIs(type(handlers.RecordDataclass.wrap(TestDataClass)), handlers.RecordDataclass)
+
+    def test_named_tuple(self):
+        class Row(NamedTuple):
+            id: int
+            name: str
+            age: int = 0
+            street: str = '-'
+
+        handler = handlers.RecordDataclass.wrap(Row)
+        self.assertEqual(self.build(handler), [Row(1, 'a', 10, '-'), Row(2, 'b', 20, '-')])
+        self.assertEqual(handler.factory(['id', 'name'])({'id': 1, 'name': 'a'}), Row(1, 'a'))
+        self.assertEqual(handler.meta.required, ('id', 'name'))
+
+    def test_slots(self):
+        handler = handlers.RecordSlots.generate('Row', ['id', 'name', ('age', int, dataclasses.field(default=0))])
+        record = self.build(handler)[0]
+        self.assertEqual((record.id, record.name, record.age), (1, 'a', 10))
+        self.assertFalse(hasattr(record, '__dict__'))
+        self.assertEqual(handler.meta.required, ('id', 'name'))
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            record.id = 2
+        with self.assertRaises(RecordClassDefinitionError):
+            handlers.RecordSlots(TestDataClass)
+
+    @skipIf(attr is None, "attrs is not installed")
+    def test_attrs(self):
+        @attr.s(slots=True, frozen=True)
+        class Row:
+            id = attr.ib()
+            _name = attr.ib()
+            age = attr.ib(default=0)
+            tags = attr.ib(default=attr.Factory(list))
+
+        handler = handlers.RecordDataclass.wrap(Row)
+        self.assertIsInstance(handler, handlers.RecordAttrs)
+        self.assertEqual(handler.get_field_names(), ['id', 'name', 'age', 'tags'])
+        self.assertEqual(handler.meta.required, ('id', 'name'))
+        self.assertEqual(handler.meta.factories, {'tags': list})
+        self.assertEqual(self.build(handler)[1], Row(2, 'b', 20))
+
+    @skipIf(msgspec is None, "msgspec is not installed")
+    def test_msgspec(self):
+        class Row(msgspec.Struct, frozen=True):
+            id: int
+            name: str
+            age: int = 0
+            street: str | None = None
+
+        handler = handlers.RecordDataclass.wrap(Row)
+        self.assertIsInstance(handler, handlers.RecordStruct)
+        self.assertEqual(handler.meta.required, ('id', 'name'))
+        self.assertEqual(self.build(handler), [Row(1, 'a', 10), Row(2, 'b', 20)])
+
+    @skipIf(pydantic is None, "pydantic is not installed")
+    def test_pydantic(self):
+        class Row(pydantic.BaseModel):
+            id: int
+            full_name: str = pydantic.Field(alias='fullName')
+            age: int = 0
+
+        handler = handlers.RecordDataclass.wrap(Row)
+        self.assertIsInstance(handler, handlers.RecordPydantic)
+        self.assertEqual(handler.get_field_names(), ['id', 'full_name', 'age'])
+        self.assertEqual(handler.meta.required, ('id', 'full_name'))
+        self.assertEqual(handler.meta.aliases, {'full_name': 'fullName'})
+
+        validator = Row.__pydantic_validator__
+        with mock.patch.object(Row, '__pydantic_validator__', mock.Mock(wraps=validator)) as validate:
+            plan = RowPlan(None, ['id', 'full_name', 'age'], handler, {})
+            self.assertTrue(plan.batched)
+            records = plan.build_chunk([(1, 'a', '10'), (2, 'b', 20)])
+        self.assertEqual(validate.validate_python.call_count, 2)
+        self.assertEqual(records, [Row(id=1, fullName='a', age=10), Row(id=2, fullName='b', age=20)])
+        with self.assertRaises(RecordInstanceError):
+            plan.build_chunk([(1, 'a', 'not a number')])
+
+        # trusted records are not validated.
+        trusted = RowPlan(None, ['id', 'full_name', 'age'], handlers.RecordPydantic(Row, trusted=True), {})
+        self.assertFalse(trusted.batched)
+        self.assertTrue(trusted.positional)
+        record = trusted((1, 'a', '10'))
+        self.assertEqual((record.id, record.full_name, record.age), (1, 'a', '10'))
+        self.assertIsNot(record.model_fields_set, trusted((2, 'b', 20)).model_fields_set)
+        record = handlers.RecordPydantic(Row, trusted=True).factory(['id', 'full_name'])({'id': 1, 'full_name': 'a'})
+        self.assertEqual(record.model_dump(), {'id': 1, 'full_name': 'a', 'age': 0})
+        self.assertEqual(record.model_fields_set, {'id', 'full_name'})
+
+        # the generated code is kept in the registry, not with the model.
+        self.assertTrue(registry.generated(Row))
+        self.assertNotIn('_django_records_generated', vars(Row))
+
+    @skipIf(pydantic is None, "pydantic is not installed")
+    def test_pydantic_collected(self):
+        Row = pydantic.create_model('Row', id=(int, ...))
+        handlers.RecordPydantic(Row).chunk_factory(['id'])([{'id': 1}])
+        handlers.RecordPydantic(Row, trusted=True).factory(['id'])({'id': 1})
+        row = weakref.ref(Row)
+        del Row
+        gc.collect()
+        self.assertIsNone(row())
+
+    def test_trusted(self):
+        calls = []
+
+        @dataclass(frozen=True)
+        class Row:
+            id: int
+            name: str
+            age: int = 0
+            tags: list = dataclasses.field(default_factory=list)
+
+            def __post_init__(self):
+                calls.append(self)
+
+        handler = handlers.RecordDataclass.wrap(Row, trusted=True)
+        records = self.build(handler)
+        self.assertEqual(calls, [])
+        self.assertEqual(records, [Row(1, 'a', 10), Row(2, 'b', 20)])
+        self.assertIsNot(records[0].tags, records[1].tags)
+        with self.assertRaises(dataclasses.FrozenInstanceError):
+            records[0].id = 3
+
+        # defaults of fields which are not fetched, and the dictionary path.
+        plan = RowPlan(None, ['id', 'name'], handler, {'post': PostProcess(lambda dbdata: None)})
+        self.assertEqual(plan((1, 'a')), Row(1, 'a'))
+        self.assertEqual(handler.factory(['name', 'id'])({'name': 'a', 'id': 1}), Row(1, 'a'))
+
+        # required fields which are not fetched fail like they do without trust.
+        with self.assertRaises(RecordInstanceError):
+            RowPlan(None, ['id'], handler, {})((1,))
+
+    def test_trusted_slots(self):
+        @dataclass(frozen=True, slots=True)
+        class Row:
+            id: int
+            name: str
+            age: int = 0
+            label: str = dataclasses.field(init=False, default='-')
+
+            def __post_init__(self):
+                raise AssertionError("__post_init__ should not be called")
+
+        records = self.build(handlers.RecordDataclass.wrap(Row, trusted=True), [(1, 'a', 10)])
+        self.assertEqual((records[0].id, records[0].name, records[0].age, records[0].label), (1, 'a', 10, '-'))
+        self.assertFalse(hasattr(records[0], '__dict__'))
+
+    def test_memory(self):
+        @dataclass
+        class Plain:
+            id: int
+            name: str
+            age: int
+
+        @dataclass(slots=True)
+        class Slotted:
+            id: int
+            name: str
+            age: int
+
+        rows = [(i, 'name', i) for i in range(2000)]
+
+        def size(handler):
+            tracemalloc.start()
+            records = self.build(handler, rows)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            self.assertEqual(len(records), len(rows))
+            return size / len(rows)
+
+        plain = size(handlers.RecordDataclass.wrap(Plain))
+        slotted = size(handlers.RecordDataclass.wrap(Slotted))
+        named = size(handlers.RecordDataclass.wrap(namedtuple('Named', ['id', 'name', 'age'])))
+        # slots and tuples save the instance dictionary of every record.
+        self.assertLess(slotted, plain * 0.8)
+        self.assertLess(named, plain * 0.9)
+
+
+class InstrumentationTests(TestCase):
+    def evaluate(self, iterable):
+        received = []
+
+        def receiver(sender, stats, **kwargs):
+            received.append(stats)
+        records_evaluated.connect(receiver)
+        try:
+            records = list(iterable)
+        finally:
+            records_evaluated.disconnect(receiver)
+        self.assertEqual(len(received), 1)
+        return records, received[0]
+
+    def test_phases(self):
+        rows = [(1, 'a', 10), (2, 'b', 20), (3, 'c', 30)]
+        adjuncts = {'street': Mut(lambda dbdata: dbdata['name'] * 2), 'post': PostProcess(lambda dbdata: None)}
+        records, stats = self.evaluate(fake_iterable(rows, adjuncts))
+        self.assertEqual(records, list(fake_iterable(rows, adjuncts)))
+        self.assertEqual(stats.rows, 3)
+        self.assertEqual(stats.chunks, 2)
+        # the last fetch finds no more rows.
+        self.assertEqual(len(stats.fetch_times), 3)
+        self.assertEqual(list(stats.resolve_times), ['street'])
+        self.assertEqual(stats.errors, 0)
+        self.assertGreaterEqual(stats.total_time, stats.create_time)
+
+    def test_errors(self):
+        rows = [(1, 'a', 10)]
+        received = []
+        receiver = lambda sender, stats, **kwargs: received.append(stats)
+        records_evaluated.connect(receiver)
+        try:
+            with self.assertRaises(ZeroDivisionError):
+                list(fake_iterable(rows, {'street': Mut(lambda dbdata: 1 / 0)}))
+        finally:
+            records_evaluated.disconnect(receiver)
+        self.assertEqual(received[0].errors, 1)
+
+    def test_slow_adjunct_logger(self):
+        stats = RecordStats(None)
+        stats.resolve_times = {'fast': 0.001, 'slow': 0.5}
+        with self.assertLogs('django_records', 'WARNING') as logs:
+            SlowAdjunctLogger(threshold=0.1, limit=1)(None, stats=stats)
+        self.assertIn('slow 500.0ms', logs.output[0])
+        self.assertNotIn('fast', logs.output[0])
+
+
+class IdentityTests(TestCase):
+    def test_identity_map(self):
+        identity_map = IdentityMap(maxsize=2)
+        self.assertEqual(identity_map.get(1, lambda: 'a'), 'a')
+        self.assertEqual(identity_map.get(1, lambda: 'b'), 'a')
+        identity_map.get(2, lambda: 'b')
+        identity_map.get(1, lambda: 'c')
+        identity_map.get(3, lambda: 'c')
+        self.assertNotIn(2, identity_map)
+        self.assertEqual(identity_map.stats(), {'hits': 2, 'misses': 3, 'hit_rate': 0.4, 'evictions': 1, 'size': 2, 'maxsize': 2})
+
+        # maps of one evaluation evict the keys stored first, regardless of their hits.
+        evaluation_map = EvaluationMap(maxsize=2)
+        for key, value in [(1, 'a'), (2, 'b'), (1, 'c'), (3, 'c')]:
+            evaluation_map.get(key, lambda: value)
+        self.assertNotIn(1, evaluation_map)
+        self.assertEqual(evaluation_map.stats(), {'hits': 1, 'misses': 3, 'hit_rate': 0.25, 'evictions': 1, 'size': 2, 'maxsize': 2})
+
+    def test_identical(self):
+        built = []
+
+        def parent(pk):
+            built.append(pk)
+            return TestDataClass(id=pk, name='parent', age=0, street='-')
+
+        rows = [(1, 'a', 10), (2, 'b', 20), (3, 'c', 20)]
+        adjuncts = {'street': Val('-'), 'parent': Ref('age', Identical(Mut(lambda age: parent(age))))}
+        records = list(fake_iterable(rows, adjuncts))
+        self.assertEqual(built, [10, 20])
+        self.assertIs(records[1].parent, records[2].parent)
+        self.assertEqual(adjuncts['parent'].adjunct.last_map.stats()['hits'], 1)
+        self.assertIsInstance(adjuncts['parent'].adjunct.last_map, EvaluationMap)
+
+        # every evaluation has its own map, unless one is shared.
+        list(fake_iterable(rows, adjuncts))
+        self.assertEqual(built, [10, 20, 10, 20])
+        shared = IdentityMap()
+        adjuncts = {'street': Val('-'),
+                    'parent': Ref('age', Identical(Mut(lambda age: parent(age)), identity_map=shared))}
+        list(fake_iterable(rows, adjuncts))
+        list(fake_iterable(rows, adjuncts))
+        self.assertEqual(built, [10, 20, 10, 20, 10, 20])
+        self.assertEqual(shared.stats()['hits'], 4)
+
+    def test_identical_batch(self):
+        calls = []
+
+        def parents(keys):
+            calls.append(keys)
+            return [f"parent {dbdata['age'] // 20}" for dbdata in keys]
+
+        identical = Identical(BatchMappedValue(parents), key=lambda dbdata: dbdata['age'] // 20).bind(None)
+        rows = [{'age': 10}, {'age': 20}, {'age': 30}, {'age': 5}]
+        self.assertEqual(identical.resolve_batch(None, rows), ['parent 0', 'parent 1', 'parent 1', 'parent 0'])
+        self.assertEqual(identical.resolve_batch(None, [{'age': 40}, {'age': 0}]), ['parent 2', 'parent 0'])
+        # only the first row of every new key is resolved.
+        self.assertEqual(calls, [[{'age': 10}, {'age': 20}], [{'age': 40}]])
+        self.assertEqual(identical.identity_map.stats()['hits'], 3)
+
+    def test_identical_unhashable(self):
+        identical = Identical(Mut(len)).bind(None)
+        self.assertEqual(identical.resolve_batch(None, [[1], [1, 2], [1]]), [1, 2, 1])
+        self.assertEqual(len(identical.identity_map), 0)
+
+
+class SpecTests(TestCase):
+    def test_spec(self):
+        spec = RecordSpec(TestDataClass, 'one', street=Ref('street_id'), parent=Skip(), two=F('field'))
+        MockedValues = mock.MagicMock()
+        qs = RecordQuerySetMixin()
+        qs.model = None
+        qs.values = MockedValues
+
+        with mock.patch.object(specs_module, 'compile_records', wraps=specs_module.compile_records) as compile_records:
+            qs.records(spec)
+            qs.record_into(spec).records()
+        # compiled once, for the first request.
+        self.assertEqual(compile_records.call_count, 1)
+        self.assertIs(spec.compile(None), spec.compile(None))
+        self.assertEqual(MockedValues.call_args_list[0], MockedValues.call_args_list[1])
+        # one is not a field of TestDataClass, so it is not fetched, unlike the annotation of two.
+        self.assertEqual(sorted(MockedValues.call_args.args), ['age', 'id', 'name', 'street_id'])
+        self.assertEqual(MockedValues.call_args.kwargs, {'two': F('field')})
+        self.assertEqual(list(MockedValues.return_value._record_kwargs), ['street'])
+        self.assertIs(MockedValues.return_value._record, spec.handler)
+
+        # further arguments are compiled per call.
+        qs.records(spec, name=F('title'))
+        self.assertEqual(MockedValues.call_args.kwargs, {'two': F('field'), 'name': F('title')})
+
+    def test_spec_validation(self):
+        with self.assertRaises(RecordClassDefinitionError):
+            RecordSpec(TestDataClass, street=1)
+        with self.assertRaises(RecordClassDefinitionError):
+            RecordSpec(TestDataClass, 1)
+        with self.assertRaises(RecordClassDefinitionError):
+            RecordSpec(object)
+
+
+class PruneTests(TestCase):
+    def compile(self, *args, handler=None, **kwargs):
+        handler = handler or handlers.RecordDataclass(TestDataClass)
+        return specs_module.compile_records(None, handler, args, kwargs)
+
+    def test_unconsumed_columns(self):
+        # notes is passed, but TestDataClass has no such field, so filtering or ordering on it does not need it selected.
+        compiled = self.compile('notes', street=Ref('street_id'), parent=Skip(), title=F('name'))
+        self.assertEqual(sorted(compiled.values_args), ['age', 'id', 'name', 'street_id'])
+        # the annotation of an expression is selected, the queryset may filter or order on it.
+        self.assertEqual(compiled.values_kwargs, {'title': F('name')})
+        # a column an adjunct resolves under its own key is not consumed by the record.
+        compiled = self.compile('street', street=Ref('street_id'))
+        self.assertNotIn('street', compiled.values_args)
+
+    def test_dependencies(self):
+        # without requires, a callback may read any column.
+        compiled = self.compile('notes', street=Mut(lambda row: row['notes']))
+        self.assertIn('notes', compiled.values_args)
+        compiled = self.compile('notes', 'code', street=Mut(lambda row: row['notes'], requires=['notes']))
+        self.assertIn('notes', compiled.values_args)
+        self.assertNotIn('code', compiled.values_args)
+        compiled = self.compile('notes', 'code', street=Val('-'), post=PostProcess(lambda row: row, requires=['code']))
+        self.assertEqual(sorted(compiled.values_args), ['age', 'code', 'id', 'name', 'parent'])
+        self.assertEqual(Identical(Ref('street_id')).dependencies(), {'street_id'})
+        self.assertIsNone(Identical(Ref('street_id'), key=itemgetter('id')).dependencies())
+
+    def test_consumed_keys(self):
+        self.assertIsNone(handlers.RecordDict().consumed_keys())
+        compiled = self.compile('notes', handler=handlers.RecordDict())
+        self.assertEqual(compiled.values_args, ['notes'])
+        keyed = KeyedRecord(handlers.RecordDataclass(TestDataClass), ('key', 'part'))
+        self.assertEqual(keyed.consumed_keys(), {'id', 'name', 'age', 'street', 'parent', 'key', 'part'})
+
+        @dataclass
+        class Empty:
+            pass
+        # values() without arguments would fetch every column.
+        self.assertEqual(self.compile('code', handler=handlers.RecordDataclass(Empty)).values_args, ['pk'])
+
+    def test_debug_warning(self):
+        with mock.patch.object(specs_module, 'settings', mock.Mock(configured=True, DEBUG=True)):
+            with self.assertLogs('django_records', 'WARNING') as logs:
+                self.compile('code', street=Ref('street_id'))
+        self.assertIn('code', logs.output[0])
+
+
+class ParallelTests(TestCase):
+    rows = [(index, f'name {index}', index, '-') for index in range(50)]
+
+    def plan(self, **adjuncts):
+        return RowPlan(None, ['id', 'name', 'age', 'street'], handlers.RecordDataclass(TestDataClass), adjuncts)
+
+    def test_ordered(self):
+        rows = self.rows[14:]
+        for executor in ['thread', 'process']:
+            adjuncts = {'age': Ref('age', double_age)}
+            plan = self.plan(**adjuncts)
+            records = list(parallel_records(plan, iter(rows), adjuncts, 3, executor, 5, 2))
+            self.assertEqual(records, [plan.build(row) for row in rows])
+
+    def test_prefetch(self):
+        fetched = []
+        rows = (fetched.append(row) or row for row in self.rows)
+        records = parallel_records(self.plan(), rows, {}, 2, 'thread', 5, 2)
+        next(records)
+        # the chunk yielded from, and two chunks ahead of it.
+        self.assertEqual(len(fetched), 15)
+        records.close()
+
+    def test_errors(self):
+        with self.assertRaisesRegex(RecordInstanceError, 'row 13 .*unlucky'):
+            list(parallel_records(self.plan(age=Ref('age', double_age)), self.rows, {}, 2, 'thread', 5, 2))
+        failing = BatchMappedValue(lambda rows: 1 / 0)
+        with self.assertRaisesRegex(RecordInstanceError, 'rows 0 to 4: ZeroDivisionError'):
+            list(parallel_records(self.plan(age=failing), self.rows, {}, 2, 'thread', 5, 2))
+        with self.assertRaisesRegex(RecordClassDefinitionError, 'callback of the MappedValue of age'):
+            list(parallel_records(self.plan(), self.rows, {'age': Mut(lambda row: 1)}, 2, 'process', 5, 2))
+
+    def test_process_cache(self):
+        # the identity map of a cache for the process is pickled without its lock, once it was used.
+        rows = self.rows[14:]
+        adjuncts = {'age': Ref('age', double_age, cache='process')}
+        plan = self.plan(**adjuncts)
+        expected = [plan.build(row) for row in rows]
+        self.assertEqual(list(parallel_records(self.plan(**adjuncts), iter(rows), adjuncts, 2, 'process', 5, 2)), expected)
+
+    def test_options(self):
+        self.assertEqual(parallel_options(2, 'thread', 100, None), (2, 'thread', 100, 4))
+        with self.assertRaises(ValueError):
+            parallel_options(2, 'fork', 100, None)
+
+
+class Shard(list):
+    """a list standing in for an ordered records queryset."""
+    ordered = True
+    model = None
+
+    def iterator(self, chunk_size=None):
+        return iter(self)
+
+
+class GatherTests(TestCase):
+    def setUp(self):
+        # the threads have no database connections to close.
+        patcher = mock.patch.object(gather_module.connections, 'close_all')
+        self.close_all = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_gather(self):
+        self.assertEqual(gather_records(Shard([1, 2]), Shard([3]), container=tuple), [(1, 2), (3,)])
+        self.assertEqual(asyncio.run(agather_records(Shard([1]), Shard())), [[1], []])
+        # every thread closes its connections.
+        self.assertEqual(self.close_all.call_count, 4)
+
+    def test_gather_error(self):
+        failing = mock.MagicMock()
+        failing.__iter__.side_effect = RecordInstanceError
+        with self.assertRaises(RecordInstanceError):
+            gather_records(Shard([1]), failing)
+
+    def test_merge(self):
+        shards = [Shard({'age': age} for age in ages) for ages in ([1, 4, 9], [2, 3], [], [5, 10])]
+        merged = merge_records(*shards, key='age', chunk_size=2)
+        self.assertEqual([record['age'] for record in merged], [1, 2, 3, 4, 5, 9, 10])
+        merged = merge_records(Shard([9, 4]), Shard([5, 1]), key=lambda value: value, reverse=True)
+        self.assertEqual(list(merged), [9, 5, 4, 1])
+
+        unordered = Shard()
+        unordered.ordered = False
+        with self.assertRaises(RecordClassDefinitionError):
+            merge_records(Shard(), unordered, key='age')
+
+    def test_merge_close(self):
+        merged = merge_records(Shard(range(100)), Shard(range(100)), key=int, chunk_size=5, prefetch=1)
+        self.assertEqual(next(merged), 0)
+        merged.close()
+        self.assertEqual(self.close_all.call_count, 2)
+
+
+class FakeCursor:
+    def __init__(self, names, rows):
+        self.description = [(name, None, None, None, None, None, None) for name in names]
+        self.rows = list(rows)
+        self.fetches = []
+
+    def fetchmany(self, size):
+        rows, self.rows = self.rows[:size], self.rows[size:]
+        self.fetches.append(len(rows))
+        return rows
+
+
+class RawTests(TestCase):
+    rows = [(index, f'name {index}', index * 10, index) for index in range(5)]
+
+    def test_cursor_records(self):
+        cursor = FakeCursor(['id', 'name', 'age', 'street_id'], self.rows)
+        records = list(cursor_records(cursor, TestDataClass, chunk_size=2, street=Ref('street_id', str), parent=Skip()))
+        self.assertEqual(records[1], TestDataClass(id=1, name='name 1', age=10, street='1'))
+        self.assertEqual(len(records), 5)
+        self.assertEqual(cursor.fetches, [2, 2, 1, 0])
+
+    def test_batched(self):
+        cursor = FakeCursor(['id', 'name', 'age', 'street'], self.rows)
+        ages = BatchMappedValue(lambda rows: [row['age'] + 1 for row in rows])
+        records = list(cursor_records(cursor, handlers.RecordDict(), chunk_size=3, age=ages))
+        self.assertEqual([record['age'] for record in records], [1, 11, 21, 31, 41])
+
+    def test_errors(self):
+        with self.assertRaises(RecordClassDefinitionError):
+            list(cursor_records(FakeCursor(['id'], []), TestDataClass, name=F('title')))
+        cursor = FakeCursor(['id'], [(1,)])
+        cursor.description = None
+        with self.assertRaises(RecordClassDefinitionError):
+            list(cursor_records(cursor, TestDataClass))
+
+
+class NestedTests(TestCase):
+    def test_record_type(self):
+        self.assertIs(record_type(TestDataClass), TestDataClass)
+        self.assertIs(record_type(TestDataClass | None), TestDataClass)
+        self.assertIs(record_type(Optional[TestDataClass]), TestDataClass)
+        self.assertIsNone(record_type(int))
+        self.assertIsNone(record_type(None))
+
+    def test_values_field_list(self):
+        MockedValues = mock.MagicMock()
+        qs = RecordQuerySetMixin()
+        qs.model = None
+        qs.values = MockedValues
+        nested = Nested(TestDataClass)
+        with mock.patch.object(Nested, 'attach', return_value=nested) as attach:
+            with mock.patch.object(Nested, 'values_field', return_value=['parent__id', 'parent__name', 'id']):
+                qs.record_into(TestDataClass).records(parent=nested)
+        # the hook gets the model of the queryset, the key and the handler.
+        self.assertEqual(attach.call_args.args[:2], (None, 'parent'))
+        self.assertIs(attach.call_args.args[2].record, TestDataClass)
+        self.assertEqual(sorted(MockedValues.call_args.args), ['age', 'id', 'name', 'parent__id', 'parent__name', 'street'])
+
+
 class AdjunctTests(TestCase):
     def test_ref_none(self):
         r = Ref('key', None)
         result = r.resolve(model=None, dbdata = {'key': 'Value'} )
         self.assertEqual(r.adjunct, None)
-        self.assertEqual(result, "Value")
\ No newline at end of file
+        self.assertEqual(result, "Value")
+
+    def test_memoized_callbacks(self):
+        calls = []
+
+        def label(age):
+            calls.append(age)
+            return f'age {age}'
+
+        rows = [(1, 'a', 10), (2, 'b', 20), (3, 'c', 10), (4, 'd', 10)]
+        ref = Ref('age', label, cache=True)
+        records = list(fake_iterable(rows, {'street': ref}))
+        self.assertEqual([r.street for r in records], ['age 10', 'age 20', 'age 10', 'age 10'])
+        self.assertEqual(calls, [10, 20])
+        self.assertEqual(ref.cache_stats()['hit_rate'], 0.5)
+        # the cache of the default scope only lives for one evaluation.
+        list(fake_iterable(rows, {'street': ref}))
+        self.assertEqual(calls, [10, 20, 10, 20])
+
+        ref = Ref('age', label, cache='process')
+        # the map of the process is there before the first evaluation, so concurrent ones do not create their own.
+        identity_map = ref.adjunct.identity_map
+        self.assertIsInstance(identity_map, IdentityMap)
+        list(fake_iterable(rows, {'street': ref}))
+        self.assertIs(ref.adjunct.identity_map, identity_map)
+        list(fake_iterable(rows, {'street': ref}))
+        self.assertEqual(calls, [10, 20, 10, 20, 10, 20])
+        self.assertEqual(ref.cache_stats()['hits'], 6)
+
+        # rows are unhashable, and only cached by the input picked with cache_by.
+        shared = IdentityMap(maxsize=10)
+        uncached = Mut(lambda dbdata: label(dbdata['age']), cache=True)
+        with self.assertRaisesRegex(ValueError, 'MappedValue of street never hits'):
+            uncached.attach(None, 'street', None)
+        self.assertIs(Ref('age', uncached).attach(None, 'street', None).adjunct, uncached)
+        by_age = Mut(lambda dbdata: label(dbdata['age']), cache=shared, cache_by=itemgetter('age'))
+        list(fake_iterable(rows, {'street': by_age}))
+        self.assertIs(by_age.attach(None, 'street', None), by_age)
+        self.assertEqual(calls[6:], [10, 20])
+        self.assertIs(by_age.cache_stats()['maxsize'], 10)
+
+        # adjuncts sharing a map keep their values apart.
+        shared = IdentityMap()
+        records = list(fake_iterable(rows, {'street': Ref('age', str, cache=shared),
+                                            'name': Ref('age', lambda age: f'name {age}', cache=shared)}))
+        self.assertEqual((records[0].street, records[0].name), ('10', 'name 10'))
+        self.assertEqual(len(shared), 4)
+
+        with self.assertRaises(ValueError):
+            Mut(label, cache='forever')
@@ -0,0 +1,189 @@
+"""
+Record trees of self-referencing foreign keys.
+
+records_tree() loads a whole hierarchy, e.g. Celestial.orbits -> orbitals, and returns the records of its roots
+with their children nested, built bottom-up, so immutable records work:
+
+    Celestial.objects.record_into(Body).records_tree('orbits', children='orbitals', root=sun)
+
+On backends with recursive common table expressions, the subtree is selected with one WITH RECURSIVE subquery,
+so the whole tree is fetched in one query. Other backends fetch the tree level by level, one query per level.
+
+The filters of the queryset apply to every node: the subtree of a node excluded by them is cut off.
+max_depth limits the levels below the roots, and max_rows raises RecordTreeLimitError if the tree has more nodes,
+so cycles or unexpectedly large hierarchies can not run away.
+"""
+from collections import defaultdict
+
+from django.db import connections
+from django.db.models import BooleanField, ExpressionWrapper, F, Q, QuerySet
+from django.db.models.expressions import RawSQL
+
+from .adjuncts import Skip
+from .errors import RecordClassDefinitionError, RecordTreeLimitError
+from .handlers import RecordHandler, queryset_handler
+
+# vendors whose supported versions run WITH RECURSIVE in subqueries.
+RECURSIVE_CTE_VENDORS = ('postgresql', 'sqlite', 'mysql')
+
+KEY_NAME = 'django_records_tree_key'
+PARENT_NAME = 'django_records_tree_parent'
+ROOT_NAME = 'django_records_tree_root'
+
+
+class TreeNode(RecordHandler):
+    """
+    wraps a handler, so that each row is kept as the dictionary the wrapped handler would be called with.
+    the records are created later, once the records of their children exist.
+    """
+    __slots__ = ['handler']
+
+    def __init__(self, handler: RecordHandler):
+        self.handler = handler
+        self.klass = handler.klass
+        self.trusted = handler.trusted
+
+    def create(self, **kwargs):
+        return kwargs
+
+    def factory(self, keys=None):
+        return lambda data: data
+
+    def get_field_names(self):
+        return self.handler.get_field_names()
+
+    def consumed_keys(self):
+        consumed = self.handler.consumed_keys()
+        if consumed is None:
+            return None
+        return consumed | {KEY_NAME, PARENT_NAME, ROOT_NAME}
+
+    @property
+    def required_arguments(self):
+        return self.handler.required_arguments
+
+
+def tree_relation(model, parent_field):
+    """the self-referencing foreign key parent_field of model."""
+    try:
+        field = model._meta.get_field(parent_field)
+    except Exception as e:
+        raise RecordClassDefinitionError(f"Relation {parent_field} not found on {model}.") from e
+    if not (field.many_to_one and field.concrete) or field.related_model is not field.model:
+        raise RecordClassDefinitionError(f"records_tree needs a self-referencing foreign key, {parent_field} is none.")
+    return field
+
+
+def root_queryset(queryset, field, root):
+    """the queryset of the root nodes: a queryset, an instance, a primary key or an iterable of them, or the nodes without parent."""
+    if root is None:
+        return queryset.filter(**{f'{field.name}__isnull': True})
+    if isinstance(root, QuerySet):
+        return queryset.filter(pk__in=root.values('pk'))
+    if isinstance(root, field.model):
+        return queryset.filter(pk=root.pk)
+    if isinstance(root, (list, tuple, set, frozenset)):
+        return queryset.filter(pk__in=[getattr(r, 'pk', r) for r in root])
+    return queryset.filter(pk=root)
+
+
+def subtree_sql(queryset, field, roots, max_depth):
+    """(sql, params) selecting the primary keys of the roots and their descendants up to max_depth levels below."""
+    connection = connections[queryset.db]
+    qn = connection.ops.quote_name
+    meta = field.model._meta
+    table = qn(meta.db_table)
+    pk = qn(meta.pk.column)
+    parent = qn(field.column)
+    roots_sql, roots_params = roots.values('pk').query.get_compiler(queryset.db).as_sql()
+    sql = (
+        f"WITH RECURSIVE django_records_tree (node, depth) AS ("
+        f"SELECT {table}.{pk}, 0 FROM {table} WHERE {table}.{pk} IN ({roots_sql}) "
+        f"UNION ALL "
+        f"SELECT {table}.{pk}, django_records_tree.depth + 1 FROM {table} "
+        f"INNER JOIN django_records_tree ON {table}.{parent} = django_records_tree.node "
+        f"WHERE django_records_tree.depth < %s"
+        f") SELECT node FROM django_records_tree"
+    )
+    return sql, (*roots_params, max_depth)
+
+
+def records_tree(queryset, parent_field: str, args=(), kwargs=None, children=None, root=None, container=tuple,
+                 max_depth: int = 32, max_rows: int | None = None, recursive: bool | None = None) -> list:
+    """see RecordQuerySetMixin.records_tree"""
+    field = tree_relation(queryset.model, parent_field)
+    if children is None:
+        children = field.remote_field.get_accessor_name()
+    if recursive is None:
+        recursive = connections[queryset.db].vendor in RECURSIVE_CTE_VENDORS
+
+    handler = queryset_handler(queryset, 'records_tree')
+    kwargs = {children: Skip(), **(kwargs or {})}
+    roots = root_queryset(queryset, field, root)
+
+    def nodes(nodes_queryset, **extra):
+        # the handler is set directly, so the arguments of a RecordSpec given to record_into() still apply.
+        nodes_queryset._record = TreeNode(handler)
+        records = nodes_queryset.records(
+            *args, **{KEY_NAME: F('pk'), PARENT_NAME: F(parent_field)}, **extra, **kwargs)
+        if max_rows is not None:
+            records = records[:max_rows + 1]
+        return list(records)
+
+    if recursive:
+        sql, params = subtree_sql(queryset, field, roots, max_depth)
+        is_root = ExpressionWrapper(Q(pk__in=roots.values('pk')), output_field=BooleanField())
+        data = nodes(queryset.filter(pk__in=RawSQL(sql, params)), **{ROOT_NAME: is_root})
+        check_rows(data, max_rows)
+        root_keys = [node[KEY_NAME] for node in data if node.pop(ROOT_NAME)]
+    else:
+        data = nodes(roots)
+        check_rows(data, max_rows)
+        root_keys = [node[KEY_NAME] for node in data]
+        level = root_keys
+        seen = set(level)
+        for _ in range(max_depth):
+            if not level:
+                break
+            found = [node for node in nodes(queryset.filter(**{f'{parent_field}__in': level}))
+                     if node[KEY_NAME] not in seen]
+            data.extend(found)
+            check_rows(data, max_rows)
+            level = [node[KEY_NAME] for node in found]
+            seen.update(level)
+    return build_tree(data, root_keys, handler, children, container)
+
+
+def check_rows(data, max_rows):
+    if max_rows is not None and len(data) > max_rows:
+        raise RecordTreeLimitError(f"Record tree has more than {max_rows} nodes.")
+
+
+def build_tree(data, root_keys, handler: RecordHandler, children: str, container) -> list:
+    """
+    creates the records of the nodes reachable from root_keys, children first, and returns the records of the roots.
+    every node is visited once, nodes in cycles or below excluded nodes are left out.
+    """
+    by_key = {}
+    children_of = defaultdict(list)
+    for node in data:
+        key = node.pop(KEY_NAME)
+        by_key[key] = node
+        children_of[node.pop(PARENT_NAME)].append(key)
+
+    # breadth first order from the roots, so every parent comes before its children.
+    order = [key for key in dict.fromkeys(root_keys) if key in by_key]
+    seen = set(order)
+    for key in order:
+        for child in children_of.get(key, ()):
+            if child not in seen:
+                seen.add(child)
+                order.append(child)
+
+    create = handler.factory(None)
+    records = {}
+    for key in reversed(order):
+        node = by_key[key]
+        node[children] = container([records[child] for child in children_of.get(key, ()) if child in records])
+        records[key] = create(node)
+    return [records[key] for key in dict.fromkeys(root_keys) if key in records]
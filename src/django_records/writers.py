@@ -0,0 +1,209 @@
+"""
+Streaming writers for records querysets.
+
+Records are written chunk by chunk as NDJSON, CSV or a JSON array, to a file-like object,
+or as generator for a StreamingHttpResponse, so memory stays flat no matter how many rows there are.
+
+orjson is used for encoding if it is installed, otherwise json with the DjangoJSONEncoder.
+
+With shape_only=True, no record instances are created at all: the handler only defines the fields,
+and the values are taken from the row tuples (or the adjunct dictionaries) directly.
+"""
+import csv
+import dataclasses
+import io
+from operator import attrgetter, itemgetter
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+from .columns import column_names
+from .errors import RecordClassDefinitionError
+from .handlers import RecordDict
+from .plans import chunked
+from .records import RecordIterable, streaming_iterable
+from .registry import registry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'json': 'application/json',
+}
+
+
+class RecordJSONEncoder(DjangoJSONEncoder):
+    """DjangoJSONEncoder that also encodes nested records."""
+
+    def default(self, o):
+        if dataclasses.is_dataclass(o) and not isinstance(o, type):
+            return dataclasses.asdict(o)
+        if hasattr(o, 'model_dump'):
+            return o.model_dump()
+        return super().default(o)
+
+
+def json_dumps():
+    """returns the fastest available function encoding an object as JSON string."""
+    if orjson is not None:
+        default = RecordJSONEncoder().default
+        return lambda obj: orjson.dumps(obj, default=default).decode()
+    return RecordJSONEncoder(separators=(',', ':')).encode
+
+
+def values_getter(fields):
+    """returns a function returning the values of fields of a record as tuple."""
+    if not fields:
+        return lambda record: ()
+    getter = attrgetter(*fields)
+    if len(fields) == 1:
+        return lambda record: (getter(record),)
+    return getter
+
+
+def record_values(iterable: RecordIterable, shape_only=False):
+    """
+    returns (fields, chunks), where chunks is an iterator over lists of value tuples in the order of fields.
+    """
+    plan = iterable.plan()
+    chunk_size = iterable.chunk_size
+    fields = column_names(plan)
+
+    if not shape_only:
+        if isinstance(plan.handler, RecordDict):
+            getter = lambda record: tuple(record.get(f) for f in fields)
+        else:
+            getter = values_getter(fields)
+
+        def chunks():
+            for rows in chunked(iterable.rows(), chunk_size):
+                yield list(map(getter, plan.build_chunk(rows)))
+        return fields, chunks()
+
+    try:
+        meta = registry.describe(plan.handler.record)
+    except Exception:
+        meta = None
+    # the defaults of the record class, as callables, so default factories give every row a value of its own.
+    defaults = {}
+    for field in fields:
+        if meta is not None and field in meta.defaults:
+            defaults[field] = (lambda value: lambda: value)(meta.defaults[field])
+        elif meta is not None and field in meta.factories:
+            defaults[field] = meta.factories[field]
+
+    def undefined(field):
+        return RecordClassDefinitionError(f"Field {field} of {plan.handler.record} is neither fetched nor has a default.")
+
+    def default(field):
+        if field not in defaults:
+            raise undefined(field)
+        return defaults[field]()
+
+    if not plan.adjuncts:
+        # the values come straight from the row tuples.
+        width = len(plan.names)
+        indexes = []
+        missing = []
+        for field in fields:
+            if field in plan.names:
+                indexes.append(plan.names.index(field))
+            elif field in defaults:
+                indexes.append(width + len(missing))
+                missing.append(defaults[field])
+            else:
+                raise undefined(field)
+        if len(indexes) == 1:
+            index = indexes[0]
+            getter = lambda row: (row[index],)
+        elif indexes:
+            getter = itemgetter(*indexes)
+        else:
+            getter = lambda row: ()
+        if missing:
+            row_getter = getter
+            getter = lambda row: row_getter((*row, *[make() for make in missing]))
+
+        def chunks():
+            for rows in chunked(iterable.rows(), chunk_size):
+                yield list(map(getter, rows))
+        return fields, chunks()
+
+    prepare = plan.compile_prepare()
+
+    def chunks():
+        for rows in chunked(iterable.rows(), chunk_size):
+            yield [tuple(dbdata[f] if f in dbdata else default(f) for f in fields) for dbdata in prepare(rows)]
+    return fields, chunks()
+
+
+def iter_ndjson(queryset, chunk_size=2000, shape_only=False):
+    """yields the records as newline delimited JSON, one string per chunk."""
+    fields, chunks = record_values(streaming_iterable(queryset, chunk_size), shape_only)
+    dumps = json_dumps()
+    for values in chunks:
+        if values:
+            yield ''.join([dumps(dict(zip(fields, row))) + '\n' for row in values])
+
+
+def iter_json(queryset, chunk_size=2000, shape_only=False):
+    """yields the records as one JSON array, one string per chunk."""
+    fields, chunks = record_values(streaming_iterable(queryset, chunk_size), shape_only)
+    dumps = json_dumps()
+    separator = '['
+    for values in chunks:
+        if values:
+            yield separator + ','.join([dumps(dict(zip(fields, row))) for row in values])
+            separator = ','
+    yield '[]' if separator == '[' else ']'
+
+
+def iter_csv(queryset, chunk_size=2000, shape_only=False, header=True, **fmtparams):
+    """yields the records as CSV, the header and each chunk as one string. fmtparams are passed to csv.writer."""
+    fields, chunks = record_values(streaming_iterable(queryset, chunk_size), shape_only)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, **fmtparams)
+    if header:
+        writer.writerow(fields)
+    for values in chunks:
+        writer.writerows(values)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+WRITERS = {
+    'ndjson': iter_ndjson,
+    'csv': iter_csv,
+    'json': iter_json,
+}
+
+
+def write_records(queryset, fp, format='ndjson', **kwargs):
+    """writes the records of queryset to the file-like object fp. binary files get utf-8."""
+    binary = not isinstance(fp, io.TextIOBase) and 'b' in getattr(fp, 'mode', 'b')
+    for data in WRITERS[format](queryset, **kwargs):
+        fp.write(data.encode() if binary else data)
+
+
+def write_ndjson(queryset, fp, **kwargs):
+    write_records(queryset, fp, 'ndjson', **kwargs)
+
+
+def write_csv(queryset, fp, **kwargs):
+    write_records(queryset, fp, 'csv', **kwargs)
+
+
+def write_json(queryset, fp, **kwargs):
+    write_records(queryset, fp, 'json', **kwargs)
+
+
+def streaming_response(queryset, format='ndjson', **kwargs) -> StreamingHttpResponse:
+    """returns a StreamingHttpResponse writing the records of queryset."""
+    return StreamingHttpResponse(WRITERS[format](queryset, **kwargs), content_type=CONTENT_TYPES[format])